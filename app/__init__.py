@@ -68,7 +68,12 @@ def create_app(config_class_string):
     # 這裡假設您的 `app.py` 中的 uploads 資料夾是需要的
     uploads_path = os.path.join(app.static_folder, 'uploads')
     os.makedirs(uploads_path, exist_ok=True)
-    
+
+    # 7. 啟動藥單分析工作佇列的工作執行緒
+    from .services.analysis_queue import get_analysis_queue
+    from .routes.handlers.prescription_handler import run_analysis_job, on_analysis_job_dead
+    get_analysis_queue().start(app, run_analysis_job, on_dead=on_analysis_job_dead)
+
     print("Flask App 建立成功，並已註冊所有藍圖。")
     
     return app
\ No newline at end of file
@@ -5,11 +5,12 @@ from linebot.models import TextSendMessage, ImageMessage, FlexSendMessage, Postb
 from urllib.parse import parse_qs, unquote
 import time
 import traceback
-import base64
 from app import line_bot_api
 
 from app.services.user_service import UserService
 from app.services import prescription_service
+from app.services.analysis_queue import get_analysis_queue
+from app.services.blob_store import get_blob_store
 from app.utils.flex import prescription as flex_prescription, general as flex_general
 from app.utils.flex.prescription import create_prescription_model_choice
 from app.utils.db import DB
@@ -48,6 +49,92 @@ def _reply_message(reply_token, message):
     except Exception as e:
         current_app.logger.error(f"回覆訊息失敗: {e}")
 
+def _add_page_url(task_info):
+    """任務保有逐張圖片的分析結果時，回傳「加拍一頁」的相機 LIFF 網址；否則回傳 None。"""
+    task_id = task_info.get('task_id')
+    if not task_id or not task_info.get('image_results'):
+        return None
+    return f"https://liff.line.me/{current_app.config['LIFF_ID_CAMERA']}?taskId={task_id}&append=1"
+
+def _make_partial_report_pusher(user_id, member_name):
+    """
+    串流分析模式下，解析出足夠的藥物後先推送一次部分結果，完整報告仍由原本的回覆送出。
+    每次分析只推送一次，避免消耗過多推播額度；未啟用串流時回傳 None。
+    """
+    if not current_app.config.get('ANALYSIS_STREAMING_ENABLED'):
+        return None
+    
+    threshold = current_app.config.get('ANALYSIS_STREAM_PARTIAL_AFTER', 2)
+    medications = []
+    pushed = False
+    
+    def on_medication(medication):
+        nonlocal pushed
+        medications.append(medication)
+        if pushed or len(medications) < threshold:
+            return
+        pushed = True
+        try:
+            line_bot_api.push_message(user_id, flex_prescription.create_partial_analysis_message(list(medications), member_name))
+            print(f"📤 [prescription_handler] 已推送部分分析結果 ({len(medications)} 種藥物) - 用戶: {user_id}")
+        except Exception as e:
+            print(f"⚠️ [prescription_handler] 推送部分分析結果失敗: {e}")
+    
+    return on_medication
+
+def _push_deferred_report(user_id, task_id, success):
+    """背景分析完成後（由分析工作佇列或 OcrJobTracker 於 app context 內呼叫），以推播訊息送出分析報告。"""
+    try:
+        if not success:
+            line_bot_api.push_message(user_id, TextSendMessage(text="❌ 藥單辨識失敗，請重新上傳照片。"))
+            return
+        
+        task_info = UserService.get_user_complex_state_path(user_id, 'last_task', {}) or {}
+        results = task_info.get('results')
+        if task_info.get('task_id') != task_id or not results:
+            return
+        
+        freq_map_list = DB.get_frequency_map()
+        frequency_map = {item['frequency_code']: item for item in freq_map_list}
+        messages = flex_prescription.generate_analysis_report_messages(
+            results, frequency_map, current_app.config['LIFF_ID_EDIT'],
+            current_app.config['LIFF_ID_PRESCRIPTION_REMINDER'], task_info.get('member', ''),
+            add_page_url=_add_page_url(task_info)
+        )
+        line_bot_api.push_message(user_id, messages)
+        print(f"📤 [prescription_handler] 已推送背景辨識結果 - 用戶: {user_id}")
+    except Exception as e:
+        print(f"❌ [prescription_handler] 推送背景辨識結果失敗: {e}")
+
+# 分析排入佇列後的回覆
+_QUEUED_REPLY = "⏳ 已收到藥單照片，正在分析中，完成後會自動傳送結果給您，請稍候。"
+
+def run_analysis_job(job):
+    """分析工作佇列的執行函式（於工作執行緒的 app context 內呼叫）：執行分析並以推播送出報告，失敗時拋出例外以重試。"""
+    user_id, task_id = job['user_id'], job['task_id']
+    task_info = UserService.get_user_complex_state_path(user_id, 'last_task', {}) or {}
+    if task_info.get('task_id') != task_id:
+        print(f"⚠️ [prescription_handler] 任務 {task_id} 已被新的操作取代，略過分析 - 用戶: {user_id}")
+        return
+    
+    # 串流模式下會先推送部分結果；重試時不再推送，避免用戶重複收到同一份部分報告
+    on_medication = None
+    if job['attempts'] == 1:
+        on_medication = _make_partial_report_pusher(user_id, task_info.get('member', ''))
+    outcome = prescription_service.PrescriptionService.trigger_analysis(
+        user_id, task_id, on_medication=on_medication, on_deferred=_push_deferred_report
+    )
+    if outcome == prescription_service.ANALYSIS_PENDING:
+        # 外部 OCR 改為背景處理，完成後由 OcrJobTracker 呼叫 _push_deferred_report
+        return
+    if outcome is not True:
+        raise RuntimeError("藥單分析失敗")
+    _push_deferred_report(user_id, task_id, True)
+
+def on_analysis_job_dead(job, error):
+    """分析任務重試次數用盡時通知用戶。"""
+    _push_deferred_report(job['user_id'], job['task_id'], False)
+
 # 新增：處理模型選擇的函數
 def handle_prescription_model_select(event, data):
     """處理藥單分析模型選擇"""
@@ -61,10 +148,9 @@ def handle_prescription_model_select(event, data):
             return
         
         # 儲存選擇的模型到用戶狀態（UserService 會自動確保用戶存在）
-        user_state = UserService.get_user_complex_state(user_id) or {}
-        user_state['selected_model'] = model_type
-        user_state['stage'] = 'model_selected'
-        result = UserService.set_user_complex_state(user_id, user_state)
+        result = UserService.update_user_complex_state(
+            user_id, sets={'selected_model': model_type, 'stage': 'model_selected'}
+        )
         
         if not result:
             current_app.logger.error(f"無法設置用戶狀態: {user_id}")
@@ -125,12 +211,15 @@ def handle(event):
             if action == 'select_patient_for_scan':
                 member_name = data.get('member', [None])[0]
                 if member_name:
-                    # 保留現有狀態，特別是 selected_model
-                    state = UserService.get_user_complex_state(user_id) or {}
-                    state["state_info"] = {"state": "AWAITING_IMAGE"}
-                    state["last_task"] = state.get("last_task", {})
-                    state["last_task"]["member"] = member_name
-                    result = UserService.set_user_complex_state(user_id, state)
+                    import time
+                    task_id = f"task_{int(time.time())}"
+                    
+                    # 保留現有狀態（特別是 selected_model），只更新流程狀態與任務資訊
+                    result = UserService.update_user_complex_state(user_id, sets={
+                        "state_info": {"state": "AWAITING_IMAGE"},
+                        "last_task.member": member_name,
+                        "last_task.task_id": task_id,
+                    })
                     
                     if not result:
                         current_app.logger.error(f"無法設置用戶狀態: {user_id}")
@@ -139,12 +228,6 @@ def handle(event):
                     
                     # 生成拍照選項
                     from linebot.models import QuickReply, QuickReplyButton, CameraAction, URIAction
-                    import time
-                    task_id = f"task_{int(time.time())}"
-                    
-                    # 更新狀態包含 task_id
-                    state["last_task"]["task_id"] = task_id
-                    UserService.set_user_complex_state(user_id, state)
                     
                     # 修正 LIFF URL 格式 - 確保參數正確傳遞
                     liff_url = f"https://liff.line.me/{current_app.config['LIFF_ID_CAMERA']}?taskId={task_id}"
@@ -164,16 +247,16 @@ def handle(event):
             # 處理其他 action
             if action == 'start_camera':
                 # 重新拍照功能
-                state = UserService.get_user_complex_state(user_id)
-                member_name = state.get("last_task", {}).get("member", "")
+                member_name = UserService.get_user_complex_state_path(user_id, "last_task.member", "")
                 
                 if member_name:
                     import time
                     task_id = f"task_{int(time.time())}"
                     
-                    state["state_info"] = {"state": "AWAITING_IMAGE"}
-                    state["last_task"]["task_id"] = task_id
-                    UserService.set_user_complex_state(user_id, state)
+                    UserService.update_user_complex_state(user_id, sets={
+                        "state_info": {"state": "AWAITING_IMAGE"},
+                        "last_task.task_id": task_id,
+                    })
                     
                     from linebot.models import QuickReply, QuickReplyButton, CameraAction, URIAction
                     liff_url = f"https://liff.line.me/{current_app.config['LIFF_ID_CAMERA']}?taskId={task_id}"
@@ -294,10 +377,9 @@ def handle_text_message(event, user_id):
         UserService.clear_user_complex_state(user_id)
         
         # 直接設定為FastAPI模式並進入成員選擇
-        user_state = UserService.get_user_complex_state(user_id) or {}
-        user_state['selected_model'] = 'fastapi_ocr'
-        user_state['stage'] = 'model_selected'
-        UserService.set_user_complex_state(user_id, user_state)
+        UserService.update_user_complex_state(
+            user_id, sets={'selected_model': 'fastapi_ocr', 'stage': 'model_selected'}
+        )
         
         # 獲取成員列表並顯示成員選擇
         members = UserService.get_user_members(user_id)
@@ -315,9 +397,8 @@ def handle_text_message(event, user_id):
     if text == "📝 預覽手動修改結果":
         print(f"🔍 [prescription_handler] 處理預覽手動修改結果 - 用戶: {user_id}")
         try:
-            # 獲取用戶狀態
-            state = UserService.get_user_complex_state(user_id)
-            task_info = state.get("last_task", {})
+            # 獲取用戶狀態（只讀取 last_task）
+            task_info = UserService.get_user_complex_state_path(user_id, "last_task", {}) or {}
             results = task_info.get("results")
             
             print(f"📊 [prescription_handler] 用戶狀態 - 有結果: {bool(results)}")
@@ -334,7 +415,7 @@ def handle_text_message(event, user_id):
                 
                 messages = flex_prescription.generate_analysis_report_messages(
                     results, frequency_map, liff_edit_id, liff_reminder_id, member_name, 
-                    is_direct_view=False, source="manual_edit"
+                    is_direct_view=False, source="manual_edit", add_page_url=_add_page_url(task_info)
                 )
                 
                 # 發送預覽結果
@@ -354,44 +435,8 @@ def handle_text_message(event, user_id):
     
     # 處理 LIFF 上傳成功訊息
     if "照片上傳成功" in text and "正在分析中" in text:
-        # 啟動載入動畫
+        # 分析已在 LIFF 上傳時排入佇列，完成後以推播送出結果；這裡只顯示載入動畫
         start_loading_animation(user_id, seconds=60)
-        
-        try:
-            # 獲取任務ID
-            state = UserService.get_user_complex_state(user_id)
-            task_id = state.get("last_task", {}).get("task_id")
-            
-            if not task_id:
-                _reply_message(reply_token, TextSendMessage(text="❌ 找不到任務ID，請重新操作。"))
-                return
-            
-            # 執行同步分析
-            prescription_service.PrescriptionService.trigger_analysis(user_id, task_id)
-            
-            # 獲取分析結果
-            updated_state = UserService.get_user_complex_state(user_id)
-            results = updated_state.get('last_task', {}).get('results')
-            
-            if results:
-                # 準備分析結果訊息
-                freq_map_list = DB.get_frequency_map()
-                frequency_map = {item['frequency_code']: item for item in freq_map_list}
-                liff_edit_id = current_app.config['LIFF_ID_EDIT']
-                liff_reminder_id = current_app.config['LIFF_ID_PRESCRIPTION_REMINDER']
-                member_name = state.get('last_task', {}).get('member', '')
-                
-                messages = flex_prescription.generate_analysis_report_messages(
-                    results, frequency_map, liff_edit_id, liff_reminder_id, member_name
-                )
-                
-                _reply_message(reply_token, messages)
-            else:
-                _reply_message(reply_token, TextSendMessage(text="❌ 分析過程中發生錯誤，請重新上傳照片。"))
-                
-        except Exception as e:
-            current_app.logger.error(f"藥單分析處理失敗: {e}")
-            _reply_message(reply_token, TextSendMessage(text="❌ 分析過程中發生錯誤，請重新上傳照片。"))
         return
     
     # 處理跳過提醒設定的訊息
@@ -422,63 +467,35 @@ def handle_image_message(reply_token, message_id, user_id):
         
         print(f"📋 [藥單辨識] 為成員 '{member_name}' 處理圖片")
         
-        # 啟動載入動畫
-        start_loading_animation(user_id, seconds=60)
-        
         # 下載圖片
         message_content = line_bot_api.get_message_content(message_id)
         image_bytes = message_content.content
         
         print(f"📥 [藥單辨識] 圖片下載完成，大小: {len(image_bytes)} bytes")
         
-        # 將圖片轉為base64並儲存到狀態
-        image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+        # 圖片存入 blob store，狀態只保存內容雜湊
+        image_hash = get_blob_store().put(image_bytes)
         
         # 生成任務ID
         import time
         task_id = f"task_{int(time.time())}"
         
-        # 更新用戶狀態
-        state["last_task"]["image_bytes_list"] = [image_b64]
-        state["last_task"]["task_id"] = task_id
-        state["state_info"]["state"] = "PROCESSING"
-        UserService.set_user_complex_state(user_id, state)
+        # 更新用戶狀態（只改寫相關路徑）
+        UserService.update_user_complex_state(
+            user_id,
+            sets={"last_task.image_hashes": [image_hash], "last_task.task_id": task_id,
+                  "state_info.state": "PROCESSING"},
+            removes=["last_task.image_results"]
+        )
         
         print(f"💾 [藥單辨識] 狀態已更新，任務ID: {task_id}")
         
-        # 執行同步分析
-        try:
-            prescription_service.PrescriptionService.trigger_analysis(user_id, task_id)
-            print(f"🔄 [藥單辨識] 分析完成")
-            
-            # 獲取分析結果
-            updated_state = UserService.get_user_complex_state(user_id)
-            results = updated_state.get('last_task', {}).get('results')
-            
-            if results:
-                print(f"✅ [藥單辨識] 分析成功，準備發送結果")
-                
-                # 準備分析結果訊息
-                freq_map_list = DB.get_frequency_map()
-                frequency_map = {item['frequency_code']: item for item in freq_map_list}
-                liff_edit_id = current_app.config['LIFF_ID_EDIT']
-                liff_reminder_id = current_app.config['LIFF_ID_PRESCRIPTION_REMINDER']
-                
-                messages = flex_prescription.generate_analysis_report_messages(
-                    results, frequency_map, liff_edit_id, liff_reminder_id, member_name
-                )
-                
-                _reply_message(reply_token, messages)
-                print(f"📤 [藥單辨識] 結果已發送給用戶")
-                
-            else:
-                print(f"❌ [藥單辨識] 分析失敗，沒有結果")
-                _reply_message(reply_token, TextSendMessage(text="❌ 分析過程中發生錯誤，請重新上傳照片。"))
-                
-        except Exception as analysis_error:
-            print(f"❌ [藥單辨識] 分析過程錯誤: {analysis_error}")
-            traceback.print_exc()
-            _reply_message(reply_token, TextSendMessage(text="❌ 分析過程中發生錯誤，請重新上傳照片。"))
+        # 排入分析佇列後立即回覆，結果由工作執行緒以推播送出
+        get_analysis_queue().enqueue(user_id, task_id)
+        _reply_message(reply_token, TextSendMessage(text=_QUEUED_REPLY))
+        
+        # 回覆後再啟動載入動畫，持續到推播結果送達
+        start_loading_animation(user_id, seconds=60)
         
     except Exception as e:
         current_app.logger.error(f"處理圖片訊息時發生錯誤: {e}")
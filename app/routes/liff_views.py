@@ -2,12 +2,15 @@
 
 from flask import Blueprint, request, jsonify, render_template, current_app
 import requests
-import base64
 import traceback
 
 # 從服務層導入邏輯
 from ..services.user_service import UserService
 from ..services import prescription_service, reminder_service
+from ..services.ocr_cache import image_sha256
+from ..services.analysis_queue import get_analysis_queue
+from ..services.blob_store import get_blob_store
+from ..services.state_store import StateConflictError
 from ..utils.helpers import convert_minguo_to_gregorian
 
 # 導入數據庫操作類別
@@ -117,10 +120,9 @@ def get_draft_api():
     if not user_id:
         return jsonify({"status": "error", "message": "無效的 Token"}), 401
 
-    full_state = UserService.get_user_complex_state(user_id)
-    task_info = full_state.get("last_task", {})
+    # 只讀取 last_task，不載入整份狀態
+    task_info = UserService.get_user_complex_state_path(user_id, "last_task", {}) or {}
     
-    current_app.logger.info(f"草稿檢查 - 用戶: {user_id}, full_state keys: {list(full_state.keys())}")
     current_app.logger.info(f"草稿檢查 - task_info keys: {list(task_info.keys()) if task_info else 'None'}")
 
     if 'results' in task_info:
@@ -175,7 +177,6 @@ def get_draft_api():
             "suggestion": "請先進行藥單掃描分析，或從藥歷記錄中選擇要修改的項目。",
             "debug_info": {
                 "user_id": user_id,
-                "has_state": bool(full_state),
                 "has_task": bool(task_info),
                 "task_keys": list(task_info.keys()) if task_info else []
             }
@@ -194,23 +195,20 @@ def update_draft_api():
         
     updated_draft = data['draftData']
 
-    full_state = UserService.get_user_complex_state(user_id)
-    task_to_update = full_state.get("last_task", {})
+    # 只更新 last_task 底下的欄位，不讀取與改寫整份狀態
+    updates = {"last_task.results": updated_draft, "last_task.source": "manual_edit"}
     
     # 處理 member 和 mm_id_to_update 資訊
     member = updated_draft.pop('member', None) 
     if member:
-        task_to_update['member'] = member
+        updates['last_task.member'] = member
     
     mm_id = updated_draft.pop('mm_id_to_update', None)
     if mm_id:
-        task_to_update['mm_id_to_update'] = mm_id
+        updates['last_task.mm_id_to_update'] = mm_id
     
-    task_to_update["results"] = updated_draft
-    task_to_update["source"] = "manual_edit"
-    
-    full_state['last_task'] = task_to_update
-    UserService.set_user_complex_state(user_id, full_state)
+    if not UserService.update_user_complex_state(user_id, sets=updates):
+        return jsonify({"status": "error", "message": "儲存草稿失敗，請稍後再試。"}), 500
     
     current_app.logger.info(f"草稿已更新，用戶: {user_id}, 成員: {member}")
     
@@ -226,18 +224,42 @@ def upload_multiple_prescriptions():
         if not all([user_id, task_id, photos]):
             return jsonify({"status": "error", "message": "請求缺少必要參數"}), 400
 
-        state = UserService.get_user_complex_state(user_id)
+        state, version = UserService.get_user_complex_state_versioned(user_id)
         if state.get("last_task", {}).get("task_id") != task_id:
              return jsonify({"status": "error", "message": "任務ID不匹配，請重新操作。"}), 400
 
-        image_b64_list = [base64.b64encode(p.read()).decode('utf-8') for p in photos]
-        state["last_task"]["image_bytes_list"] = image_b64_list
-        state.pop("state_info", None) 
-        UserService.set_user_complex_state(user_id, state)
+        uploaded = {}
+        for photo in photos:
+            image_bytes = photo.read()
+            uploaded.setdefault(image_sha256(image_bytes), image_bytes)
+        last_task = state["last_task"]
+        removes = ["state_info"]
+        if request.form.get('mode') == 'append' and last_task.get("image_hashes"):
+            # 加拍頁面：保留已上傳的圖片，只附加內容不重複的新圖片（分析時只會送出新圖片）
+            image_hashes = list(last_task["image_hashes"])
+            image_hashes += [image_hash for image_hash in uploaded if image_hash not in image_hashes]
+            if len(image_hashes) > 10:
+                return jsonify({"status": "error", "message": "同一張藥單最多只能有10張照片。"}), 400
+        else:
+            # 重新上傳：捨棄先前每張圖片的分析結果
+            image_hashes = list(uploaded)
+            removes.append("last_task.image_results")
+        
+        # 圖片存入 blob store（以內容雜湊為鍵），狀態只保存雜湊
+        blob_store = get_blob_store()
+        for image_bytes in uploaded.values():
+            blob_store.put(image_bytes)
+        try:
+            # 以讀取時的版本號寫入：期間任務被其他請求改寫（例如重新拍照）時不覆蓋
+            UserService.update_user_complex_state(
+                user_id, sets={"last_task.image_hashes": image_hashes}, removes=removes, expected_version=version
+            )
+        except StateConflictError:
+            return jsonify({"status": "error", "message": "任務已被其他操作更新，請重新操作。"}), 409
         
-        # 不再需要背景線程，改為在 prescription_handler 中同步處理
+        # 排入分析佇列後立即回覆，結果由工作執行緒以推播送出
+        get_analysis_queue().enqueue(user_id, task_id)
         
-        # 先回覆上傳成功，然後在背景執行分析
         return jsonify({
             "status": "success", 
             "message": "✅ 照片上傳成功！正在分析中，請稍候...",
@@ -3,6 +3,7 @@
 from flask import Blueprint, request, abort, current_app
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, PostbackEvent, FollowEvent, TextMessage, ImageMessage, TextSendMessage, FlexSendMessage
+import functools
 import traceback
 
 from app import handler, line_bot_api
@@ -18,6 +19,7 @@ except ImportError:
     pill_handler = None
 
 from ..services.user_service import UserService
+from ..utils.ordered_dispatcher import get_webhook_dispatcher
 from ..utils.flex import general as flex_general
 from ..utils.flex import health as flex_health
 from ..utils.flex import prescription as flex_prescription
@@ -29,19 +31,63 @@ webhook_bp = Blueprint('webhook', __name__)
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    current_app.logger.info("Request body: " + body)
     try:
-        handler.handle(body, signature)
+        # 只驗證簽章並解析事件，處理交給背景分派器，LINE 不必等處理完成才收到 200
+        payload = handler.parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
         abort(400)
     except Exception as e:
-        current_app.logger.error(f"處理 Webhook 時發生錯誤: {e}")
+        current_app.logger.error(f"解析 Webhook 時發生錯誤: {e}")
         traceback.print_exc()
-        abort(500)
+        abort(400)
+
+    app = current_app._get_current_object()
+    base_url = request.host_url
+    dispatcher = get_webhook_dispatcher()
+    for event in payload.events:
+        # 同一用戶的事件依序處理（狀態機依賴順序），不同用戶之間同時處理
+        source = getattr(event, 'source', None)
+        key = getattr(source, 'user_id', None) or getattr(source, 'group_id', None) or getattr(source, 'room_id', None)
+        dispatcher.submit(key or 'unknown', _event_key(event), functools.partial(_handle_event, app, base_url, event))
+    current_app.logger.info(f"收到 {len(payload.events)} 個 Webhook 事件: {[_event_key(event) for event in payload.events]}")
     return 'OK'
 
 
-@handler.add(MessageEvent, message=(TextMessage, ImageMessage))
+# 事件處理函式：{處理函式鍵: 函式}，由 _on_event 註冊
+_event_handlers = {}
+
+
+def _event_key(event):
+    """事件對應的處理函式鍵（同 WebhookHandler：訊息事件為「事件類型_訊息類型」）。"""
+    if isinstance(event, MessageEvent):
+        return f"{type(event).__name__}_{type(event.message).__name__}"
+    return type(event).__name__
+
+
+def _on_event(event_type, message=None):
+    """註冊事件處理函式（用法同 WebhookHandler.add）。"""
+    def decorator(func):
+        messages = message if isinstance(message, (list, tuple)) else [message]
+        for message_type in messages:
+            key = event_type.__name__ if message_type is None else f"{event_type.__name__}_{message_type.__name__}"
+            _event_handlers[key] = func
+        return func
+    return decorator
+
+
+def _handle_event(app, base_url, event):
+    """
+    在分派器的執行緒中處理單一事件，查找順序與 WebhookHandler.handle 相同：訊息類型 → 事件類型。
+    以原請求的網址建立請求 context，處理函式中的 url_for(..., _external=True) 才能產生完整網址。
+    """
+    func = _event_handlers.get(_event_key(event)) or _event_handlers.get(type(event).__name__)
+    if func is None:
+        return
+    with app.test_request_context(base_url=base_url):
+        func(event)
+
+
+@_on_event(MessageEvent, message=(TextMessage, ImageMessage))
 def handle_message_dispatcher(event):
     user_id = event.source.user_id
     UserService.get_or_create_user(user_id)
@@ -287,7 +333,7 @@ def handle_login_request(event):
         current_app.logger.error(f"登入請求處理錯誤: {e}")
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="登入功能暫時無法使用，請稍後再試。"))
 
-@handler.add(FollowEvent)
+@_on_event(FollowEvent)
 def handle_follow_event(event):
     """處理用戶第一次加入 Bot 的事件 - 顯示個人資料蒐集聲明"""
     try:
@@ -322,7 +368,7 @@ def handle_follow_event(event):
         except Exception as fallback_error:
             current_app.logger.error(f"發送備用歡迎訊息也失敗: {fallback_error}")
 
-@handler.add(PostbackEvent)
+@_on_event(PostbackEvent)
 def handle_postback_dispatcher(event):
     from urllib.parse import parse_qs, unquote
     
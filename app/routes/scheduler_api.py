@@ -3,6 +3,7 @@
 
 from flask import Blueprint, jsonify, request, current_app
 from datetime import datetime
+import hmac
 import os
 
 scheduler_api = Blueprint('scheduler_api', __name__)
@@ -41,6 +42,27 @@ def check_reminders_endpoint():
             'error': str(e)
         }), 500
 
+@scheduler_api.route('/api/ocr/callback', methods=['POST'])
+def ocr_callback():
+    """
+    外部 OCR API 的完成回呼端點（送出任務時附上的 callback_url），
+    內容格式與輪詢結果相同：{"status": "completed" | "error" | "processing", "data": ..., "message": ...}
+    """
+    expected_token = current_app.config.get('OCR_CALLBACK_TOKEN') or ''
+    token = request.args.get('token', '')
+    if not expected_token or not hmac.compare_digest(token, expected_token):
+        current_app.logger.warning(f"未授權的 OCR 回呼請求: {request.remote_addr}")
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    payload = request.get_json(silent=True) or {}
+    job_key = request.args.get('job_key') or payload.get('job_key')
+    if not job_key:
+        return jsonify({'error': 'job_key is required'}), 400
+    
+    from app.services.prescription_service import PrescriptionService
+    accepted = PrescriptionService.handle_ocr_callback(job_key, payload)
+    return jsonify({'status': 'accepted' if accepted else 'ignored'})
+
 @scheduler_api.route('/api/health-detailed', methods=['GET'])
 def health_check_detailed():
     """
@@ -48,7 +70,19 @@ def health_check_detailed():
     """
     try:
         from app.utils.db import get_db_connection
-        
+        from app.utils.db_pool import get_pool
+        from app.services.drug_catalog import get_catalog
+        from app.services.ocr_cache import get_ocr_cache
+        from app.services.analysis_cache import get_analysis_cache
+        from app.services.gemini_gateway import get_gemini_gateway
+        from app.utils.async_runtime import get_async_runtime
+        from app.services.ocr_job_tracker import get_ocr_job_tracker
+        from app.services.analysis_queue import get_analysis_queue
+        from app.utils.ordered_dispatcher import get_webhook_dispatcher
+        from app.services.session_cache import get_session_cache
+        from app.services.blob_store import get_blob_store
+        from app.utils.state_codec import get_state_codec
+
         # 檢查資料庫連線
         db_status = 'unknown'
         try:
@@ -79,6 +113,18 @@ def health_check_detailed():
             'status': 'healthy',
             'timestamp': datetime.now().isoformat(),
             'database': db_status,
+            'db_pool': get_pool().stats(),
+            'drug_catalog': get_catalog().stats(),
+            'ocr_cache': get_ocr_cache().stats(),
+            'analysis_cache': get_analysis_cache().stats(),
+            'gemini_gateway': get_gemini_gateway().stats(),
+            'async_runtime': get_async_runtime().stats(),
+            'ocr_jobs': get_ocr_job_tracker().stats(),
+            'analysis_queue': get_analysis_queue().stats(),
+            'webhook_dispatcher': get_webhook_dispatcher().stats(),
+            'session_cache': get_session_cache().stats(),
+            'blob_store': get_blob_store().stats(),
+            'state_codec': get_state_codec().stats(),
             'environment': env_status,
             'is_cloud_run': os.environ.get('K_SERVICE') is not None,
             'version': '1.0.0'
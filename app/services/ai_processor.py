@@ -7,36 +7,40 @@ import base64
 import traceback
 import asyncio
 import concurrent.futures
+from types import SimpleNamespace
 from typing import List, Dict, Any, Tuple
 from google.genai import types
-from google import genai
-import pymysql
 
-def get_all_drugs_from_db(db_config: dict):
-    """從資料庫獲取所有藥物"""
+from config import Config
+from . import drug_vector_scorer
+from .analysis_merge import merge_group_results, plan_image_groups, remap_source_image
+from .analysis_prompt import encode_drug_table, encode_frequency_table, estimate_tokens, join_drug_details
+from .drug_alias import AliasMatches, get_alias_table
+from .drug_catalog import get_catalog
+from .drug_name_index import (
+    SIMILARITY_THRESHOLD, DrugNameIndex, extract_drug_components, get_drug_name_index, normalize_drug_name,
+)
+from .gemini_gateway import get_gemini_gateway
+from .image_preprocessor import preprocess_images
+from .ocr_cache import OCR_MODEL, get_ocr_cache, image_sha256
+from .streaming_json import JsonArrayStreamParser
+from ..utils.async_runtime import get_async_runtime
+
+# 頻率導向完整分析使用的模型
+ANALYSIS_MODEL = "gemini-2.5-flash"
+
+def get_all_drugs_from_db(db_config: dict = None):
+    """
+    從行程內共用的藥品目錄獲取所有藥物（唯讀）。
+    目錄只在首次使用或版本變動時才查詢資料庫；db_config 保留供相容舊呼叫端。
+    """
     try:
-        # 確保 db_config 中的 port 是整數
-        if 'port' in db_config and isinstance(db_config['port'], str):
-            db_config['port'] = int(db_config['port'])
-            
-        conn = pymysql.connect(**db_config, cursorclass=pymysql.cursors.DictCursor)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT drug_id, drug_name_zh, drug_name_en, main_use, side_effects 
-            FROM drug_info 
-            ORDER BY drug_id
-        """)
-        
-        all_drugs = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
+        all_drugs = get_catalog().get_analysis_rows()
         print(f"[Smart Filter] 載入全部 {len(all_drugs)} 種藥物")
         return all_drugs
-        
+
     except Exception as e:
-        print(f"[Smart Filter] 資料庫連接失敗: {e}")
+        print(f"[Smart Filter] 藥品目錄載入失敗: {e}")
         return []
 
 def get_frequency_database():
@@ -52,15 +56,10 @@ def get_frequency_database():
         {"frequency_code": "PC", "frequency_name": "飯後服用", "times_per_day": 0.0, "timing_description": "飯後"}
     ]
 
-def extract_drug_keywords_batch(image_bytes_list: List[bytes], api_key: str) -> Tuple[List[str], int]:
-    """使用單次API調用從多張圖片提取藥物關鍵字"""
-    try:
-        print(f"[Smart Filter] 批次提取 {len(image_bytes_list)} 張圖片的藥物關鍵字...")
-        
-        client = genai.Client(api_key=api_key)
-        
-        # 批次OCR prompt - 加強對特定藥物的識別
-        ocr_prompt = f"""請快速識別這{len(image_bytes_list)}張圖片中的藥物名稱關鍵字。
+def _request_batch_keywords(image_bytes_list: List[bytes], api_key: str) -> Tuple[List[str], int]:
+    """實際呼叫 Gemini 從多張圖片提取藥物關鍵字（不經過快取，失敗時拋出例外）"""
+    # 批次OCR prompt - 加強對特定藥物的識別（修改內容時請更新 ocr_cache.OCR_PROMPT_VERSION）
+    ocr_prompt = f"""請快速識別這{len(image_bytes_list)}張圖片中的藥物名稱關鍵字。
 只需要提取藥物的英文名稱和中文名稱關鍵字，不需要其他資訊。
 
 特別注意以下容易誤識的藥物：
@@ -69,51 +68,107 @@ def extract_drug_keywords_batch(image_bytes_list: List[bytes], api_key: str) ->
 
 用逗號分隔，例如：ALPRAZOLAM,MOCALM,安柏寧,永康緒,摩舒益多,MOSAPRIDE
 請將所有圖片中的藥物關鍵字合併輸出。"""
+    
+    prompt_parts = [types.Part.from_text(text=ocr_prompt)]
+    
+    # 添加所有圖片
+    for i, image_bytes in enumerate(image_bytes_list):
+        prompt_parts.append(types.Part(
+            inline_data=types.Blob(
+                mime_type='image/jpeg',
+                data=base64.b64encode(image_bytes).decode()
+            )
+        ))
+    
+    contents = [types.Content(role="user", parts=prompt_parts)]
+    config = types.GenerateContentConfig(temperature=0)
+    
+    response = get_gemini_gateway().generate_content(
+        api_key, 'ocr',
+        model=OCR_MODEL,
+        contents=contents,
+        config=config
+    )
+    
+    keywords_text = response.text if hasattr(response, 'text') else ""
+    keywords = list(set([k.strip() for k in keywords_text.split(',') if k.strip()]))  # 去重
+    
+    # 統計OCR的TOKEN使用
+    ocr_tokens = 0
+    if hasattr(response, 'usage_metadata') and response.usage_metadata:
+        ocr_tokens = getattr(response.usage_metadata, 'total_token_count', 0)
+        print(f"[Smart Filter] 批次OCR Token使用: {ocr_tokens}")
+    
+    return keywords, ocr_tokens
+
+def extract_drug_keywords_batch(image_bytes_list: List[bytes], api_key: str, cache_stats: dict = None) -> Tuple[List[str], int]:
+    """
+    使用單次API調用從多張圖片提取藥物關鍵字
+
+    以圖片內容雜湊快取結果：重新上傳相同藥單或失敗後重試時不會再次呼叫 OCR，
+    只有沒有快取的圖片才會送出。傳入 cache_stats 時會填入 hits / misses / tokens_saved。
+    回傳的 token 數只包含這次實際使用的 token。
+    """
+    stats = cache_stats if cache_stats is not None else {}
+    stats.update({'hits': 0, 'misses': 0, 'tokens_saved': 0})
+    cached_keywords = []
+    try:
+        print(f"[Smart Filter] 批次提取 {len(image_bytes_list)} 張圖片的藥物關鍵字...")
         
-        prompt_parts = [types.Part.from_text(text=ocr_prompt)]
-        
-        # 添加所有圖片
-        for i, image_bytes in enumerate(image_bytes_list):
-            prompt_parts.append(types.Part(
-                inline_data=types.Blob(
-                    mime_type='image/jpeg',
-                    data=base64.b64encode(image_bytes).decode()
-                )
-            ))
-        
-        contents = [types.Content(role="user", parts=prompt_parts)]
-        config = types.GenerateContentConfig(temperature=0)
-        
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=contents,
-            config=config
-        )
+        cache = get_ocr_cache()
+        image_hashes = [image_sha256(image_bytes) for image_bytes in image_bytes_list]
+        
+        # 整組圖片曾經一起分析過
+        cached = cache.get(image_hashes, 'batch')
+        if cached is not None:
+            stats.update({'hits': len(image_hashes), 'tokens_saved': cached['tokens']})
+            print(f"[OCR Cache] 命中 {len(image_hashes)} 張圖片，節省 Token: {cached['tokens']}")
+            print(f"[Smart Filter] 批次提取關鍵字: {cached['keywords']}")
+            return list(cached['keywords']), 0
+        
+        # 逐張查詢，只對沒有快取的圖片呼叫 OCR
+        missing = []
+        for i, image_hash in enumerate(image_hashes):
+            cached = cache.get([image_hash], 'batch') if len(image_hashes) > 1 else None
+            if cached is None:
+                missing.append(i)
+                continue
+            cached_keywords.extend(cached['keywords'])
+            stats['hits'] += 1
+            stats['tokens_saved'] += cached['tokens']
+        stats['misses'] = len(missing)
         
-        keywords_text = response.text if hasattr(response, 'text') else ""
-        keywords = list(set([k.strip() for k in keywords_text.split(',') if k.strip()]))  # 去重
+        if stats['hits']:
+            print(f"[OCR Cache] 命中 {stats['hits']}/{len(image_hashes)} 張圖片，節省 Token: {stats['tokens_saved']}")
         
-        # 統計OCR的TOKEN使用
         ocr_tokens = 0
-        if hasattr(response, 'usage_metadata') and response.usage_metadata:
-            ocr_tokens = getattr(response.usage_metadata, 'total_token_count', 0)
-            print(f"[Smart Filter] 批次OCR Token使用: {ocr_tokens}")
+        keywords = []
+        if missing:
+            keywords, ocr_tokens = _request_batch_keywords([image_bytes_list[i] for i in missing], api_key)
+            if keywords:
+                cache.set([image_hashes[i] for i in missing], 'batch', keywords, ocr_tokens)
         
+        keywords = list(set(cached_keywords + keywords))
         print(f"[Smart Filter] 批次提取關鍵字: {keywords}")
         return keywords, ocr_tokens
         
     except Exception as e:
         print(f"[Smart Filter] 批次關鍵字提取失敗: {e}")
-        return [], 0
+        return list(set(cached_keywords)), 0
 
 def extract_drug_keywords(image_bytes: bytes, api_key: str) -> Tuple[List[str], int]:
-    """使用簡單OCR提取藥物關鍵字"""
+    """使用簡單OCR提取藥物關鍵字（以圖片內容雜湊快取結果）"""
     try:
         print("[Smart Filter] 提取藥物關鍵字...")
         
-        client = genai.Client(api_key=api_key)
+        cache = get_ocr_cache()
+        image_hashes = [image_sha256(image_bytes)]
+        cached = cache.get(image_hashes, 'single')
+        if cached is not None:
+            print(f"[OCR Cache] 命中，節省 Token: {cached['tokens']}")
+            return list(cached['keywords']), 0
         
-        # 簡單的OCR prompt - 加強對特定藥物的識別
+        # 簡單的OCR prompt - 加強對特定藥物的識別（修改內容時請更新 ocr_cache.OCR_PROMPT_VERSION）
         ocr_prompt = """請快速識別圖片中的藥物名稱關鍵字。
 只需要提取藥物的英文名稱和中文名稱關鍵字，不需要其他資訊。
 
@@ -134,8 +189,9 @@ def extract_drug_keywords(image_bytes: bytes, api_key: str) -> Tuple[List[str],
         contents = [types.Content(role="user", parts=prompt_parts)]
         config = types.GenerateContentConfig(temperature=0)
         
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
+        response = get_gemini_gateway().generate_content(
+            api_key, 'ocr_single',
+            model=OCR_MODEL,
             contents=contents,
             config=config
         )
@@ -149,6 +205,9 @@ def extract_drug_keywords(image_bytes: bytes, api_key: str) -> Tuple[List[str],
             ocr_tokens = getattr(response.usage_metadata, 'total_token_count', 0)
             print(f"[Smart Filter] OCR Token使用: {ocr_tokens}")
         
+        if keywords:
+            cache.set(image_hashes, 'single', keywords, ocr_tokens)
+        
         print(f"[Smart Filter] 提取關鍵字: {keywords}")
         return keywords, ocr_tokens
         
@@ -156,50 +215,6 @@ def extract_drug_keywords(image_bytes: bytes, api_key: str) -> Tuple[List[str],
         print(f"[Smart Filter] 關鍵字提取失敗: {e}")
         return [], 0
 
-def normalize_drug_name(name):
-    """標準化藥物名稱，移除特殊字符和空格"""
-    if not name:
-        return ""
-    
-    # 轉為小寫並移除各種特殊字符
-    normalized = (name.lower()
-                 .replace("_", "")
-                 .replace("-", "")
-                 .replace(" ", "")
-                 .replace("\"", "")
-                 .replace("'", "")
-                 .replace(".", "")
-                 .replace("(", "")
-                 .replace(")", "")
-                 .replace("[", "")
-                 .replace("]", "")
-                 .replace(",", ""))
-    
-    return normalized
-
-def extract_drug_components(name):
-    """提取藥物名稱的主要組成部分"""
-    if not name:
-        return []
-    
-    import re
-    
-    # 移除劑量信息 (如 0.125MG, 10mg 等)
-    name_clean = re.sub(r'\d+\.?\d*\s*mg|tablets?|capsules?', '', name, flags=re.IGNORECASE)
-    
-    # 分割成組件
-    components = []
-    
-    # 按常見分隔符分割
-    parts = re.split(r'[_\-\s"\'\.]+', name_clean)
-    
-    for part in parts:
-        part = part.strip()
-        if part and len(part) > 1:  # 忽略單字符
-            components.append(part.lower())
-    
-    return components
-
 def extract_numeric_value(text):
     """從文字中提取數值，支援多種格式"""
     if not text:
@@ -394,214 +409,221 @@ def get_frequency_code_from_times(times_per_day):
     times_map = {1: 'QD', 2: 'BID', 3: 'TID', 4: 'QID'}
     return times_map.get(times_per_day, 'TID')  # 預設為TID
 
-def smart_filter_drugs(all_drugs: List[Dict], keywords: List[str]) -> List[Dict]:
-    """改進的藥物篩選函數，支持更靈活的匹配"""
+class _KeywordForms:
+    """單一 OCR 關鍵字的各種預先計算形式，每次篩選只計算一次。"""
+
+    __slots__ = ('keyword', 'lower', 'normalized', 'components', 'words', 'clean', 'alpha', 'similarity_candidates')
+
+    def __init__(self, keyword: str, name_index: DrugNameIndex):
+        self.keyword = keyword
+        self.lower = keyword.lower()
+        self.normalized = normalize_drug_name(keyword)
+        self.components = extract_drug_components(keyword)
+        self.words = self.lower.replace('_', ' ').split()
+        self.clean = ''.join(c for c in self.lower if c.isalnum())
+        self.alpha = ''.join(c for c in self.lower if c.isalpha())
+        self.similarity_candidates = name_index.similarity_candidates(self.lower)
+
+
+def _score_drug(pos: int, entry, keyword_forms: List[_KeywordForms], alias_matches: AliasMatches) -> Tuple[float, str]:
+    """以所有關鍵字為單一藥品評分，回傳 (最高分數, 匹配說明)；沒有匹配時分數為 0。"""
     import difflib
     
-    # 過濾掉 None 值的關鍵字
-    keywords = [kw for kw in (keywords or []) if kw is not None and str(kw).strip()]
+    drug_zh_lower = entry.zh_lower
+    drug_en_lower = entry.en_lower
+    zh_slot, en_slot = pos * 2, pos * 2 + 1
     
-    if not keywords:
-        print("[Smart Filter] 沒有關鍵字，使用前20種藥物")
-        return all_drugs[:20]
+    max_score = 0
+    best_match_info = ""
     
-    filtered_drugs = []
-    match_scores = []  # 記錄匹配分數
-    
-    for drug in all_drugs:
-        drug_zh = drug.get('drug_name_zh', '') or ''
-        drug_en = drug.get('drug_name_en', '') or ''
-        
-        max_score = 0
-        best_match_info = ""
-        
-        # 檢查每個關鍵字
-        for keyword in keywords:
-            if keyword is None:
-                continue
-            keyword_lower = keyword.lower()
+    # 檢查每個關鍵字
+    for kf in keyword_forms:
+        keyword = kf.keyword
+        keyword_lower = kf.lower
+        
+        # 方法1: 直接包含匹配
+        if (keyword_lower in drug_zh_lower or 
+            keyword_lower in drug_en_lower):
+            score = 1.0
+            match_info = f"direct_match({keyword})"
+            if score > max_score:
+                max_score = score
+                best_match_info = match_info
+        
+        # 方法2: 標準化後匹配
+        normalized_keyword = kf.normalized
+        
+        if (normalized_keyword in entry.zh_norm or 
+            normalized_keyword in entry.en_norm):
+            score = 0.9
+            match_info = f"normalized_match({keyword})"
+            if score > max_score:
+                max_score = score
+                best_match_info = match_info
+        
+        # 方法3: 組件匹配 (如 spalytic_hs -> spalytic + hs)
+        keyword_components = kf.components
+        
+        if keyword_components:
+            # 檢查所有關鍵字組件是否都能在藥物名稱中找到
+            zh_matches = sum(1 for kc in keyword_components 
+                           if any(kc in dc for dc in entry.zh_components))
+            en_matches = sum(1 for kc in keyword_components 
+                           if any(kc in dc for dc in entry.en_components))
             
-            # 方法1: 直接包含匹配
-            if (keyword_lower in drug_zh.lower() or 
-                keyword_lower in drug_en.lower()):
-                score = 1.0
-                match_info = f"direct_match({keyword})"
-                if score > max_score:
-                    max_score = score
-                    best_match_info = match_info
+            component_score_zh = zh_matches / len(keyword_components)
+            component_score_en = en_matches / len(keyword_components)
+            component_score = max(component_score_zh, component_score_en)
             
-            # 方法2: 標準化後匹配
-            normalized_keyword = normalize_drug_name(keyword)
-            normalized_zh = normalize_drug_name(drug_zh)
-            normalized_en = normalize_drug_name(drug_en)
-            
-            if (normalized_keyword in normalized_zh or 
-                normalized_keyword in normalized_en):
-                score = 0.9
-                match_info = f"normalized_match({keyword})"
+            if component_score >= 0.5:  # 降低到50%的組件匹配
+                score = 0.8 * component_score
+                match_info = f"component_match({keyword}:{component_score:.2f})"
                 if score > max_score:
                     max_score = score
                     best_match_info = match_info
-            
-            # 方法3: 組件匹配 (如 spalytic_hs -> spalytic + hs)
-            keyword_components = extract_drug_components(keyword)
-            drug_zh_components = extract_drug_components(drug_zh)
-            drug_en_components = extract_drug_components(drug_en)
-            
-            if keyword_components:
-                # 檢查所有關鍵字組件是否都能在藥物名稱中找到
-                zh_matches = sum(1 for kc in keyword_components 
-                               if any(kc in dc for dc in drug_zh_components))
-                en_matches = sum(1 for kc in keyword_components 
-                               if any(kc in dc for dc in drug_en_components))
-                
-                component_score_zh = zh_matches / len(keyword_components)
-                component_score_en = en_matches / len(keyword_components)
-                component_score = max(component_score_zh, component_score_en)
-                
-                if component_score >= 0.5:  # 降低到50%的組件匹配
-                    score = 0.8 * component_score
-                    match_info = f"component_match({keyword}:{component_score:.2f})"
-                    if score > max_score:
-                        max_score = score
-                        best_match_info = match_info
-            
-            # 方法3.5: 強化的spalytic_hs特殊處理
-            if 'spalytic' in keyword_lower and 'hs' in keyword_lower:
-                if ('spalytic' in drug_en.lower() and 'hs' in drug_en.lower()) or \
-                   ('spalytic' in drug_zh.lower() and 'hs' in drug_zh.lower()):
-                    score = 0.95  # 給予很高的分數
-                    match_info = f"spalytic_hs_special_match({keyword})"
-                    if score > max_score:
-                        max_score = score
-                        best_match_info = match_info
-            
-            # 方法3.6: 摩舒益多特殊處理 - 多種變體匹配
-            mosapride_variants = ['摩舒益多', 'mosapride', '摩舒', '益多', 'mosa', 'pride']
-            drug_combined = (drug_zh + ' ' + drug_en).lower()
-            
-            if any(variant in keyword_lower for variant in mosapride_variants):
-                # 檢查藥物名稱是否包含摩舒益多的任何形式
-                if any(variant in drug_combined for variant in ['摩舒益多', 'mosapride', '摩舒', 'mosa']):
-                    score = 0.95
-                    match_info = f"mosapride_special_match({keyword})"
-                    if score > max_score:
-                        max_score = score
-                        best_match_info = match_info
-            
-            # 方法3.7: 瓦斯康錠/Gascon特殊處理 - OCR誤識修正
-            gascon_variants = ['卡斯康', '瓦斯康', '加斯康', 'cascon', 'gascon', 'kascon']
-            
-            # 檢查關鍵字是否包含瓦斯康的變體
-            if any(variant in keyword_lower for variant in gascon_variants):
-                # 檢查藥物名稱是否包含瓦斯康或gascon
-                if ('瓦斯康' in drug_zh.lower() or 'gascon' in drug_en.lower() or 
-                    'cascon' in drug_en.lower() or 'kascon' in drug_en.lower()):
-                    score = 0.95
-                    match_info = f"gascon_special_match({keyword})"
-                    if score > max_score:
-                        max_score = score
-                        best_match_info = match_info
-            
-            # 特殊處理：如果關鍵字包含「斯康」相關且有劑量資訊
-            elif (('斯康' in keyword_lower or 'scon' in keyword_lower) and 
-                  any(dose in keyword_lower for dose in ['40', '毫克', 'mg'])):
-                if ('瓦斯康' in drug_zh.lower() or 'gascon' in drug_en.lower() or 
-                    'cascon' in drug_en.lower()):
-                    score = 0.9
-                    match_info = f"gascon_partial_match({keyword})"
-                    if score > max_score:
-                        max_score = score
-                        best_match_info = match_info
-            
-            # 進一步特殊處理：40mg相關的gascon變體
-            elif ('40' in keyword_lower and any(variant in keyword_lower for variant in ['cas', 'gas', 'kas'])):
-                if ('gascon' in drug_en.lower() or 'cascon' in drug_en.lower() or '瓦斯康' in drug_zh.lower()):
-                    score = 0.85
-                    match_info = f"gascon_40mg_match({keyword})"
-                    if score > max_score:
-                        max_score = score
-                        best_match_info = match_info
-            
-            # 方法4: 相似度匹配 (使用較低的閾值)
-            similarity_zh = difflib.SequenceMatcher(None, keyword_lower, drug_zh.lower()).ratio()
-            similarity_en = difflib.SequenceMatcher(None, keyword_lower, drug_en.lower()).ratio()
+        
+        # 方法4: 相似度匹配 (使用較低的閾值)
+        # 只對字元倒排索引找出的候選計算 ratio；分數上限為 0.6，已達 0.6 時不可能再提高
+        if max_score < 0.6 and (zh_slot in kf.similarity_candidates or en_slot in kf.similarity_candidates):
+            similarity_zh = (difflib.SequenceMatcher(None, keyword_lower, drug_zh_lower).ratio()
+                             if zh_slot in kf.similarity_candidates else 0.0)
+            similarity_en = (difflib.SequenceMatcher(None, keyword_lower, drug_en_lower).ratio()
+                             if en_slot in kf.similarity_candidates else 0.0)
             similarity = max(similarity_zh, similarity_en)
             
-            if similarity >= 0.6:  # 降低相似度閾值
+            if similarity >= SIMILARITY_THRESHOLD:  # 降低相似度閾值
                 score = 0.6 * similarity
                 match_info = f"similarity_match({keyword}:{similarity:.2f})"
                 if score > max_score:
                     max_score = score
                     best_match_info = match_info
-            
-            # 方法5: 部分詞匹配
-            keyword_words = keyword_lower.replace('_', ' ').split()
-            matched_words = 0
-            for word in keyword_words:
-                if len(word) > 1:  # 降低最小長度要求
-                    if (word in drug_zh.lower() or word in drug_en.lower()):
-                        matched_words += 1
-            
-            if matched_words > 0:
-                word_match_ratio = matched_words / len(keyword_words)
-                if word_match_ratio >= 0.5:  # 至少50%的詞匹配
-                    score = 0.4 + (0.3 * word_match_ratio)  # 0.4-0.7分數範圍
-                    match_info = f"partial_word_match({matched_words}/{len(keyword_words)})"
-                    if score > max_score:
-                        max_score = score
-                        best_match_info = match_info
-            
-            # 方法6: 超級寬鬆匹配 - 確保不遺漏任何可能的匹配
-            # 移除所有非字母數字字符後進行匹配
-            keyword_clean = ''.join(c for c in keyword_lower if c.isalnum())
-            drug_en_clean = ''.join(c for c in drug_en.lower() if c.isalnum())
-            drug_zh_clean = ''.join(c for c in drug_zh.lower() if c.isalnum())
-            
-            if len(keyword_clean) > 3:  # 避免太短的匹配
-                if (keyword_clean in drug_en_clean or keyword_clean in drug_zh_clean):
-                    score = 0.3
-                    match_info = f"ultra_loose_match({keyword})"
-                    if score > max_score:
-                        max_score = score
-                        best_match_info = match_info
-        
-        # 終極保障：硬編碼關鍵匹配規則，確保100%匹配成功
-        for keyword in keywords:
-            if keyword is None:
-                continue
-            keyword_lower = keyword.lower()
-            drug_en_lower = drug_en.lower()
-            drug_zh_lower = drug_zh.lower()
-            
-            # 特殊規則：spalytic_hs 系列
-            if 'spalytic' in keyword_lower and 'hs' in keyword_lower:
-                if 'spalytic' in drug_en_lower and 'hs' in drug_en_lower:
-                    max_score = 1.0
-                    best_match_info = f"guaranteed_spalytic_hs_match({keyword})"
-                    break
-            
-            # 特殊規則：摩舒益多系列 - 終極保障
-            mosapride_check = ['摩舒益多', 'mosapride', '摩舒', 'mosa']
-            if any(variant in keyword_lower for variant in mosapride_check):
-                if any(variant in drug_en_lower or variant in drug_zh_lower for variant in mosapride_check):
-                    max_score = 1.0
-                    best_match_info = f"guaranteed_mosapride_match({keyword})"
-                    break
-            
-            # 特殊規則：移除所有符號後的完全匹配
-            keyword_alpha = ''.join(c for c in keyword_lower if c.isalpha())
-            drug_en_alpha = ''.join(c for c in drug_en_lower if c.isalpha())
-            drug_zh_alpha = ''.join(c for c in drug_zh_lower if c.isalpha())
-            
-            if len(keyword_alpha) > 4 and (keyword_alpha in drug_en_alpha or keyword_alpha in drug_zh_alpha):
-                if max_score < 0.8:
-                    max_score = 0.8
-                    best_match_info = f"guaranteed_alpha_match({keyword})"
         
-        # 如果有匹配，加入結果
+        # 方法5: 部分詞匹配
+        keyword_words = kf.words
+        matched_words = 0
+        for word in keyword_words:
+            if len(word) > 1:  # 降低最小長度要求
+                if (word in drug_zh_lower or word in drug_en_lower):
+                    matched_words += 1
+        
+        if matched_words > 0:
+            word_match_ratio = matched_words / len(keyword_words)
+            if word_match_ratio >= 0.5:  # 至少50%的詞匹配
+                score = 0.4 + (0.3 * word_match_ratio)  # 0.4-0.7分數範圍
+                match_info = f"partial_word_match({matched_words}/{len(keyword_words)})"
+                if score > max_score:
+                    max_score = score
+                    best_match_info = match_info
+        
+        # 方法6: 超級寬鬆匹配 - 確保不遺漏任何可能的匹配
+        # 移除所有非字母數字字符後進行匹配
+        keyword_clean = kf.clean
+        
+        if len(keyword_clean) > 3:  # 避免太短的匹配
+            if (keyword_clean in entry.en_alnum or keyword_clean in entry.zh_alnum):
+                score = 0.3
+                match_info = f"ultra_loose_match({keyword})"
+                if score > max_score:
+                    max_score = score
+                    best_match_info = match_info
+    
+    # 別名表（OCR 誤讀、特殊藥品）的規則分數，規則內容見 app/data/drug_aliases.json
+    special = alias_matches.scores.get(pos)
+    if special and special[0] > max_score:
+        max_score, best_match_info = special
+    
+    # 終極保障：移除所有符號後的完全匹配
+    for kf in keyword_forms:
+        keyword_alpha = kf.alpha
+        
+        if len(keyword_alpha) > 4 and (keyword_alpha in entry.en_alpha or keyword_alpha in entry.zh_alpha):
+            if max_score < 0.8:
+                max_score = 0.8
+                best_match_info = f"guaranteed_alpha_match({kf.keyword})"
+    
+    # 終極保障：別名表中標記 guaranteed 的規則，確保100%匹配成功
+    guaranteed = alias_matches.guaranteed.get(pos)
+    if guaranteed:
+        max_score = 1.0
+        best_match_info = guaranteed
+    
+    return max_score, best_match_info
+
+
+def _vector_match_scores(name_index: DrugNameIndex, keyword_forms: List[_KeywordForms], alias_matches: AliasMatches,
+                         top_k: int) -> List[Tuple[Dict, float, str]]:
+    """
+    numpy 評分後端：一次矩陣運算算出所有關鍵字 × 藥品的向量相似度，每個關鍵字取前 top_k 名，
+    候選藥品（另加上別名表命中的藥品）再以與 python 後端相同的規則評分；
+    規則都沒有命中時以向量相似度計分。
+    """
+    scorer = drug_vector_scorer.get_vector_scorer(name_index)
+    vector_start = time.time()
+    top_matches = scorer.top_k([kf.lower for kf in keyword_forms], top_k)
+    
+    best_vector = {}  # 藥品位置 -> (相似度, 關鍵字)
+    for kf, matches in zip(keyword_forms, top_matches):
+        for pos, similarity in matches:
+            if pos not in best_vector or similarity > best_vector[pos][0]:
+                best_vector[pos] = (similarity, kf.keyword)
+    print(f"[Smart Filter] 向量評分: {len(best_vector)} 個候選，耗時: {time.time() - vector_start:.4f}s")
+    
+    match_scores = []
+    # 依目錄順序處理，與 python 後端同分時的排序一致
+    for pos in sorted(set(best_vector) | alias_matches.positions()):
+        entry = name_index.entries[pos]
+        max_score, best_match_info = _score_drug(pos, entry, keyword_forms, alias_matches)
+        similarity, keyword = best_vector.get(pos, (0.0, ''))
+        if 0.6 * similarity > max_score:
+            max_score = 0.6 * similarity
+            best_match_info = f"vector_match({keyword}:{similarity:.2f})"
         if max_score > 0:
-            match_scores.append((drug, max_score, best_match_info))
+            match_scores.append((entry.drug, max_score, best_match_info))
+    return match_scores
+
+
+def smart_filter_drugs(all_drugs: List[Dict], keywords: List[str], name_index: DrugNameIndex = None,
+                       backend: str = None, top_k: int = None, pad_common: bool = True) -> List[Dict]:
+    """
+    改進的藥物篩選函數，支持更靈活的匹配
+
+    backend: 'python'（逐一評分全部藥品）或 'numpy'（向量批次評分後只評估前 top_k 名），
+    未指定時使用 Config.SMART_FILTER_BACKEND。
+    pad_common=False 時只回傳關鍵字實際匹配到的藥物，不補充常用藥物（推測分析比對用）。
+    """
+    # 過濾掉 None 值的關鍵字
+    keywords = [kw for kw in (keywords or []) if kw is not None and str(kw).strip()]
+    
+    if not keywords:
+        if not pad_common:
+            return []
+        print("[Smart Filter] 沒有關鍵字，使用前20種藥物")
+        return all_drugs[:20]
+    
+    # 藥品名稱的各種形式每個目錄版本只計算一次；關鍵字的形式每次篩選只計算一次
+    if name_index is None:
+        name_index = get_drug_name_index(all_drugs)
+    keyword_forms = [_KeywordForms(keyword, name_index) for keyword in keywords]
+    alias_matches = get_alias_table().match(name_index, keywords)
+    
+    filtered_drugs = []
+    match_scores = []  # 記錄匹配分數
+    
+    if backend is None:
+        backend = Config.SMART_FILTER_BACKEND
+    if backend == 'numpy' and not drug_vector_scorer.is_available():
+        print("[Smart Filter] numpy 未安裝，改用 python 評分")
+        backend = 'python'
+    
+    if backend == 'numpy':
+        match_scores = _vector_match_scores(name_index, keyword_forms, alias_matches, top_k or Config.SMART_FILTER_TOP_K)
+    else:
+        for pos, entry in enumerate(name_index.entries):
+            max_score, best_match_info = _score_drug(pos, entry, keyword_forms, alias_matches)
+            
+            # 如果有匹配，加入結果
+            if max_score > 0:
+                match_scores.append((entry.drug, max_score, best_match_info))
     
     # 按匹配分數排序
     match_scores.sort(key=lambda x: x[1], reverse=True)
@@ -611,52 +633,47 @@ def smart_filter_drugs(all_drugs: List[Dict], keywords: List[str]) -> List[Dict]
         filtered_drugs.append(drug)
         print(f"[Smart Filter] 匹配: {drug.get('drug_name_en', '')} | {drug.get('drug_name_zh', '')} | {match_info} | 分數: {score:.3f}")
     
-    # 終極檢查：確保關鍵藥物不被遺漏
-    critical_keywords = ['spalytic', 'spalytic_hs', 'spalyticus', '摩舒益多', 'mosapride', '摩舒', '益多', 
-                        '卡斯康', '瓦斯康', '加斯康', 'cascon', 'gascon', 'kascon']
-    for critical_keyword in critical_keywords:
-        if any(critical_keyword.lower() in (kw or '').lower() for kw in keywords if kw is not None):
-            # 強制搜索包含關鍵詞的所有藥物
-            search_terms = []
-            if critical_keyword.lower() in ['spalytic', 'spalytic_hs', 'spalyticus']:
-                search_terms = ['spalytic']
-            elif critical_keyword.lower() in ['摩舒益多', 'mosapride', '摩舒', '益多']:
-                search_terms = ['摩舒益多', 'mosapride', '摩舒']
-            elif critical_keyword.lower() in ['卡斯康', '瓦斯康', '加斯康', 'cascon', 'gascon', 'kascon']:
-                search_terms = ['瓦斯康', 'gascon', 'cascon']
-            
-            for search_term in search_terms:
-                for drug in all_drugs:
-                    drug_en = (drug.get('drug_name_en') or '').lower()
-                    drug_zh = (drug.get('drug_name_zh') or '').lower()
-                    if search_term.lower() in drug_en or search_term in drug_zh:
-                        if drug not in filtered_drugs:
-                            filtered_drugs.append(drug)
-                            print(f"[Smart Filter] 強制加入關鍵藥物: {drug.get('drug_name_en', '')} | {drug.get('drug_name_zh', '')}")
-    
-    # 如果篩選結果太少，補充一些常用藥物
-    if len(filtered_drugs) < 5:
-        print(f"[Smart Filter] 篩選結果太少({len(filtered_drugs)})，補充常用藥物")
-        common_drugs = all_drugs[:15]
-        for drug in common_drugs:
-            if drug not in filtered_drugs:
-                filtered_drugs.append(drug)
-                if len(filtered_drugs) >= 15:
-                    break
+    # 終極檢查：確保關鍵藥物不被遺漏（別名表中標記 force_include 的規則）
+    included = {id(drug) for drug in filtered_drugs}
+    for pos in alias_matches.force_include:
+        drug = name_index.entries[pos].drug
+        if id(drug) not in included:
+            included.add(id(drug))
+            filtered_drugs.append(drug)
+            print(f"[Smart Filter] 強制加入關鍵藥物: {drug.get('drug_name_en', '')} | {drug.get('drug_name_zh', '')}")
+    
+    if pad_common:
+        filtered_drugs = pad_with_common_drugs(all_drugs, filtered_drugs)
     
     print(f"[Smart Filter] 篩選結果: {len(filtered_drugs)} 種藥物")
     return filtered_drugs
 
-async def parallel_db_and_ocr(image_bytes_list: List[bytes], db_config: dict, api_key: str) -> Tuple[List[Dict], Tuple[List[str], int], float]:
-    """並行執行資料庫查詢和OCR處理"""
+def pad_with_common_drugs(all_drugs: List[Dict], filtered_drugs: List[Dict]) -> List[Dict]:
+    """如果篩選結果太少，補充一些常用藥物"""
+    if len(filtered_drugs) >= 5:
+        return filtered_drugs
+    print(f"[Smart Filter] 篩選結果太少({len(filtered_drugs)})，補充常用藥物")
+    filtered_drugs = list(filtered_drugs)
+    common_drugs = all_drugs[:15]
+    for drug in common_drugs:
+        if drug not in filtered_drugs:
+            filtered_drugs.append(drug)
+            if len(filtered_drugs) >= 15:
+                break
+    return filtered_drugs
+
+async def parallel_db_and_ocr(image_bytes_list: List[bytes], db_config: dict, api_key: str,
+                              ocr_cache_stats: dict = None) -> Tuple[List[Dict], Tuple[List[str], int], float]:
+    """並行執行資料庫查詢和OCR處理（須在共用事件迴圈內執行）"""
+    runtime = get_async_runtime()
     
     async def db_task():
         """資料庫查詢任務"""
-        return await asyncio.to_thread(get_all_drugs_from_db, db_config)
+        return await runtime.run_blocking(get_all_drugs_from_db, db_config)
     
     async def ocr_task():
         """OCR處理任務"""
-        return await asyncio.to_thread(extract_drug_keywords_batch, image_bytes_list, api_key)
+        return await runtime.run_blocking(extract_drug_keywords_batch, image_bytes_list, api_key, ocr_cache_stats)
     
     # 並行執行兩個任務
     parallel_start = time.time()
@@ -687,69 +704,33 @@ async def parallel_db_and_ocr(image_bytes_list: List[bytes], db_config: dict, ap
         print(f"[Parallel] 並行處理異常: {e}")
         # 回退到序列處理
         print("[Parallel] 回退到序列處理...")
-        db_result = get_all_drugs_from_db(db_config)
-        ocr_result = extract_drug_keywords_batch(image_bytes_list, api_key)
+        db_result = await runtime.run_blocking(get_all_drugs_from_db, db_config)
+        ocr_result = await runtime.run_blocking(extract_drug_keywords_batch, image_bytes_list, api_key, ocr_cache_stats)
         parallel_time = time.time() - parallel_start
         return db_result, ocr_result, parallel_time
 
-def run_analysis(image_bytes_list: List[bytes], db_config: dict, api_key: str) -> Tuple[Dict | None, Dict | None]:
+def build_analysis_prompt(filtered_drugs: List[Dict], image_count: int) -> Tuple[str, dict]:
     """
-    智能篩選版頻率導向分析 - 支援並行處理優化
+    構建完整的頻率導向分析 Prompt（候選藥物 + 頻率參考清單），回傳 (prompt, 編碼統計)。
+    候選藥物以精簡表格列出，並依 Config.ANALYSIS_PROMPT_TOKEN_BUDGET 從分數最低的一端截斷。
     """
-    start_time = time.time()
-    print("[Smart Filter] 開始智能篩選頻率導向分析 (並行版本)...")
+    freq_codes = get_frequency_database()
+    drug_ref_str, prompt_stats = encode_drug_table(filtered_drugs, Config.ANALYSIS_PROMPT_TOKEN_BUDGET)
+    freq_ref_str = encode_frequency_table(freq_codes)
+    if prompt_stats['truncated']:
+        print(f"[Smart Filter] 候選藥物超過 token 預算，保留 {prompt_stats['included']}/{prompt_stats['candidates']} 種")
     
-    if not image_bytes_list:
-        print("[Smart Filter] 錯誤：沒有提供任何圖片資料。")
-        return None, None
-
-    try:
-        # 第1&2步：並行執行資料庫查詢和OCR處理
-        try:
-            # 嘗試使用並行處理
-            all_drugs, (keywords, total_ocr_tokens), parallel_time = asyncio.run(
-                parallel_db_and_ocr(image_bytes_list, db_config, api_key)
-            )
-            processing_mode = "parallel"
-        except Exception as e:
-            print(f"[Smart Filter] 並行處理失敗，回退到序列處理: {e}")
-            # 回退到原始序列處理
-            all_drugs = get_all_drugs_from_db(db_config)
-            if not all_drugs:
-                return None, {"error": "資料庫連線失敗"}
-            
-            ocr_start = time.time()
-            keywords, total_ocr_tokens = extract_drug_keywords_batch(image_bytes_list, api_key)
-            parallel_time = time.time() - ocr_start
-            processing_mode = "sequential_fallback"
-        
-        if not all_drugs:
-            return None, {"error": "資料庫連線失敗"}
-        
-        print(f"[Smart Filter] 處理模式: {processing_mode}, 耗時: {parallel_time:.4f}s")
-        print(f"[Smart Filter] 從 {len(image_bytes_list)} 張圖片提取到 {len(keywords)} 個唯一關鍵字")
-        
-        # 第3步：智能篩選
-        filtered_drugs = smart_filter_drugs(all_drugs, keywords)
-        
-        # 第4步：獲取頻率參考
-        freq_codes = get_frequency_database()
-        
-        # 第5步：構建完整的頻率導向分析 Prompt
-        drug_ref_str = json.dumps(filtered_drugs, ensure_ascii=False, indent=2, default=str)
-        freq_ref_str = json.dumps(freq_codes, ensure_ascii=False, indent=2, default=str)
-        
-        complete_prompt = f"""
+    prompt = f"""
 # 任務與角色
-你是一位頂尖的醫療資訊分析師。你的任務是分析我提供的{len(image_bytes_list)}張藥單圖片，並結合參考資料，將結果結構化為一個單一的 JSON 物件。
+你是一位頂尖的醫療資訊分析師。你的任務是分析我提供的{image_count}張藥單圖片，並結合參考資料，將結果結構化為一個單一的 JSON 物件。
 
-**重要提醒：我提供了{len(image_bytes_list)}張圖片，請分析所有圖片中的藥物資訊，並將所有藥物合併到同一個medications列表中。**
+**重要提醒：我提供了{image_count}張圖片，請分析所有圖片中的藥物資訊，並將所有藥物合併到同一個medications列表中。**
 
 # 參考資料
-1. **藥品資料庫參考清單 (請從中選擇)**:
+1. **藥品資料庫參考清單 (請從中選擇；每行以 | 分隔，第一行為欄位名稱)**:
 {drug_ref_str}
 
-2. **用藥頻率參考清單 (這是你唯一的頻率判斷依據)**:
+2. **用藥頻率參考清單 (這是你唯一的頻率判斷依據；每行以 | 分隔，第一行為欄位名稱)**:
 {freq_ref_str}
 
 # 輸出要求 (嚴格遵守)
@@ -767,13 +748,11 @@ def run_analysis(image_bytes_list: List[bytes], db_config: dict, api_key: str) -
   * 如果找到多個天數，選擇最合理的總給藥天數（通常是較大的數字）
 
 ## `medications` 列表中的物件欄位
-**請將所有{len(image_bytes_list)}張圖片中的藥物都加入到medications列表中，不要遺漏任何一種藥物。**
+**請將所有{image_count}張圖片中的藥物都加入到medications列表中，不要遺漏任何一種藥物。**
 
 - `matched_drug_id`: (字串或null) 從「藥品資料庫」中選出的最匹配藥物的 `drug_id`。如果找不到合理的匹配，此欄位必須為 `null`。
 - `drug_name_zh`: (字串) 匹配到的藥物中文名，若無匹配則從圖片中提取。
 - `drug_name_en`: (字串) 匹配到的藥物英文名，若無匹配則從圖片中提取。
-- `main_use`: (字串) 匹配到的藥物主要用途。
-- `side_effects`: (字串) 匹配到的藥物常見副作用。
 - `dose_quantity`: (字串) 從圖片中解析出的「單次劑量」，包含數值和單位 (例如: '1 顆', '0.5 錠')。
 - `source_image`: (整數) 該藥物來自第幾張圖片 (1, 2, 3...)。
 
@@ -808,63 +787,350 @@ def run_analysis(image_bytes_list: List[bytes], db_config: dict, api_key: str) -
 
 請確保你的輸出是一個格式完全正確的 JSON 物件，並用 ```json ... ``` 包圍。
 """
+    prompt_stats['estimated_prompt_tokens'] = estimate_tokens(prompt)
+    return prompt, prompt_stats
 
-        # API設定
-        client = genai.Client(api_key=api_key)
-        model_name = "gemini-2.5-flash"
-        
-        config = types.GenerateContentConfig(
-            temperature=0,
-            thinking_config=types.ThinkingConfig(thinking_budget=0),
-            response_mime_type="application/json"
+def _stream_analysis(api_key: str, contents, config, on_medication=None, stream_stats: dict = None):
+    """
+    以串流方式取得分析回應：每當 medications 中有一筆藥物完整出現就呼叫 on_medication(medication)，
+    串流結束後回傳組合好的完整回應（具有 text 與 usage_metadata，與非串流回應用法相同）。
+    """
+    stats = stream_stats if stream_stats is not None else {}
+    stats.update({'streamed': True, 'chunks': 0, 'medications_streamed': 0, 'first_medication_at': None})
+    parser = JsonArrayStreamParser('medications')
+    text_parts = []
+    usage = None
+    
+    for chunk in get_gemini_gateway().generate_content_stream(
+        api_key, 'analysis',
+        model=ANALYSIS_MODEL,
+        contents=contents,
+        config=config
+    ):
+        stats['chunks'] += 1
+        usage = getattr(chunk, 'usage_metadata', None) or usage
+        text = getattr(chunk, 'text', None) or ""
+        text_parts.append(text)
+        for medication in parser.feed(text):
+            if stats['first_medication_at'] is None:
+                stats['first_medication_at'] = time.time()
+            stats['medications_streamed'] += 1
+            if on_medication:
+                try:
+                    on_medication(medication)
+                except Exception as e:
+                    print(f"[Smart Filter] 串流藥物回呼失敗: {e}")
+    
+    return SimpleNamespace(text="".join(text_parts), usage_metadata=usage)
+
+async def request_analysis(image_bytes_list: List[bytes], api_key: str, filtered_drugs: List[Dict],
+                           on_medication=None, stream_stats: dict = None) -> Tuple[Any, float, dict]:
+    """
+    以候選藥物清單發送頻率導向分析請求（須在共用事件迴圈內執行），回傳 (response, 耗時, prompt 編碼統計)。
+    Config.ANALYSIS_STREAMING_ENABLED 時改用串流 API，並在解析出每筆藥物時呼叫 on_medication（於執行緒池中呼叫）。
+    """
+    runtime = get_async_runtime()
+    complete_prompt, prompt_stats = build_analysis_prompt(filtered_drugs, len(image_bytes_list))
+    
+    config = types.GenerateContentConfig(
+        temperature=0,
+        thinking_config=types.ThinkingConfig(thinking_budget=0),
+        response_mime_type="application/json"
+    )
+    
+    # 構建請求（包含所有圖片）
+    prompt_parts = [types.Part.from_text(text=complete_prompt)]
+    
+    for i, image_bytes in enumerate(image_bytes_list):
+        prompt_parts.append(types.Part(
+            inline_data=types.Blob(
+                mime_type='image/jpeg',
+                data=base64.b64encode(image_bytes).decode()
+            )
+        ))
+    
+    contents = [types.Content(role="user", parts=prompt_parts)]
+    
+    # 執行分析（經由共用閘道呼叫）
+    print("[Smart Filter] 發送分析請求...")
+    analysis_start = time.time()
+    
+    if Config.ANALYSIS_STREAMING_ENABLED:
+        response = await runtime.run_blocking(_stream_analysis, api_key, contents, config, on_medication, stream_stats)
+    else:
+        response = await runtime.run_blocking(
+            get_gemini_gateway().generate_content,
+            api_key, 'analysis',
+            model=ANALYSIS_MODEL,
+            contents=contents,
+            config=config
         )
+    
+    return response, time.time() - analysis_start, prompt_stats
+
+def parse_analysis_response(response) -> Dict | None:
+    """解析分析回應中的 JSON 物件，沒有內容或格式錯誤時回傳 None"""
+    response_text = response.text if hasattr(response, 'text') else ""
+    if not response_text:
+        print("[Smart Filter] 模型沒有回傳任何文字內容。")
+        return None
+
+    try:
+        if response_text.startswith('```json'):
+            json_start = response_text.find('{')
+            json_end = response_text.rfind('}') + 1
+            clean_json = response_text[json_start:json_end]
+            return json.loads(clean_json)
+        return json.loads(response_text)
+    except json.JSONDecodeError as e:
+        print(f"[Smart Filter] JSON解析失敗: {e}")
+        return None
+
+def _usage_tokens(response) -> Tuple[int, int, int]:
+    """回傳 (prompt, completion, total) token 數"""
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage:
+        return 0, 0, 0
+    return (getattr(usage, 'prompt_token_count', 0) or 0,
+            getattr(usage, 'candidates_token_count', 0) or 0,
+            getattr(usage, 'total_token_count', 0) or 0)
+
+async def analyze_image_groups(image_bytes_list: List[bytes], api_key: str, filtered_drugs: List[Dict],
+                               on_medication=None) -> Tuple[Dict | None, dict]:
+    """
+    多張圖片分組並行分析：每組（Config.ANALYSIS_SPLIT_GROUP_SIZE 張）各自發送一次分析請求，
+    同時進行的組數受 Config.ANALYSIS_SPLIT_CONCURRENCY 限制；單組失敗不影響其他組。
+    全部完成後依 matched_drug_id 去重合併，並協調診所、醫師、日期、天數等全域欄位。
+
+    回傳 (合併後的分析結果或 None, 統計)；統計包含 token 數、各組耗時與狀態。
+    """
+    runtime = get_async_runtime()
+    groups = plan_image_groups(len(image_bytes_list), Config.ANALYSIS_SPLIT_GROUP_SIZE)
+    semaphore = asyncio.Semaphore(max(1, Config.ANALYSIS_SPLIT_CONCURRENCY))
+    callback_lock = asyncio.Lock()
+    stats = {
+        'groups': [], 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0,
+        'prompt_stats': None, 'first_medication_at': None,
+    }
+    print(f"[Smart Filter] 分組並行分析: {len(image_bytes_list)} 張圖片分成 {len(groups)} 組")
+
+    async def analyze_group(group_no, image_indexes):
+        group_info = {'group': group_no, 'images': [i + 1 for i in image_indexes], 'status': 'failed', 'analysis_time': 0.0}
+        stats['groups'].append(group_info)
+        async with semaphore:
+            try:
+                response, analysis_time, prompt_stats = await request_analysis(
+                    [image_bytes_list[i] for i in image_indexes], api_key, filtered_drugs
+                )
+            except Exception as e:
+                print(f"[Smart Filter] 第 {group_no} 組分析失敗: {e}")
+                return None
+        group_info['analysis_time'] = analysis_time
+        stats['prompt_stats'] = stats['prompt_stats'] or prompt_stats
+        prompt_tokens, completion_tokens, total_tokens = _usage_tokens(response)
+        stats['prompt_tokens'] += prompt_tokens
+        stats['completion_tokens'] += completion_tokens
+        stats['total_tokens'] += total_tokens
+
+        result = parse_analysis_response(response)
+        if result is None:
+            return None
+        group_info['status'] = 'ok'
+        group_info['medications'] = len(result.get('medications') or [])
+
+        if group_info['medications'] and stats['first_medication_at'] is None:
+            stats['first_medication_at'] = time.time()
+        if on_medication and result.get('medications'):
+            # 各組完成順序不定，依序呼叫回呼以免呼叫端需要自行加鎖
+            async with callback_lock:
+                for med in result['medications']:
+                    if not isinstance(med, dict):
+                        continue
+                    # 與合併時相同：把組內的圖片編號換回整份藥單的編號
+                    streamed = dict(med)
+                    remap_source_image(streamed, image_indexes)
+                    try:
+                        await runtime.run_blocking(on_medication, streamed)
+                    except Exception as e:
+                        print(f"[Smart Filter] 分組藥物回呼失敗: {e}")
+        return result
+
+    results = await asyncio.gather(*(analyze_group(no, indexes) for no, indexes in enumerate(groups, 1)))
+    stats['groups'].sort(key=lambda g: g['group'])
+
+    succeeded = [(indexes, result) for indexes, result in zip(groups, results) if result is not None]
+    if not succeeded:
+        return None, stats
+    merged, stats['merged_duplicates'] = merge_group_results(succeeded)
+    print(f"[Smart Filter] 分組分析完成: {len(succeeded)}/{len(groups)} 組成功，"
+          f"合併 {len(merged['medications'])} 種藥物（去除重複 {stats['merged_duplicates']}）")
+    return merged, stats
+
+def _discard_task(task):
+    """放棄不再需要的推測分析（已送出的 Gemini 請求仍會在背景完成）"""
+    if task is not None and not task.done():
+        task.cancel()
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+def run_analysis(image_bytes_list: List[bytes], db_config: dict, api_key: str,
+                 speculative_drugs: List[Dict] = None, on_medication=None) -> Tuple[Dict | None, Dict | None]:
+    """
+    智能篩選版頻率導向分析（同步介面）：把分析協程交給行程內共用的事件迴圈執行並等待結果。
+    """
+    return get_async_runtime().run(
+        run_analysis_async(image_bytes_list, db_config, api_key, speculative_drugs, on_medication)
+    )
+
+async def run_analysis_async(image_bytes_list: List[bytes], db_config: dict, api_key: str,
+                             speculative_drugs: List[Dict] = None, on_medication=None) -> Tuple[Dict | None, Dict | None]:
+    """
+    智能篩選版頻率導向分析 - 支援並行處理優化
+    各階段的阻塞工作都交給共用執行緒池，多個分析請求可以在同一個事件迴圈上互相重疊。
+
+    speculative_drugs（選用）：推測的候選藥物清單（例如該成員近期用藥）。提供時會在關鍵字擷取的同時
+    以此清單開始完整分析；若關鍵字篩選出的藥物都在清單內就直接採用推測結果，否則以篩選結果重新分析。
+
+    on_medication（選用）：串流模式下每解析出一筆藥物就呼叫一次，供呼叫端提早推送部分結果。
+    推測分析可能被捨棄，因此只有最終採用的分析請求會觸發此回呼。
+
+    圖片數超過 Config.ANALYSIS_SPLIT_THRESHOLD 時改為分組並行分析（見 analyze_image_groups），
+    此時不使用推測分析；分組模式下每組完成時即對該組的藥物呼叫 on_medication。
+    """
+    runtime = get_async_runtime()
+    start_time = time.time()
+    print("[Smart Filter] 開始智能篩選頻率導向分析 (並行版本)...")
+    
+    if not image_bytes_list:
+        print("[Smart Filter] 錯誤：沒有提供任何圖片資料。")
+        return None, None
+
+    # 推測分析的任務；不論以何種方式結束都在 finally 中放棄尚未完成的推測分析
+    speculative_task = None
+    try:
+        # 第0步：圖片前處理（轉正、縮圖、重新壓縮），OCR 與分析兩個階段共用同一份結果
+        image_bytes_list, image_preprocess_stats = await runtime.run_blocking(preprocess_images, image_bytes_list)
         
-        # 構建請求（包含所有圖片）
-        prompt_parts = [types.Part.from_text(text=complete_prompt)]
+        # OCR 關鍵字快取的命中統計（由 extract_drug_keywords_batch 填入）
+        ocr_cache_stats = {'hits': 0, 'misses': 0, 'tokens_saved': 0}
         
-        for i, image_bytes in enumerate(image_bytes_list):
-            prompt_parts.append(types.Part(
-                inline_data=types.Blob(
-                    mime_type='image/jpeg',
-                    data=base64.b64encode(image_bytes).decode()
-                )
-            ))
+        # 圖片較多時分組並行分析，避免單一請求過大或一張壞圖拖垮整批
+        split_mode = 0 < Config.ANALYSIS_SPLIT_THRESHOLD < len(image_bytes_list)
+        if split_mode and speculative_drugs:
+            print("[Speculative] 分組分析模式不使用推測分析")
+            speculative_drugs = None
         
-        contents = [types.Content(role="user", parts=prompt_parts)]
+        # 推測分析：不等關鍵字擷取，直接以候選清單開始完整分析
+        speculation_info = {'enabled': bool(speculative_drugs)}
+        stream_stats = {'streamed': False}
+        if speculative_drugs:
+            print(f"[Speculative] 以 {len(speculative_drugs)} 種近期用藥開始推測分析")
+            speculative_task = asyncio.ensure_future(request_analysis(image_bytes_list, api_key, speculative_drugs))
         
-        # 執行分析
-        print("[Smart Filter] 發送分析請求...")
-        analysis_start = time.time()
+        # 第1&2步：並行執行資料庫查詢和OCR處理
+        try:
+            # 嘗試使用並行處理
+            all_drugs, (keywords, total_ocr_tokens), parallel_time = await parallel_db_and_ocr(
+                image_bytes_list, db_config, api_key, ocr_cache_stats
+            )
+            processing_mode = "parallel"
+        except Exception as e:
+            print(f"[Smart Filter] 並行處理失敗，回退到序列處理: {e}")
+            # 回退到原始序列處理
+            all_drugs = await runtime.run_blocking(get_all_drugs_from_db, db_config)
+            if not all_drugs:
+                return None, {"error": "資料庫連線失敗"}
+            
+            ocr_start = time.time()
+            keywords, total_ocr_tokens = await runtime.run_blocking(
+                extract_drug_keywords_batch, image_bytes_list, api_key, ocr_cache_stats
+            )
+            parallel_time = time.time() - ocr_start
+            processing_mode = "sequential_fallback"
         
-        response = client.models.generate_content(
-            model=model_name,
-            contents=contents,
-            config=config
-        )
+        if not all_drugs:
+            return None, {"error": "資料庫連線失敗"}
         
-        analysis_time = time.time() - analysis_start
+        print(f"[Smart Filter] 處理模式: {processing_mode}, 耗時: {parallel_time:.4f}s")
+        print(f"[Smart Filter] 從 {len(image_bytes_list)} 張圖片提取到 {len(keywords)} 個唯一關鍵字")
         
-        # 處理回應
-        response_text = response.text if hasattr(response, 'text') else ""
-        if not response_text:
-            print("[Smart Filter] 模型沒有回傳任何文字內容。")
-            return None, None
-
-        # 解析JSON
-        try:
-            if response_text.startswith('```json'):
-                json_start = response_text.find('{')
-                json_end = response_text.rfind('}') + 1
-                clean_json = response_text[json_start:json_end]
-                analysis_result = json.loads(clean_json)
+        model_name = ANALYSIS_MODEL
+        response = None
+        if split_mode:
+            # 第3步：智能篩選（所有圖片的關鍵字共用一份候選清單）
+            filtered_drugs = await runtime.run_blocking(smart_filter_drugs, all_drugs, keywords)
+            
+            # 第4&5步：分組並行分析並合併結果
+            analysis_start = time.time()
+            analysis_result, split_stats = await analyze_image_groups(image_bytes_list, api_key, filtered_drugs, on_medication)
+            analysis_time = time.time() - analysis_start
+            if analysis_result is None:
+                print("[Smart Filter] 所有分組皆分析失敗。")
+                return None, None
+            prompt_stats = split_stats['prompt_stats']
+            analysis_prompt_tokens = split_stats['prompt_tokens']
+            analysis_completion_tokens = split_stats['completion_tokens']
+            analysis_tokens = split_stats['total_tokens']
+            group_timings = split_stats['groups']
+            if split_stats['first_medication_at'] is not None:
+                stream_stats['first_medication_at'] = split_stats['first_medication_at']
+        elif speculative_task is None:
+            # 第3步：智能篩選
+            filtered_drugs = await runtime.run_blocking(smart_filter_drugs, all_drugs, keywords)
+            
+            # 第4&5步：構建頻率導向分析 Prompt 並發送分析請求
+            response, analysis_time, prompt_stats = await request_analysis(
+                image_bytes_list, api_key, filtered_drugs, on_medication, stream_stats
+            )
+        else:
+            # 第3步：只取關鍵字實際匹配到的藥物，檢查推測清單是否已涵蓋
+            matched_drugs = await runtime.run_blocking(smart_filter_drugs, all_drugs, keywords, pad_common=False)
+            shortlist_ids = {drug['drug_id'] for drug in speculative_drugs}
+            missed_drugs = [drug for drug in matched_drugs if drug['drug_id'] not in shortlist_ids]
+            speculation_info.update({
+                'shortlist_size': len(speculative_drugs),
+                'missed_drugs': len(missed_drugs),
+                'hit': False,
+                'latency_saved': 0.0,
+            })
+            
+            if not missed_drugs:
+                wait_start = time.time()
+                try:
+                    response, analysis_time, prompt_stats = await speculative_task
+                    filtered_drugs = speculative_drugs
+                    # 推測分析在關鍵字擷取期間已完成的部分，就是省下的等待時間
+                    speculation_info['hit'] = True
+                    speculation_info['latency_saved'] = max(0.0, analysis_time - (time.time() - wait_start))
+                except Exception as e:
+                    print(f"[Speculative] 推測分析失敗，改用篩選結果重新分析: {e}")
+            else:
+                _discard_task(speculative_task)
+            
+            if speculation_info['hit']:
+                print(f"[Speculative] 命中，節省 {speculation_info['latency_saved']:.4f}s")
             else:
-                analysis_result = json.loads(response_text)
-        except json.JSONDecodeError as e:
-            print(f"[Smart Filter] JSON解析失敗: {e}")
-            return None, None
+                # 第4&5步：推測清單漏掉了關鍵字匹配到的藥物，以篩選結果重新分析
+                print(f"[Speculative] 未命中：篩選結果有 {len(missed_drugs)} 種藥物不在近期用藥清單中，重新分析")
+                filtered_drugs = pad_with_common_drugs(all_drugs, matched_drugs)
+                response, analysis_time, prompt_stats = await request_analysis(
+                    image_bytes_list, api_key, filtered_drugs, on_medication, stream_stats
+                )
+        
+        if response is not None:
+            # 處理回應、解析JSON
+            analysis_result = parse_analysis_response(response)
+            if analysis_result is None:
+                return None, None
+            analysis_prompt_tokens, analysis_completion_tokens, analysis_tokens = _usage_tokens(response)
+            group_timings = [{
+                'group': 1, 'images': list(range(1, len(image_bytes_list) + 1)), 'status': 'ok',
+                'analysis_time': analysis_time, 'medications': len(analysis_result.get('medications') or []),
+            }]
         
         # 數學驗證健壯邏輯 - 在統計前先驗證和修正頻率
         medications = analysis_result.get('medications', [])
+        # prompt 中只有藥名，用途與副作用由藥品目錄補回
+        join_drug_details(medications, all_drugs)
         medications = apply_math_validation(medications, analysis_result.get('days_supply'))
         analysis_result['medications'] = medications  # 更新修正後的結果
         
@@ -908,12 +1174,18 @@ def run_analysis(image_bytes_list: List[bytes], db_config: dict, api_key: str) -
         analysis_result['is_successful'] = frequency_rate > 0
         analysis_result['user_message'] = f"智能篩選分析完成，識別{total_meds}種藥物，{with_frequency}種有頻率資訊。"
         
-        # 統計分析階段的TOKEN
-        analysis_tokens = 0
-        if hasattr(response, 'usage_metadata') and response.usage_metadata:
-            analysis_prompt_tokens = getattr(response.usage_metadata, 'prompt_token_count', 0)
-            analysis_completion_tokens = getattr(response.usage_metadata, 'candidates_token_count', 0)
-            analysis_tokens = getattr(response.usage_metadata, 'total_token_count', 0)
+        # 每張圖片的前處理與分析耗時（單一請求模式下所有圖片同屬一組）
+        per_image_timings = []
+        for group in group_timings:
+            for image_no in group['images']:
+                per_image_timings.append({
+                    'image': image_no,
+                    'preprocess_time': image_preprocess_stats['per_image_times'][image_no - 1],
+                    'group': group['group'],
+                    'analysis_time': group['analysis_time'],
+                    'status': group['status'],
+                })
+        per_image_timings.sort(key=lambda t: t['image'])
         
         # 計算總TOKEN（OCR + 分析）
         total_tokens = total_ocr_tokens + analysis_tokens
@@ -923,6 +1195,11 @@ def run_analysis(image_bytes_list: List[bytes], db_config: dict, api_key: str) -
         math_corrected_count = sum(1 for med in medications if med.get('math_validation', {}).get('corrected'))
         avg_confidence = sum(med.get('math_validation', {}).get('confidence_score', 0.5) for med in medications) / total_meds if total_meds > 0 else 0.5
         
+        # 串流模式：從分析開始到第一筆藥物解析完成的時間
+        first_medication_at = stream_stats.pop('first_medication_at', None)
+        if first_medication_at is not None:
+            stream_stats['time_to_first_medication'] = first_medication_at - start_time
+        
         # 使用統計
         end_time = time.time()
         usage_info = {
@@ -941,12 +1218,25 @@ def run_analysis(image_bytes_list: List[bytes], db_config: dict, api_key: str) -
             "completeness_type": completeness_type,
             "is_successful": analysis_result['is_successful'],
             "images_processed": len(image_bytes_list),
-            "api_calls_used": 2,  # OCR批次 + 分析
+            # OCR批次（快取全部命中時略過） + 分析（分組模式每組一次；推測未命中時多一次）
+            "api_calls_used": (1 if ocr_cache_stats['misses'] else 0) + (
+                len(group_timings) if split_mode else 1 + (1 if speculation_info['enabled'] and not speculation_info.get('hit') else 0)
+            ),
             "api_calls_saved": len(image_bytes_list) - 1,  # 節省的OCR調用次數
             "ocr_tokens": total_ocr_tokens,
             "analysis_tokens": analysis_tokens,
+            "analysis_prompt_tokens": analysis_prompt_tokens,
+            "analysis_completion_tokens": analysis_completion_tokens,
+            "prompt_encoding": prompt_stats,
             "total_tokens": total_ocr_tokens + analysis_tokens,
             "token_savings": f"{((6964 - total_tokens) / 6964 * 100):.1f}%" if total_tokens > 0 else "N/A",
+            "ocr_cache": ocr_cache_stats,
+            "image_preprocess": image_preprocess_stats,
+            "speculative": speculation_info,
+            "streaming": stream_stats,
+            "analysis_mode": "split" if split_mode else "single",
+            "analysis_groups": len(group_timings),
+            "per_image_timings": per_image_timings,
             # 新增數學驗證統計
             "math_validation": {
                 "validated_count": math_validated_count,
@@ -960,11 +1250,16 @@ def run_analysis(image_bytes_list: List[bytes], db_config: dict, api_key: str) -
         print(f"[Smart Filter] 資料庫篩選: {len(all_drugs)} → {len(filtered_drugs)} ({usage_info['filter_ratio']:.1%})")
         print(f"[Smart Filter] 處理模式: {processing_mode}")
         print(f"[Smart Filter] 並行處理時間: {parallel_time:.4f}s")
-        print(f"[Smart Filter] API調用優化: {len(image_bytes_list)}張圖片僅用2次API調用 (OCR批次+分析)")
+        print(f"[Smart Filter] API調用: {len(image_bytes_list)}張圖片共 {usage_info['api_calls_used']} 次 (OCR批次+分析)")
         print(f"[Smart Filter] Token使用: OCR({total_ocr_tokens}) + 分析({analysis_tokens}) = {total_tokens}")
+        print(f"[Smart Filter] 分析 Prompt: 候選藥物 {prompt_stats['included']}/{prompt_stats['candidates']} 種, "
+              f"prompt {analysis_prompt_tokens} / 回應 {analysis_completion_tokens} tokens")
+        print(f"[OCR Cache] 命中 {ocr_cache_stats['hits']}/{len(image_bytes_list)} 張圖片，節省 Token: {ocr_cache_stats['tokens_saved']}")
         print(f"[Smart Filter] 處理圖片數量: {len(image_bytes_list)}")
         print(f"[Smart Filter] Token節省: {usage_info['token_savings']}")
         print(f"[Smart Filter] 總執行時間: {end_time - start_time:.4f}s")
+        if 'time_to_first_medication' in stream_stats:
+            print(f"[Smart Filter] 串流首筆藥物時間: {stream_stats['time_to_first_medication']:.4f}s")
         print(f"[Smart Filter] 成功匹配: {len(successful_matches)}/{total_meds}")
         print(f"[Smart Filter] 頻率完整度: {frequency_rate:.1%}")
         print(f"[Smart Filter] 完整性類型: {completeness_type}")
@@ -978,5 +1273,7 @@ def run_analysis(image_bytes_list: List[bytes], db_config: dict, api_key: str) -
         print(f"[Smart Filter] 分析處理錯誤: {e}")
         traceback.print_exc()
         return None, None
+    finally:
+        _discard_task(speculative_task)
 
 # --- END OF FILE: app/services/ai_processor.py (智能篩選優化版) ---
\ No newline at end of file
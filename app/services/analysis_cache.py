@@ -0,0 +1,73 @@
+# app/services/analysis_cache.py
+
+import copy
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+from ..utils.cache import LRUCache
+from .drug_catalog import get_catalog
+
+# 外部 OCR 模型：遠端服務會依 line_user_id / member 建立紀錄，快取不可跨用戶或成員共用
+_REMOTE_MODELS = ('api_ocr', 'fastapi_ocr')
+
+
+class AnalysisCache:
+    """
+    整份藥單分析結果的快取。
+
+    鍵為依序排列的圖片雜湊 + 分析模型（smart_filter / api_ocr / fastapi_ocr）+ 藥品目錄版本；
+    外部 OCR 模型另外加上用戶與成員，確保每個用戶 / 成員第一次上傳時仍會呼叫遠端服務建立紀錄。
+    目錄內容變動時由目錄的版本監聽清空。存取時一律深拷貝，
+    避免使用者後續編輯藥單時改到快取內容。
+    """
+
+    def __init__(self, max_entries=128, ttl=3600):
+        self._cache = LRUCache(max_entries, ttl)
+        self._invalidations = 0
+
+    @staticmethod
+    def _key(image_hashes: List[str], model: str, catalog_version: int, user_id: str = None, member: str = None) -> str:
+        key = f"analysis:{model}:catalog-v{catalog_version}:{'+'.join(image_hashes)}"
+        if model in _REMOTE_MODELS:
+            key += f":{user_id}:{member}"
+        return key
+
+    def get(self, image_hashes: List[str], model: str, user_id: str = None, member: str = None) -> Optional[Tuple[Dict, Dict]]:
+        """回傳 (analysis_result, usage_info) 的副本，沒有快取時回傳 None。"""
+        cached = self._cache.get(self._key(image_hashes, model, get_catalog().version, user_id, member))
+        if cached is None:
+            return None
+        return copy.deepcopy(cached)
+
+    def set(self, image_hashes: List[str], model: str, analysis_result: Dict, usage_info: Dict,
+            user_id: str = None, member: str = None):
+        key = self._key(image_hashes, model, get_catalog().version, user_id, member)
+        self._cache.set(key, copy.deepcopy((analysis_result, usage_info or {})))
+
+    def invalidate(self, *_):
+        """清空所有分析結果（藥品目錄變動時自動呼叫）。"""
+        self._cache.clear()
+        self._invalidations += 1
+
+    def stats(self) -> dict:
+        return {**self._cache.stats(), 'invalidations': self._invalidations}
+
+
+_analysis_cache = None
+_analysis_cache_lock = threading.Lock()
+
+
+def get_analysis_cache() -> AnalysisCache:
+    """取得行程內共用的分析結果快取，並註冊藥品目錄的版本監聽。"""
+    global _analysis_cache
+    if _analysis_cache is None:
+        with _analysis_cache_lock:
+            if _analysis_cache is None:
+                cache = AnalysisCache(
+                    max_entries=Config.ANALYSIS_CACHE_SIZE,
+                    ttl=Config.ANALYSIS_CACHE_TTL_SECONDS or None,
+                )
+                get_catalog().add_listener(cache.invalidate)
+                _analysis_cache = cache
+    return _analysis_cache
@@ -0,0 +1,145 @@
+# app/services/analysis_merge.py
+
+from collections import Counter
+from typing import Dict, List, Tuple
+
+# 每張圖片都可能辨識出、需要在合併時協調的全域欄位
+GLOBAL_FIELDS = ('clinic_name', 'doctor_name', 'visit_date', 'days_supply')
+_EMPTY_VALUES = ('', 'null', 'none', 'n/a')
+
+
+def plan_image_groups(image_count: int, group_size: int = 1) -> List[List[int]]:
+    """將圖片依序切成每組最多 group_size 張（回傳 0 起算的圖片索引）。"""
+    group_size = max(1, group_size)
+    return [list(range(start, min(start + group_size, image_count))) for start in range(0, image_count, group_size)]
+
+
+def _is_empty(value) -> bool:
+    return value is None or str(value).strip().lower() in _EMPTY_VALUES
+
+
+def _as_number(value) -> float:
+    try:
+        return float(str(value).strip())
+    except ValueError:
+        return 0.0
+
+
+def reconcile_field(field: str, values: list):
+    """
+    協調多組分析結果中的同一個全域欄位：取出現最多次的非空值，
+    平手時 days_supply 取較大的天數（與 prompt 的規則一致），其他欄位取圖片順序較前者。
+    """
+    values = [v for v in values if not _is_empty(v)]
+    if not values:
+        return None
+    counts = Counter(str(v).strip() for v in values)
+    best = max(counts.values())
+    tied = [v for v in values if counts[str(v).strip()] == best]
+    if field == 'days_supply':
+        return max(tied, key=_as_number)
+    return tied[0]
+
+
+def remap_source_image(med: Dict, image_indexes: List[int]) -> None:
+    """把 source_image 從子集合內的編號（1 起算）換回整份藥單的編號。"""
+    try:
+        local_index = int(med.get('source_image') or 1) - 1
+    except (TypeError, ValueError):
+        local_index = 0
+    local_index = min(max(local_index, 0), len(image_indexes) - 1)
+    med['source_image'] = image_indexes[local_index] + 1
+
+
+def merge_group_results(group_results: List[Tuple[List[int], Dict]]) -> Tuple[Dict, int]:
+    """
+    合併各組圖片的分析結果（group_results 依圖片順序排列，每項為 (圖片索引, 分析結果)）：
+    - source_image 從組內編號換回整份藥單的編號
+    - 相同 matched_drug_id 的藥物只保留第一筆；沒有匹配到資料庫的藥物全部保留
+    - 全域欄位以 reconcile_field 協調
+    回傳 (合併結果, 移除的重複藥物數)。
+    """
+    merged = {'medications': []}
+    seen_ids = set()
+    duplicates = 0
+
+    for image_indexes, result in group_results:
+        for med in result.get('medications') or []:
+            if not isinstance(med, dict):
+                continue
+            remap_source_image(med, image_indexes)
+
+            drug_id = med.get('matched_drug_id')
+            if not _is_empty(drug_id):
+                if str(drug_id) in seen_ids:
+                    duplicates += 1
+                    continue
+                seen_ids.add(str(drug_id))
+            merged['medications'].append(med)
+
+    for field in GLOBAL_FIELDS:
+        merged[field] = reconcile_field(field, [result.get(field) for _, result in group_results])
+    return merged, duplicates
+
+
+def _medication_key(med: Dict) -> str:
+    drug_id = med.get('matched_drug_id')
+    if not _is_empty(drug_id):
+        return f"id:{drug_id}"
+    name = med.get('drug_name_zh') or med.get('drug_name_en') or ''
+    return f"name:{str(name).strip().lower()}" if str(name).strip() else ''
+
+
+def split_result_by_image(result: Dict, image_count: int) -> List[Dict]:
+    """
+    將一次分析的結果依 source_image 拆成每張圖片各自的結果（依圖片順序），
+    供之後加拍頁面時重複使用；全域欄位每張圖片都保留一份。
+    """
+    per_image = [{'medications': []} for _ in range(image_count)]
+    if not image_count:
+        return per_image
+    for med in result.get('medications') or []:
+        if not isinstance(med, dict):
+            continue
+        try:
+            index = int(med.get('source_image') or 1) - 1
+        except (TypeError, ValueError):
+            index = 0
+        per_image[min(max(index, 0), image_count - 1)]['medications'].append(dict(med))
+    for item in per_image:
+        for field in GLOBAL_FIELDS:
+            item[field] = result.get(field)
+    return per_image
+
+
+def merge_into_draft(draft: Dict, new_result: Dict, image_indexes: List[int]) -> Tuple[Dict, int, int]:
+    """
+    將新增頁面（image_indexes 為這些圖片在整份藥單中的索引）的分析結果併入既有草稿：
+    - 草稿內既有的藥物（含使用者在編輯頁手動修改或刪除的結果）一律不動
+    - 新藥物依 matched_drug_id（未匹配時依藥名）去除與草稿重複者後附加在最後
+    - 全域欄位只在草稿中為空時才補上
+    回傳 (草稿, 新增藥物數, 略過的重複藥物數)。
+    """
+    medications = draft.setdefault('medications', [])
+    seen = {_medication_key(med) for med in medications if isinstance(med, dict)}
+    seen.discard('')
+    added = duplicates = 0
+
+    for med in new_result.get('medications') or []:
+        if not isinstance(med, dict):
+            continue
+        remap_source_image(med, image_indexes)
+        key = _medication_key(med)
+        if key and key in seen:
+            duplicates += 1
+            continue
+        if key:
+            seen.add(key)
+        medications.append(med)
+        added += 1
+
+    for field in GLOBAL_FIELDS:
+        if _is_empty(draft.get(field)) and not _is_empty(new_result.get(field)):
+            draft[field] = new_result[field]
+    draft['successful_match_count'] = len([med for med in medications if isinstance(med, dict) and med.get('matched_drug_id')])
+    return draft, added, duplicates
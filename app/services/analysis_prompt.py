@@ -0,0 +1,77 @@
+# app/services/analysis_prompt.py
+
+import math
+from typing import Dict, List, Tuple
+
+# 送進 prompt 的藥品欄位：模型只需要這些欄位來選出 matched_drug_id，
+# 用途與副作用等描述欄位在回應後再由藥品目錄補回
+PROMPT_DRUG_FIELDS = ('drug_id', 'drug_name_zh', 'drug_name_en')
+PROMPT_FREQUENCY_FIELDS = ('frequency_code', 'frequency_name', 'times_per_day', 'timing_description')
+DETAIL_FIELDS = ('main_use', 'side_effects')
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估 token 數：中日韓文字約 1 字 1 token，其餘字元約 4 字 1 token。"""
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def _cell(value) -> str:
+    if value is None:
+        return ''
+    return str(value).replace('|', '/').replace('\n', ' ').strip()
+
+
+def _row(item: Dict, fields) -> str:
+    return '|'.join(_cell(item.get(field)) for field in fields)
+
+
+def encode_drug_table(drugs: List[Dict], token_budget: int = 0) -> Tuple[str, dict]:
+    """
+    將候選藥物編成「drug_id|中文名|英文名」的精簡表格。
+
+    候選清單已依匹配分數排序，超過 token_budget 時從尾端（分數最低）截斷；
+    token_budget <= 0 表示不限制。回傳 (表格文字, 統計)。
+    """
+    lines = ['|'.join(PROMPT_DRUG_FIELDS)]
+    used = estimate_tokens(lines[0])
+    for drug in drugs:
+        line = _row(drug, PROMPT_DRUG_FIELDS)
+        cost = estimate_tokens(line) + 1
+        if token_budget > 0 and used + cost > token_budget and len(lines) > 1:
+            break
+        lines.append(line)
+        used += cost
+
+    included = len(lines) - 1
+    stats = {
+        'candidates': len(drugs),
+        'included': included,
+        'truncated': len(drugs) - included,
+        'estimated_table_tokens': used,
+        'token_budget': token_budget,
+    }
+    return '\n'.join(lines), stats
+
+
+def encode_frequency_table(freq_codes: List[Dict]) -> str:
+    lines = ['|'.join(PROMPT_FREQUENCY_FIELDS)]
+    lines.extend(_row(item, PROMPT_FREQUENCY_FIELDS) for item in freq_codes)
+    return '\n'.join(lines)
+
+
+def join_drug_details(medications: List[Dict], drugs: List[Dict]) -> int:
+    """
+    依 matched_drug_id 從藥品目錄補回用途、副作用等描述欄位（就地修改），回傳補回的筆數。
+    沒有匹配的藥物保留原值（通常為空），由顯示端套用預設文字。
+    """
+    wanted = {str(med.get('matched_drug_id')) for med in medications if med.get('matched_drug_id')}
+    by_id = {str(drug['drug_id']): drug for drug in drugs if str(drug.get('drug_id')) in wanted} if wanted else {}
+
+    joined = 0
+    for med in medications:
+        drug = by_id.get(str(med.get('matched_drug_id')))
+        for field in DETAIL_FIELDS:
+            med[field] = drug.get(field) if drug else med.get(field)
+        joined += drug is not None
+    return joined
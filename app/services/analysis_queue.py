@@ -0,0 +1,487 @@
+# app/services/analysis_queue.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+import pymysql
+
+from config import Config
+from ..utils.db_pool import pooled_connection
+
+# 任務狀態
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_DEAD = 'dead'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    payload TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    enqueued_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs (status, available_at);
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_user ON analysis_jobs (user_id, status);
+"""
+
+_MYSQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_jobs (
+    id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    user_id VARCHAR(64) NOT NULL,
+    task_id VARCHAR(64) NOT NULL,
+    payload TEXT NOT NULL,
+    status VARCHAR(16) NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    enqueued_at DOUBLE NOT NULL,
+    available_at DOUBLE NOT NULL,
+    started_at DOUBLE,
+    finished_at DOUBLE,
+    INDEX idx_analysis_jobs_status (status, available_at),
+    INDEX idx_analysis_jobs_user (user_id, status)
+) DEFAULT CHARSET = utf8mb4
+"""
+
+# 取出任務時持有的 MySQL 具名鎖，讓多個執行個體不會同時取出同一用戶的任務
+_DEQUEUE_LOCK_NAME = 'analysis_jobs_dequeue'
+
+# 兩種儲存後端的資料庫例外
+_DB_ERRORS = (sqlite3.Error, pymysql.MySQLError)
+
+# 同一用戶只取最早的待處理任務，且該用戶沒有執行中的任務時才取出，確保同一用戶的任務依序執行
+_NEXT_JOB_SQL = """
+SELECT * FROM analysis_jobs AS j
+WHERE j.status = 'queued' AND j.available_at <= ?
+  AND NOT EXISTS (SELECT 1 FROM analysis_jobs AS r WHERE r.user_id = j.user_id AND r.status = 'running')
+  AND NOT EXISTS (SELECT 1 FROM analysis_jobs AS e WHERE e.user_id = j.user_id AND e.status = 'queued' AND e.id < j.id)
+ORDER BY j.id
+LIMIT 1
+"""
+
+# 計算延遲時保留的最近完成任務數
+_LATENCY_WINDOW = 200
+
+
+class _SQLiteJobStore:
+    """佇列存在本機 SQLite 檔案：只適用於單一執行個體（本機開發），Cloud Run 的 /tmp 不會跨執行個體共用。"""
+
+    shared = False
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(_SCHEMA)
+
+    def describe(self) -> str:
+        return f"SQLite {self.db_path}"
+
+    def _connect(self) -> sqlite3.Connection:
+        """每個執行緒各自保有一條連線（sqlite3 連線不可跨執行緒共用）。"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def transaction(self, serialize: bool = False):
+        # BEGIN IMMEDIATE 本身就讓取出任務的交易彼此排隊
+        return _Transaction(self._connect())
+
+    def query(self, sql: str, params=()) -> List[dict]:
+        return [dict(row) for row in self._connect().execute(sql, params).fetchall()]
+
+
+class _MySQLJobStore:
+    """佇列存在 MySQL（經由連線池）：任務在執行個體重新啟動、縮減後仍保留，所有執行個體共用同一個佇列。"""
+
+    shared = True
+
+    def __init__(self):
+        with self.transaction() as conn:
+            conn.execute(_MYSQL_SCHEMA)
+
+    def describe(self) -> str:
+        return "MySQL analysis_jobs"
+
+    @contextmanager
+    def transaction(self, serialize: bool = False):
+        """
+        以連線池的連線執行一個交易。serialize 為 True 時先取得具名鎖：
+        取出任務時以此排隊，避免不同執行個體同時取出同一用戶的任務。
+        """
+        with pooled_connection() as conn:
+            if serialize:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT GET_LOCK(%s, 10) AS locked", (_DEQUEUE_LOCK_NAME,))
+                    locked = cursor.fetchone()['locked']
+                conn.commit()
+                if not locked:
+                    raise pymysql.MySQLError("等待佇列鎖逾時")
+            try:
+                yield _MySQLConnection(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                if serialize:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT RELEASE_LOCK(%s)", (_DEQUEUE_LOCK_NAME,))
+
+    def query(self, sql: str, params=()) -> List[dict]:
+        with pooled_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.replace('?', '%s'), params)
+                return list(cursor.fetchall())
+
+
+class _MySQLConnection:
+    """讓佇列的 SQL（以 ? 為參數）可以直接在 pymysql 連線上執行。"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql: str, params=()):
+        cursor = self.conn.cursor()
+        cursor.execute(sql.replace('?', '%s'), params)
+        return cursor
+
+
+class AnalysisJobQueue:
+    """
+    藥單分析工作佇列，任務存在 MySQL（預設，所有 Cloud Run 執行個體共用）或本機 SQLite 檔案。
+
+    Webhook 與 LIFF 上傳只負責 enqueue 後立即回應，背景工作執行緒 dequeue 後執行分析並以推播送出結果。
+    每個執行個體各自啟動工作執行緒，從共用的佇列取出任務；同一用戶的任務不論在哪個執行個體都依序執行。
+    執行個體中斷時留下的執行中任務，超過 stale_after 秒後會重新排入佇列；失敗的任務以遞增的延遲重試，
+    超過 max_attempts 次後標記為 dead（死信），保留在資料表中供檢查與手動重新排入。
+    """
+
+    def __init__(self, store, workers: int = 2, max_attempts: int = 3,
+                 retry_delay: float = 10.0, retention: float = 24 * 3600, stale_after: float = 900.0):
+        self._store = store
+        self.stale_after = stale_after
+        self.workers = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self.retention = retention
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._started = False
+        self._threads: List[threading.Thread] = []
+        self._latencies = []  # [(等待秒數, 執行秒數)]
+        self._stats = {'enqueued': 0, 'deduplicated': 0, 'succeeded': 0, 'retried': 0, 'dead_lettered': 0,
+                       'recovered': 0}
+
+    # --- 資料庫 ---
+
+    def _transaction(self, serialize: bool = False):
+        return self._store.transaction(serialize)
+
+    # --- 佇列操作 ---
+
+    def enqueue(self, user_id: str, task_id: str, payload: dict = None) -> int:
+        """
+        排入一個分析任務並回傳任務 ID。
+        同一個任務已在排隊（尚未開始）時不重複排入：執行時會讀取最新的任務狀態，結果相同。
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id FROM analysis_jobs WHERE user_id = ? AND task_id = ? AND status = 'queued'",
+                (user_id, task_id)
+            ).fetchone()
+            if row is not None:
+                job_id = row['id']
+                deduplicated = True
+            else:
+                job_id = conn.execute(
+                    "INSERT INTO analysis_jobs (user_id, task_id, payload, status, enqueued_at, available_at) "
+                    "VALUES (?, ?, ?, 'queued', ?, ?)",
+                    (user_id, task_id, json.dumps(payload or {}, ensure_ascii=False), now, now)
+                ).lastrowid
+                deduplicated = False
+        with self._wakeup:
+            self._stats['deduplicated' if deduplicated else 'enqueued'] += 1
+            self._wakeup.notify()
+        print(f"[Analysis Queue] {'任務已在佇列中' if deduplicated else '已排入任務'} #{job_id} - 用戶: {user_id}, 任務: {task_id}")
+        return job_id
+
+    def dequeue(self) -> Optional[dict]:
+        """取出下一個可執行的任務並標記為執行中；沒有可執行的任務時回傳 None。"""
+        now = time.time()
+        with self._transaction(serialize=True) as conn:
+            row = conn.execute(_NEXT_JOB_SQL, (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE analysis_jobs SET status = 'running', attempts = attempts + 1, started_at = ? WHERE id = ?",
+                (now, row['id'])
+            )
+        job = dict(row)
+        job['attempts'] += 1
+        job['started_at'] = now
+        job['payload'] = json.loads(job['payload'] or '{}')
+        return job
+
+    def ack(self, job: dict):
+        """任務成功完成。"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE analysis_jobs SET status = 'done', finished_at = ?, last_error = NULL WHERE id = ?",
+                (now, job['id'])
+            )
+        with self._wakeup:
+            self._stats['succeeded'] += 1
+            self._record_latency_locked(job, now)
+            # 同一用戶的下一個任務現在可以執行了
+            self._wakeup.notify_all()
+
+    def fail(self, job: dict, error: str) -> bool:
+        """
+        任務執行失敗：未超過重試次數時以遞增的延遲重新排入佇列，否則標記為死信。
+        回傳 True 表示已標記為死信。
+        """
+        now = time.time()
+        dead = job['attempts'] >= self.max_attempts
+        with self._transaction() as conn:
+            if dead:
+                conn.execute(
+                    "UPDATE analysis_jobs SET status = 'dead', finished_at = ?, last_error = ? WHERE id = ?",
+                    (now, error, job['id'])
+                )
+            else:
+                delay = self.retry_delay * (2 ** (job['attempts'] - 1))
+                conn.execute(
+                    "UPDATE analysis_jobs SET status = 'queued', available_at = ?, last_error = ? WHERE id = ?",
+                    (now + delay, error, job['id'])
+                )
+        with self._wakeup:
+            if dead:
+                self._stats['dead_lettered'] += 1
+                self._record_latency_locked(job, now)
+            else:
+                self._stats['retried'] += 1
+            self._wakeup.notify_all()
+        if dead:
+            print(f"[Analysis Queue] 任務 #{job['id']} 已失敗 {job['attempts']} 次，移入死信: {error}")
+        else:
+            print(f"[Analysis Queue] 任務 #{job['id']} 第 {job['attempts']} 次執行失敗，稍後重試: {error}")
+        return dead
+
+    def requeue_dead(self, job_id: int) -> bool:
+        """把死信任務重新排入佇列（重試次數歸零）。"""
+        now = time.time()
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE analysis_jobs SET status = 'queued', attempts = 0, available_at = ?, finished_at = NULL "
+                "WHERE id = ? AND status = 'dead'",
+                (now, job_id)
+            ).rowcount
+        if updated:
+            with self._wakeup:
+                self._wakeup.notify()
+        return bool(updated)
+
+    def dead_letters(self, limit: int = 50) -> List[dict]:
+        return self._store.query(
+            "SELECT id, user_id, task_id, attempts, last_error, enqueued_at, finished_at FROM analysis_jobs "
+            "WHERE status = 'dead' ORDER BY id DESC LIMIT ?",
+            (limit,)
+        )
+
+    def recover(self, startup: bool = False) -> int:
+        """
+        把中斷的任務（仍標記為執行中）重新排入佇列。
+        佇列只屬於這個行程（SQLite）時，啟動時所有執行中的任務都是上次中斷留下的；
+        共用的佇列（MySQL）中其他執行個體可能正在執行，只重新排入開始超過 stale_after 秒的任務。
+        """
+        now = time.time()
+        sql = "UPDATE analysis_jobs SET status = 'queued', available_at = ? WHERE status = 'running'"
+        params = [now]
+        if self._store.shared or not startup:
+            sql += " AND started_at < ?"
+            params.append(now - self.stale_after)
+        with self._transaction(serialize=True) as conn:
+            recovered = conn.execute(sql, params).rowcount
+        if recovered:
+            with self._wakeup:
+                self._stats['recovered'] += recovered
+            print(f"[Analysis Queue] 重新排入 {recovered} 個中斷的任務")
+        return recovered
+
+    def purge(self) -> int:
+        """刪除超過保留時間的已完成任務（死信保留）。"""
+        if not self.retention:
+            return 0
+        with self._transaction() as conn:
+            return conn.execute(
+                "DELETE FROM analysis_jobs WHERE status = 'done' AND finished_at < ?",
+                (time.time() - self.retention,)
+            ).rowcount
+
+    # --- 工作執行緒 ---
+
+    def start(self, app, handler: Callable[[dict], None], on_dead: Callable[[dict, str], None] = None):
+        """
+        啟動工作執行緒。handler(job) 在 app context 內執行，拋出例外即視為失敗並重試；
+        任務移入死信後呼叫 on_dead(job, error)。
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self.recover(startup=True)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, args=(app, handler, on_dead),
+                                      name=f'analysis-worker-{i + 1}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"[Analysis Queue] 已啟動 {self.workers} 個工作執行緒，佇列: {self._store.describe()}")
+
+    def _worker(self, app, handler, on_dead):
+        last_purge = last_recover = time.time()
+        while True:
+            try:
+                job = self.dequeue()
+            except _DB_ERRORS as e:
+                print(f"[Analysis Queue] 讀取佇列失敗: {e}")
+                job = None
+            if job is None:
+                if time.time() - last_recover > min(self.stale_after, 60):
+                    # 其他執行個體中斷時留下的任務
+                    last_recover = time.time()
+                    try:
+                        self.recover()
+                    except _DB_ERRORS as e:
+                        print(f"[Analysis Queue] 重新排入中斷任務失敗: {e}")
+                if time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    try:
+                        self.purge()
+                    except _DB_ERRORS as e:
+                        print(f"[Analysis Queue] 清除已完成任務失敗: {e}")
+                with self._wakeup:
+                    # 重試中的任務到期時不會有人通知，定期醒來檢查
+                    self._wakeup.wait(timeout=1.0)
+                continue
+
+            print(f"[Analysis Queue] 開始執行任務 #{job['id']}（第 {job['attempts']} 次）- 用戶: {job['user_id']}")
+            try:
+                with app.app_context():
+                    handler(job)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                try:
+                    dead = self.fail(job, error)
+                except _DB_ERRORS as db_error:
+                    print(f"[Analysis Queue] 更新任務 #{job['id']} 失敗: {db_error}")
+                    continue
+                if dead and on_dead:
+                    try:
+                        with app.app_context():
+                            on_dead(job, error)
+                    except Exception as hook_error:
+                        print(f"[Analysis Queue] 死信處理失敗: {hook_error}")
+                continue
+            try:
+                self.ack(job)
+            except _DB_ERRORS as e:
+                print(f"[Analysis Queue] 更新任務 #{job['id']} 失敗: {e}")
+
+    # --- 觀測 ---
+
+    def _record_latency_locked(self, job: dict, finished_at: float):
+        self._latencies.append((job['started_at'] - job['enqueued_at'], finished_at - job['started_at']))
+        if len(self._latencies) > _LATENCY_WINDOW:
+            del self._latencies[:-_LATENCY_WINDOW]
+
+    @staticmethod
+    def _percentile(values, q):
+        if not values:
+            return None
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+    def stats(self) -> dict:
+        rows = self._store.query(
+            "SELECT status, COUNT(*) AS count, MIN(enqueued_at) AS oldest FROM analysis_jobs GROUP BY status"
+        )
+        depth = {row['status']: row['count'] for row in rows}
+        oldest = next((row['oldest'] for row in rows if row['status'] == JOB_QUEUED), None)
+        with self._lock:
+            waits = [wait for wait, _ in self._latencies]
+            runs = [run for _, run in self._latencies]
+            return {
+                'backend': 'mysql' if self._store.shared else 'sqlite',
+                'workers': len(self._threads),
+                'depth': depth.get(JOB_QUEUED, 0),
+                'running': depth.get(JOB_RUNNING, 0),
+                'dead': depth.get(JOB_DEAD, 0),
+                'oldest_queued_age': round(time.time() - oldest, 3) if oldest else None,
+                'wait_p50': self._percentile(waits, 0.5),
+                'wait_p95': self._percentile(waits, 0.95),
+                'run_p50': self._percentile(runs, 0.5),
+                'run_p95': self._percentile(runs, 0.95),
+                **self._stats,
+            }
+
+
+class _Transaction:
+    """以 BEGIN IMMEDIATE 開始的交易，取出任務時不會被其他執行緒同時取走。"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_analysis_queue() -> AnalysisJobQueue:
+    """取得行程內共用的藥單分析工作佇列（依 Config.ANALYSIS_QUEUE_BACKEND 選擇 MySQL 或 SQLite）。"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                if Config.ANALYSIS_QUEUE_BACKEND == 'sqlite':
+                    store = _SQLiteJobStore(Config.ANALYSIS_QUEUE_DB_PATH)
+                else:
+                    store = _MySQLJobStore()
+                _queue = AnalysisJobQueue(
+                    store,
+                    workers=Config.ANALYSIS_QUEUE_WORKERS,
+                    max_attempts=Config.ANALYSIS_JOB_MAX_ATTEMPTS,
+                    retry_delay=Config.ANALYSIS_JOB_RETRY_DELAY,
+                    retention=Config.ANALYSIS_QUEUE_RETENTION_HOURS * 3600,
+                    stale_after=Config.ANALYSIS_JOB_STALE_SECONDS,
+                )
+    return _queue
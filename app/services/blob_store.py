@@ -0,0 +1,295 @@
+# app/services/blob_store.py
+
+import abc
+import os
+import threading
+import time
+from typing import Iterable, List, Optional
+
+from config import Config
+from ..utils.cache import LRUCache
+from .ocr_cache import image_sha256
+
+# 兩次垃圾回收之間至少間隔的秒數
+_GC_INTERVAL = 3600
+
+
+class BlobStore(abc.ABC):
+    """
+    以內容 SHA-256 為鍵的二進位資料儲存（藥單圖片）。
+
+    狀態 JSON 只保存雜湊，圖片本身存在這裡；相同內容只存一份。
+    超過 ttl 秒未再寫入或讀取的資料會在垃圾回收時刪除（0 表示不回收），
+    垃圾回收在寫入時順便觸發（每小時最多一次，於背景執行緒執行）。
+    子類別實作 _exists / _write / _read / _delete / _expired_keys / _touch；
+    _read 讀到資料時應呼叫 _touch，仍在使用中的資料（例如正在編輯的草稿）才不會被回收。
+    """
+
+    def __init__(self, ttl: float = 24 * 3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_gc = time.time()
+        self._stats = {'puts': 0, 'put_bytes': 0, 'deduplicated': 0, 'hits': 0, 'misses': 0,
+                       'get_bytes': 0, 'gc_runs': 0, 'gc_removed': 0}
+
+    # --- 子類別實作 ---
+
+    @abc.abstractmethod
+    def _exists(self, key: str) -> bool:
+        """資料是否存在。"""
+
+    @abc.abstractmethod
+    def _write(self, key: str, data: bytes):
+        """寫入資料。"""
+
+    @abc.abstractmethod
+    def _read(self, key: str) -> Optional[bytes]:
+        """讀取資料並延長存活時間；不存在時回傳 None。"""
+
+    @abc.abstractmethod
+    def _delete(self, key: str):
+        """刪除資料；不存在時不做任何事。"""
+
+    @abc.abstractmethod
+    def _expired_keys(self, cutoff: float) -> Iterable[str]:
+        """列出最後寫入或讀取時間早於 cutoff 的鍵。"""
+
+    @abc.abstractmethod
+    def _touch(self, key: str):
+        """延長既有資料的存活時間（重新寫入相同內容或讀取時呼叫）。"""
+
+    # --- 公開介面 ---
+
+    def put(self, data: bytes) -> str:
+        """儲存資料並回傳其 SHA-256；內容已存在時只延長存活時間。"""
+        key = image_sha256(data)
+        if self._exists(key):
+            self._touch(key)
+            deduplicated = True
+        else:
+            self._write(key, data)
+            deduplicated = False
+        with self._lock:
+            self._stats['puts'] += 1
+            if deduplicated:
+                self._stats['deduplicated'] += 1
+            else:
+                self._stats['put_bytes'] += len(data)
+        self._maybe_gc()
+        return key
+
+    def get(self, key: str) -> Optional[bytes]:
+        """讀取資料；不存在（或已被回收）時回傳 None。"""
+        data = self._read(key)
+        with self._lock:
+            if data is None:
+                self._stats['misses'] += 1
+            else:
+                self._stats['hits'] += 1
+                self._stats['get_bytes'] += len(data)
+        return data
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [self.get(key) for key in keys]
+
+    def delete(self, key: str):
+        self._delete(key)
+
+    def gc(self) -> int:
+        """刪除超過存活時間的資料，回傳刪除的數量。"""
+        if not self.ttl:
+            return 0
+        removed = 0
+        for key in list(self._expired_keys(time.time() - self.ttl)):
+            try:
+                self._delete(key)
+                removed += 1
+            except Exception as e:
+                print(f"[Blob Store] 刪除過期資料 {key[:12]} 失敗: {e}")
+        with self._lock:
+            self._stats['gc_runs'] += 1
+            self._stats['gc_removed'] += removed
+        if removed:
+            print(f"[Blob Store] 垃圾回收刪除 {removed} 個過期項目")
+        return removed
+
+    def _maybe_gc(self):
+        if not self.ttl:
+            return
+        with self._lock:
+            if time.time() - self._last_gc < _GC_INTERVAL:
+                return
+            self._last_gc = time.time()
+
+        def run():
+            try:
+                self.gc()
+            except Exception as e:
+                print(f"[Blob Store] 垃圾回收失敗: {e}")
+
+        threading.Thread(target=run, name='blob-store-gc', daemon=True).start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'backend': self.backend, 'ttl': self.ttl, **self._stats}
+
+
+class LocalBlobStore(BlobStore):
+    """
+    存放在本機目錄的實作（<root>/<雜湊前兩碼>/<雜湊>），以檔案修改時間判斷存活時間。
+    只適用於單一執行個體：Cloud Run 的每個執行個體各有自己的 /tmp，其他執行個體讀不到這裡的圖片。
+    """
+
+    backend = 'local'
+
+    def __init__(self, root: str, ttl: float = 24 * 3600):
+        super().__init__(ttl)
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def _exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def _write(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        # 仍在使用中的圖片（例如正在編輯的草稿）不應被回收
+        self._touch(key)
+        return data
+
+    def _touch(self, key):
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+
+    def _delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _expired_keys(self, cutoff):
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    if os.path.getmtime(os.path.join(directory, name)) < cutoff:
+                        yield name
+                except OSError:
+                    continue
+
+
+class GcsBlobStore(BlobStore):
+    """
+    存放在 Google Cloud Storage bucket 的實作，供多個執行個體共用。
+
+    client 可替換為任何提供 bucket(name) 的物件（本機開發或測試的替身），
+    其 bucket 需提供 blob(name) 與 list_blobs(prefix=...)，blob 需提供
+    exists()、upload_from_string()、download_as_bytes()、patch()、delete() 與 metadata、updated 屬性；
+    不存在的資料以 FileNotFoundError 或 google.api_core 的 NotFound 表示。
+    存活時間以物件的 updated（最後修改中繼資料的時間）計算：重新上傳相同內容或讀取時
+    更新中繼資料的 touched_at 欄位來延長；同一個物件在 ttl 的四分之一內只更新一次，避免每次讀取都寫入。
+    """
+
+    backend = 'gcs'
+
+    def __init__(self, bucket_name: str, prefix: str = 'prescriptions/', ttl: float = 24 * 3600, client=None):
+        super().__init__(ttl)
+        if client is None:
+            from google.cloud import storage
+            client = storage.Client()
+        self.prefix = prefix
+        self._bucket = client.bucket(bucket_name)
+        # 最近已延長存活時間的物件
+        self._touched = LRUCache(4096, ttl / 4 if ttl else None)
+        try:
+            from google.api_core.exceptions import NotFound
+            self._not_found = (NotFound, FileNotFoundError)
+        except ImportError:
+            self._not_found = (FileNotFoundError,)
+
+    def _blob(self, key):
+        return self._bucket.blob(self.prefix + key)
+
+    def _exists(self, key):
+        return self._blob(key).exists()
+
+    def _write(self, key, data):
+        self._blob(key).upload_from_string(data, content_type='application/octet-stream')
+        self._touched.set(key, True)
+
+    def _read(self, key):
+        try:
+            data = self._blob(key).download_as_bytes()
+        except self._not_found:
+            return None
+        self._touch(key)
+        return data
+
+    def _touch(self, key):
+        if not self.ttl or self._touched.get(key):
+            return
+        blob = self._blob(key)
+        blob.metadata = {'touched_at': str(int(time.time()))}
+        try:
+            blob.patch()
+        except self._not_found:
+            return
+        except Exception as e:
+            print(f"[Blob Store] 延長 {key[:12]} 的存活時間失敗: {e}")
+            return
+        self._touched.set(key, True)
+
+    def _delete(self, key):
+        try:
+            self._blob(key).delete()
+        except self._not_found:
+            pass
+        self._touched.delete(key)
+
+    def _expired_keys(self, cutoff):
+        for blob in self._bucket.list_blobs(prefix=self.prefix):
+            updated = getattr(blob, 'updated', None)
+            if updated is not None and updated.timestamp() < cutoff:
+                yield blob.name[len(self.prefix):]
+
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+
+def get_blob_store() -> BlobStore:
+    """取得行程內共用的藥單圖片儲存（依 Config.BLOB_STORE_BACKEND 選擇 local 或 gcs）。"""
+    global _blob_store
+    if _blob_store is None:
+        with _blob_store_lock:
+            if _blob_store is None:
+                ttl = Config.BLOB_STORE_TTL_HOURS * 3600
+                if Config.BLOB_STORE_BACKEND == 'gcs':
+                    _blob_store = GcsBlobStore(Config.BLOB_STORE_BUCKET, Config.BLOB_STORE_PREFIX, ttl)
+                else:
+                    _blob_store = LocalBlobStore(Config.BLOB_STORE_DIR, ttl)
+    return _blob_store
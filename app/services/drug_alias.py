@@ -0,0 +1,221 @@
+# app/services/drug_alias.py
+
+import json
+import os
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+from .drug_name_index import DrugNameIndex
+
+# OCR 誤讀 / 特殊藥品別名表
+ALIAS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'drug_aliases.json')
+
+
+class AhoCorasick:
+    """多字串比對自動機：對文字做一次線性掃描，找出其中出現的所有 pattern。"""
+
+    def __init__(self, patterns: Iterable[Tuple[str, object]]):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for pattern, value in patterns:
+            if pattern:
+                self._add(pattern, value)
+        self._build()
+
+    def _add(self, pattern: str, value):
+        node = 0
+        for char in pattern:
+            child = self._goto[node].get(char)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][char] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = child
+        self._output[node].append(value)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, text: str) -> set:
+        """回傳 text 中出現的所有 pattern 對應的 value。"""
+        found = set()
+        node = 0
+        goto, fail, output = self._goto, self._fail, self._output
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+
+class AliasRule:
+    """別名表中的一條規則，欄位說明見 app/data/drug_aliases.json。"""
+
+    __slots__ = ('name', 'variants', 'requires_any', 'target_any', 'target_all', 'score', 'guaranteed', 'force_include')
+
+    def __init__(self, data: dict):
+        self.name = data['name']
+        self.variants = [v.lower() for v in data.get('variants', [])]
+        self.requires_any = [r.lower() for r in data.get('requires_any', [])]
+        self.target_any = [t.lower() for t in data.get('target_any', [])]
+        self.target_all = [t.lower() for t in data.get('target_all', [])]
+        self.score = data.get('score')
+        self.guaranteed = bool(data.get('guaranteed', False))
+        self.force_include = bool(data.get('force_include', False))
+
+
+class AliasMatches:
+    """單次篩選中，由別名表命中的目標藥品（以 DrugNameIndex 中的位置表示）。"""
+
+    __slots__ = ('scores', 'guaranteed', 'force_include')
+
+    def __init__(self):
+        self.scores: Dict[int, Tuple[float, str]] = {}   # 位置 -> (分數, 匹配說明)
+        self.guaranteed: Dict[int, str] = {}             # 位置 -> 匹配說明（直接給 1.0 分）
+        self.force_include: List[int] = []               # 一定要加入結果的位置（依規則、目錄順序）
+
+    def positions(self) -> set:
+        return set(self.scores) | set(self.guaranteed) | set(self.force_include)
+
+
+class DrugAliasTable:
+    """
+    將別名表編譯成兩個 Aho-Corasick 自動機：
+      - 變體自動機：對每個 OCR 關鍵字掃描一次，找出觸發的規則
+      - 目標自動機：每個目錄版本對所有藥名掃描一次，找出每條規則的目標藥品
+    """
+
+    def __init__(self, rules: List[AliasRule]):
+        self.rules = rules
+        self._variants = AhoCorasick((variant, i) for i, rule in enumerate(rules) for variant in rule.variants)
+
+        terms = sorted({term for rule in rules for term in rule.target_any + rule.target_all})
+        term_ids = {term: i for i, term in enumerate(terms)}
+        self._terms = AhoCorasick(term_ids.items())
+        self._target_any = [frozenset(term_ids[t] for t in rule.target_any) for rule in rules]
+        self._target_all = [frozenset(term_ids[t] for t in rule.target_all) for rule in rules]
+
+        self._targets_lock = threading.Lock()
+        self._targets_index = None
+        self._targets: List[List[int]] = []
+
+    @classmethod
+    def from_file(cls, path: str) -> 'DrugAliasTable':
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls([AliasRule(rule) for rule in data.get('rules', [])])
+
+    def __len__(self):
+        return len(self.rules)
+
+    def triggered_rules(self, keywords_lower: List[str]) -> List[Tuple[int, str]]:
+        """回傳 (規則編號, 觸發的關鍵字)，依關鍵字順序；每條規則只記錄第一個觸發的關鍵字。"""
+        triggered = {}
+        for keyword in keywords_lower:
+            for rule_id in sorted(self._variants.find(keyword)):
+                if rule_id in triggered:
+                    continue
+                requires_any = self.rules[rule_id].requires_any
+                if not requires_any or any(term in keyword for term in requires_any):
+                    triggered[rule_id] = keyword
+        return list(triggered.items())
+
+    def targets(self, name_index: DrugNameIndex) -> List[List[int]]:
+        """每條規則的目標藥品位置；同一個名稱索引（目錄版本）只解析一次。"""
+        if self._targets_index is name_index:
+            return self._targets
+
+        with self._targets_lock:
+            if self._targets_index is name_index:
+                return self._targets
+
+            targets = [[] for _ in self.rules]
+            for pos, entry in enumerate(name_index.entries):
+                matched_rules = set()
+                # target_all 必須在同一個名稱（中文或英文）中全部出現
+                for name in (entry.zh_lower, entry.en_lower):
+                    found = self._terms.find(name)
+                    if not found:
+                        continue
+                    for rule_id in range(len(self.rules)):
+                        target_all = self._target_all[rule_id]
+                        if (self._target_any[rule_id] & found) or (target_all and target_all <= found):
+                            matched_rules.add(rule_id)
+                for rule_id in matched_rules:
+                    targets[rule_id].append(pos)
+
+            self._targets = targets
+            self._targets_index = name_index
+            print(f"[Smart Filter] 解析別名表目標藥品: {len(self.rules)} 條規則 (版本 {name_index.version})")
+            return targets
+
+    def match(self, name_index: DrugNameIndex, keywords: List[str]) -> AliasMatches:
+        """以一次篩選的全部關鍵字比對別名表，回傳命中的目標藥品。"""
+        matches = AliasMatches()
+        triggered = self.triggered_rules([kw.lower() for kw in keywords])
+        if not triggered:
+            return matches
+
+        originals = {kw.lower(): kw for kw in reversed(keywords)}
+        targets = self.targets(name_index)
+        included = set()
+        for rule_id, keyword_lower in triggered:
+            rule = self.rules[rule_id]
+            keyword = originals.get(keyword_lower, keyword_lower)
+            for pos in targets[rule_id]:
+                if rule.guaranteed and pos not in matches.guaranteed:
+                    matches.guaranteed[pos] = f"guaranteed_{rule.name}_match({keyword})"
+                if rule.score is not None and rule.score > matches.scores.get(pos, (0, ''))[0]:
+                    matches.scores[pos] = (rule.score, f"{rule.name}_special_match({keyword})")
+                if rule.force_include and pos not in included:
+                    included.add(pos)
+                    matches.force_include.append(pos)
+        return matches
+
+
+_table_lock = threading.Lock()
+_table = None
+_table_mtime = None
+
+
+def get_alias_table() -> DrugAliasTable:
+    """
+    取得編譯好的別名表；檔案更新後下一次呼叫會自動重新編譯。
+    檔案不存在或格式錯誤時回傳空表，篩選仍可正常運作。
+    """
+    global _table, _table_mtime
+    try:
+        mtime = os.path.getmtime(ALIAS_FILE)
+    except OSError:
+        mtime = None
+
+    if _table is not None and mtime == _table_mtime:
+        return _table
+
+    with _table_lock:
+        if _table is not None and mtime == _table_mtime:
+            return _table
+        try:
+            table = DrugAliasTable.from_file(ALIAS_FILE)
+            print(f"[Smart Filter] 載入別名表: {len(table)} 條規則")
+        except Exception as e:
+            print(f"[Smart Filter] 載入別名表失敗: {e}")
+            table = DrugAliasTable([])
+        _table, _table_mtime = table, mtime
+        return table
@@ -0,0 +1,270 @@
+# app/services/drug_catalog.py
+
+import bisect
+import threading
+import time
+from typing import Dict, List, Optional
+
+from config import Config
+from ..utils.db_pool import pooled_connection
+
+# 目錄中保存的完整欄位（藥單分析與藥丸辨識共用）
+CATALOG_COLUMNS = "drug_id, drug_name_zh, drug_name_en, main_use, side_effects, shape, color, food_drug_interactions, image_url"
+# 藥單分析（smart filter / prompt）只需要的欄位
+ANALYSIS_FIELDS = ('drug_id', 'drug_name_zh', 'drug_name_en', 'main_use', 'side_effects')
+
+
+class _Snapshot:
+    """某一版本目錄的不可變快照；更新時整份替換，讀取端不需加鎖。"""
+
+    def __init__(self, rows_by_id: Dict[str, dict], version: int):
+        self.version = version
+        self.rows_by_id = rows_by_id
+        self.ordered_ids = sorted(rows_by_id)
+        self.rows = [rows_by_id[drug_id] for drug_id in self.ordered_ids]
+        # 藥單分析用的精簡列，每個版本只建立一次
+        self.analysis_rows = [{field: row.get(field) for field in ANALYSIS_FIELDS} for row in self.rows]
+        # drug_id LIKE 'prefix%' 在 MySQL 預設 collation 下不分大小寫
+        self.lower_ids = [str(drug_id).lower() for drug_id in self.ordered_ids]
+        self.lower_order = sorted(range(len(self.lower_ids)), key=lambda i: self.lower_ids[i])
+        self.sorted_lower_ids = [self.lower_ids[i] for i in self.lower_order]
+
+
+class DrugCatalog:
+    """
+    行程內共用的 drug_info 目錄。
+
+    - 首次使用時整表載入一次，之後每 refresh_interval 秒做一次輕量探測：
+      若資料表有 updated_at 欄位，只撈取 watermark 之後變動的列；
+      否則比對筆數，並每 full_reload_interval 秒整表重載一次。
+    - DB.add_drug_info 寫入後呼叫 invalidate(drug_id)，下一次讀取只重撈該藥品。
+    - 內容有變動時 version 遞增，供名稱索引、分析快取等以版本為鍵失效。
+    """
+
+    def __init__(self, refresh_interval: float = 300, full_reload_interval: float = 3600):
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+
+        self._snapshot: Optional[_Snapshot] = None
+        self._refresh_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._pending_ids = set()
+        self._needs_full_reload = True
+        self._has_updated_at = None
+        self._watermark = None
+        self._last_check = 0.0
+        self._last_full_load = 0.0
+        self._listeners = []
+        self._stats = {'full_loads': 0, 'incremental_refreshes': 0, 'rows_refreshed': 0, 'last_load_time': 0.0}
+
+    # --- 讀取 API（皆為唯讀，請勿修改回傳的 dict） ---
+
+    @property
+    def version(self) -> int:
+        snapshot = self._ensure_fresh()
+        return snapshot.version if snapshot else 0
+
+    def get_all(self) -> List[dict]:
+        """回傳全部藥品（完整欄位），依 drug_id 排序。"""
+        snapshot = self._ensure_fresh()
+        return snapshot.rows if snapshot else []
+
+    def get_analysis_rows(self) -> List[dict]:
+        """回傳藥單分析用的精簡藥品列表（drug_id、中英文名、用途、副作用）。"""
+        snapshot = self._ensure_fresh()
+        return snapshot.analysis_rows if snapshot else []
+
+    def get_by_ids(self, drug_ids) -> List[dict]:
+        """依 drug_id 查詢，結果依 drug_id 排序（與原本 IN 查詢一致）。"""
+        snapshot = self._ensure_fresh()
+        if not snapshot:
+            return []
+        found = {str(d) for d in drug_ids if d is not None and str(d) in snapshot.rows_by_id}
+        return [snapshot.rows_by_id[d] for d in sorted(found)]
+
+    def get_by_prefix(self, prefix: str) -> List[dict]:
+        """依 drug_id 前綴查詢（不分大小寫），結果依 drug_id 排序。"""
+        snapshot = self._ensure_fresh()
+        if not snapshot or not prefix:
+            return []
+        prefix = str(prefix).lower()
+        start = bisect.bisect_left(snapshot.sorted_lower_ids, prefix)
+        matched = []
+        for pos in range(start, len(snapshot.sorted_lower_ids)):
+            if not snapshot.sorted_lower_ids[pos].startswith(prefix):
+                break
+            matched.append(snapshot.lower_order[pos])
+        return [snapshot.rows[i] for i in sorted(matched)]
+
+    # --- 失效與監聽 ---
+
+    def invalidate(self, drug_id=None):
+        """標記目錄需要更新；指定 drug_id 時只重撈該筆，否則下次整表重載。"""
+        with self._state_lock:
+            if drug_id is None:
+                self._needs_full_reload = True
+            else:
+                self._pending_ids.add(str(drug_id))
+
+    def add_listener(self, callback):
+        """註冊版本變動回呼，callback(new_version) 於目錄內容變動後呼叫。"""
+        self._listeners.append(callback)
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        return {
+            'version': snapshot.version if snapshot else 0,
+            'drug_count': len(snapshot.rows) if snapshot else 0,
+            'has_updated_at': self._has_updated_at,
+            **self._stats,
+        }
+
+    def load_rows(self, rows: List[dict]):
+        """直接以給定資料列取代目錄內容（離線基準測試、本機工具使用）。"""
+        with self._refresh_lock:
+            self._install({str(r['drug_id']): r for r in rows})
+            with self._state_lock:
+                self._needs_full_reload = False
+                self._pending_ids.clear()
+            self._last_check = self._last_full_load = time.monotonic()
+            # 沒有資料庫時不做週期性探測
+            self.refresh_interval = float('inf')
+
+    # --- 內部實作 ---
+
+    def _ensure_fresh(self) -> Optional[_Snapshot]:
+        now = time.monotonic()
+        with self._state_lock:
+            due = (self._needs_full_reload or bool(self._pending_ids)
+                   or now - self._last_check >= self.refresh_interval)
+        if not due:
+            return self._snapshot
+
+        if self._snapshot is None:
+            # 第一次載入：其他執行緒需要等待
+            with self._refresh_lock:
+                if self._snapshot is None or self._needs_full_reload:
+                    self._safe_refresh()
+            return self._snapshot
+
+        # 已有快照：由一個執行緒負責更新，其他執行緒直接使用舊快照
+        if self._refresh_lock.acquire(blocking=False):
+            try:
+                self._safe_refresh()
+            finally:
+                self._refresh_lock.release()
+        return self._snapshot
+
+    def _safe_refresh(self):
+        try:
+            self._refresh()
+        except Exception as e:
+            print(f"[Drug Catalog] 更新目錄失敗: {e}")
+            # 避免資料庫異常時每個請求都重試
+            self._last_check = time.monotonic()
+
+    def _refresh(self):
+        now = time.monotonic()
+        with self._state_lock:
+            full = (self._snapshot is None or self._needs_full_reload
+                    or now - self._last_full_load >= self.full_reload_interval)
+            pending = set(self._pending_ids)
+
+        with pooled_connection() as conn:
+            with conn.cursor() as cursor:
+                if self._has_updated_at is None:
+                    cursor.execute("SHOW COLUMNS FROM drug_info LIKE 'updated_at'")
+                    self._has_updated_at = cursor.fetchone() is not None
+
+                if full:
+                    self._full_load(cursor)
+                else:
+                    self._incremental_load(cursor, pending)
+
+        with self._state_lock:
+            if full:
+                self._needs_full_reload = False
+            self._pending_ids -= pending
+            self._last_check = time.monotonic()
+
+    def _full_load(self, cursor):
+        start = time.time()
+        extra = ", updated_at" if self._has_updated_at else ""
+        cursor.execute(f"SELECT {CATALOG_COLUMNS}{extra} FROM drug_info ORDER BY drug_id")
+        rows = cursor.fetchall()
+        if self._has_updated_at:
+            updated = [r.pop('updated_at', None) for r in rows]
+            self._watermark = max((u for u in updated if u), default=None)
+        rows_by_id = {str(r['drug_id']): r for r in rows}
+        self._last_full_load = time.monotonic()
+        self._stats['full_loads'] += 1
+        self._stats['last_load_time'] = time.time() - start
+        if self._snapshot is not None and self._snapshot.rows_by_id == rows_by_id:
+            # 內容沒有變動：保留原快照與版本號，不觸發快取清除與索引重建
+            print(f"[Drug Catalog] 重新載入 {len(rows)} 種藥物，內容未變動 (版本 {self._snapshot.version})")
+            return
+        self._install(rows_by_id)
+        print(f"[Drug Catalog] 載入全部 {len(rows)} 種藥物 (版本 {self._snapshot.version})，耗時: {self._stats['last_load_time']:.4f}s")
+
+    def _incremental_load(self, cursor, pending_ids):
+        snapshot = self._snapshot
+        changed = {}
+
+        if pending_ids:
+            placeholders = ', '.join(['%s'] * len(pending_ids))
+            cursor.execute(f"SELECT {CATALOG_COLUMNS} FROM drug_info WHERE drug_id IN ({placeholders})", list(pending_ids))
+            for row in cursor.fetchall():
+                changed[str(row['drug_id'])] = row
+
+        if self._has_updated_at:
+            cursor.execute("SELECT COUNT(*) AS cnt, MAX(updated_at) AS max_updated FROM drug_info")
+            probe = cursor.fetchone() or {}
+            if self._watermark is not None and probe.get('max_updated') and probe['max_updated'] > self._watermark:
+                cursor.execute(f"SELECT {CATALOG_COLUMNS}, updated_at FROM drug_info WHERE updated_at > %s", (self._watermark,))
+                for row in cursor.fetchall():
+                    self._watermark = max(self._watermark, row.pop('updated_at'))
+                    changed[str(row['drug_id'])] = row
+        else:
+            cursor.execute("SELECT COUNT(*) AS cnt FROM drug_info")
+            probe = cursor.fetchone() or {}
+
+        merged_count = len(set(snapshot.rows_by_id) | set(changed))
+        changed = {drug_id: row for drug_id, row in changed.items() if snapshot.rows_by_id.get(drug_id) != row}
+        if probe.get('cnt') is not None and probe['cnt'] != merged_count:
+            # 有刪除或無法偵測的新增，直接整表重載
+            self._full_load(cursor)
+            return
+
+        if changed:
+            rows_by_id = dict(snapshot.rows_by_id)
+            rows_by_id.update(changed)
+            self._install(rows_by_id)
+            self._stats['incremental_refreshes'] += 1
+            self._stats['rows_refreshed'] += len(changed)
+            print(f"[Drug Catalog] 增量更新 {len(changed)} 種藥物 (版本 {self._snapshot.version})")
+
+    def _install(self, rows_by_id: Dict[str, dict]):
+        version = (self._snapshot.version if self._snapshot else 0) + 1
+        self._snapshot = _Snapshot(rows_by_id, version)
+        for callback in list(self._listeners):
+            try:
+                callback(version)
+            except Exception as e:
+                print(f"[Drug Catalog] 版本變動回呼失敗: {e}")
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> DrugCatalog:
+    """取得行程內共用的藥品目錄。"""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = DrugCatalog(
+                    refresh_interval=Config.DRUG_CATALOG_REFRESH_SECONDS,
+                    full_reload_interval=Config.DRUG_CATALOG_FULL_RELOAD_SECONDS,
+                )
+    return _catalog
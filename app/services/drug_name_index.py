@@ -0,0 +1,149 @@
+# app/services/drug_name_index.py
+
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Set
+
+_DOSE_PATTERN = re.compile(r'\d+\.?\d*\s*mg|tablets?|capsules?', flags=re.IGNORECASE)
+_SPLIT_PATTERN = re.compile(r'[_\-\s"\'\.]+')
+_NORMALIZE_TABLE = str.maketrans('', '', '_- "\'.()[],')
+
+# smart_filter_drugs 方法4 的相似度門檻；只有可能達到門檻的藥名才需要計算 ratio()
+SIMILARITY_THRESHOLD = 0.6
+
+
+def normalize_drug_name(name):
+    """標準化藥物名稱，移除特殊字符和空格"""
+    if not name:
+        return ""
+    # 轉為小寫並移除各種特殊字符
+    return name.lower().translate(_NORMALIZE_TABLE)
+
+
+def extract_drug_components(name):
+    """提取藥物名稱的主要組成部分"""
+    if not name:
+        return []
+
+    # 移除劑量信息 (如 0.125MG, 10mg 等)
+    name_clean = _DOSE_PATTERN.sub('', name)
+
+    # 按常見分隔符分割，忽略單字符
+    return [part.strip().lower() for part in _SPLIT_PATTERN.split(name_clean) if part.strip() and len(part.strip()) > 1]
+
+
+def only_alnum(text):
+    return ''.join(c for c in text if c.isalnum())
+
+
+def only_alpha(text):
+    return ''.join(c for c in text if c.isalpha())
+
+
+class DrugNameEntry:
+    """單一藥品名稱的各種預先計算形式（中英文各一份）。"""
+
+    __slots__ = (
+        'drug', 'zh_lower', 'en_lower', 'zh_norm', 'en_norm',
+        'zh_components', 'en_components', 'zh_alnum', 'en_alnum',
+        'zh_alpha', 'en_alpha',
+    )
+
+    def __init__(self, drug: dict):
+        drug_zh = drug.get('drug_name_zh', '') or ''
+        drug_en = drug.get('drug_name_en', '') or ''
+        self.drug = drug
+        self.zh_lower = drug_zh.lower()
+        self.en_lower = drug_en.lower()
+        self.zh_norm = normalize_drug_name(drug_zh)
+        self.en_norm = normalize_drug_name(drug_en)
+        self.zh_components = extract_drug_components(drug_zh)
+        self.en_components = extract_drug_components(drug_en)
+        self.zh_alnum = only_alnum(self.zh_lower)
+        self.en_alnum = only_alnum(self.en_lower)
+        self.zh_alpha = only_alpha(self.zh_lower)
+        self.en_alpha = only_alpha(self.en_lower)
+
+
+class DrugNameIndex:
+    """
+    藥品名稱索引：每個目錄版本只建立一次，
+    smart_filter_drugs 的評分迴圈直接讀取預先計算好的名稱形式。
+
+    另外建立字元倒排索引，相似度比對（方法4）只對可能達到門檻的藥名計算 difflib ratio。
+    每個藥名以 slot 表示：slot = 位置 * 2（中文名）或 位置 * 2 + 1（英文名）。
+    """
+
+    def __init__(self, all_drugs: List[Dict], version=None):
+        self.version = version
+        self.drugs = all_drugs
+        self.entries = [DrugNameEntry(drug) for drug in all_drugs]
+
+        # (字元, 第幾次出現) -> slots；同一字元出現 n 次的藥名會出現在 n 個 posting 中，
+        # 累加後即為關鍵字與藥名的字元多重集合交集大小
+        self._postings: Dict[tuple, List[int]] = {}
+        self._slot_lengths: List[int] = []
+        for pos, entry in enumerate(self.entries):
+            for slot, name in ((pos * 2, entry.zh_lower), (pos * 2 + 1, entry.en_lower)):
+                self._slot_lengths.append(len(name))
+                seen = Counter()
+                for char in name:
+                    seen[char] += 1
+                    self._postings.setdefault((char, seen[char]), []).append(slot)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def similarity_candidates(self, keyword_lower: str) -> Set[int]:
+        """
+        回傳 difflib ratio 可能達到門檻的藥名 slot。
+
+        SequenceMatcher.ratio() 不會超過 quick_ratio()（字元多重集合交集 * 2 / 總長度），
+        這裡用倒排索引一次算出所有藥名的 quick_ratio，因此不會遺漏任何達到門檻的藥名。
+        """
+        overlap = Counter()
+        for char, count in Counter(keyword_lower).items():
+            for occurrence in range(1, count + 1):
+                postings = self._postings.get((char, occurrence))
+                if not postings:
+                    break
+                overlap.update(postings)
+
+        keyword_length = len(keyword_lower)
+        lengths = self._slot_lengths
+        return {
+            slot for slot, matches in overlap.items()
+            if 2.0 * matches / (keyword_length + lengths[slot]) >= SIMILARITY_THRESHOLD
+        }
+
+    def stats(self) -> dict:
+        return {
+            'drug_count': len(self.entries),
+            'posting_count': len(self._postings),
+            'version': self.version,
+        }
+
+
+_cache_lock = threading.Lock()
+_cached_index = None
+
+
+def get_drug_name_index(all_drugs: List[Dict], version=None) -> DrugNameIndex:
+    """
+    取得 all_drugs 對應的名稱索引。
+    同一份藥品列表（同一目錄版本）只會建立一次索引。
+    """
+    global _cached_index
+    cached = _cached_index
+    if cached is not None and cached.drugs is all_drugs and (version is None or cached.version == version):
+        return cached
+
+    with _cache_lock:
+        cached = _cached_index
+        if cached is not None and cached.drugs is all_drugs and (version is None or cached.version == version):
+            return cached
+        index = DrugNameIndex(all_drugs, version)
+        _cached_index = index
+        print(f"[Smart Filter] 建立藥品名稱索引: {len(index)} 種藥物 (版本 {version})")
+        return index
@@ -0,0 +1,59 @@
+# app/services/drug_shortlist.py
+
+import threading
+from typing import Dict, List
+
+from config import Config
+from ..utils.cache import LRUCache
+from ..utils.db import DB
+from .drug_catalog import get_catalog
+
+
+class RecentDrugShortlist:
+    """
+    推測分析用的候選藥物清單：某位成員近期藥單中出現過的藥品。
+
+    藥品 ID 依 (使用者, 成員) 快取一段時間；儲存新藥單時由 invalidate() 清除該成員的快取。
+    回傳的是目前藥品目錄中的分析用欄位，目錄已移除的藥品會被略過。
+    """
+
+    def __init__(self, max_entries=1024, ttl=600, limit=30):
+        self.limit = limit
+        self._cache = LRUCache(max_entries, ttl)
+
+    def get_drug_ids(self, user_id: str, member: str) -> List[str]:
+        key = (user_id, member)
+        drug_ids = self._cache.get(key)
+        if drug_ids is None:
+            drug_ids = DB.get_recent_drug_ids(user_id, member, self.limit)
+            self._cache.set(key, drug_ids)
+        return drug_ids
+
+    def get(self, user_id: str, member: str) -> List[Dict]:
+        drug_ids = set(self.get_drug_ids(user_id, member))
+        if not drug_ids:
+            return []
+        return [row for row in get_catalog().get_analysis_rows() if row['drug_id'] in drug_ids]
+
+    def invalidate(self, user_id: str, member: str):
+        self._cache.delete((user_id, member))
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+_shortlist = None
+_shortlist_lock = threading.Lock()
+
+
+def get_drug_shortlist() -> RecentDrugShortlist:
+    """取得行程內共用的近期藥物候選清單。"""
+    global _shortlist
+    if _shortlist is None:
+        with _shortlist_lock:
+            if _shortlist is None:
+                _shortlist = RecentDrugShortlist(
+                    ttl=Config.SPECULATIVE_SHORTLIST_TTL_SECONDS or None,
+                    limit=Config.SPECULATIVE_SHORTLIST_SIZE,
+                )
+    return _shortlist
@@ -0,0 +1,151 @@
+# app/services/drug_vector_scorer.py
+
+import math
+import threading
+from collections import Counter
+from typing import Dict, List, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy 為選用相依套件，未安裝時 smart_filter_drugs 使用純 Python 評分
+    np = None
+
+from .drug_name_index import DrugNameIndex
+
+# 向量相似度低於此值的藥品不列入候選
+MIN_VECTOR_SIMILARITY = 0.3
+
+
+def is_available() -> bool:
+    return np is not None
+
+
+def char_ngrams(text: str) -> Counter:
+    """字元 1~3-gram（前後補空白以保留詞首詞尾資訊），回傳各 gram 的出現次數。"""
+    if not text:
+        return Counter()
+    padded = f' {text} '
+    grams = Counter(text)
+    for n in (2, 3):
+        grams.update(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return grams
+
+
+class DrugVectorScorer:
+    """
+    以 NumPy 批次計算「所有關鍵字 × 所有藥名」的 TF-IDF 字元 n-gram 餘弦相似度。
+
+    藥名向量每個目錄版本只建立一次，以 CSC 形式（每個 gram 一段 slot/weight 陣列）保存；
+    一次請求的全部關鍵字組成查詢矩陣後，用單次 bincount 完成稀疏矩陣乘法，
+    再以 argpartition 取出每個關鍵字的前 k 名。
+    slot 的定義與 DrugNameIndex 相同：位置 * 2 為中文名，位置 * 2 + 1 為英文名。
+    """
+
+    def __init__(self, name_index: DrugNameIndex):
+        if np is None:
+            raise RuntimeError("numpy 未安裝，無法使用向量評分")
+        self.name_index = name_index
+        self.slot_count = len(name_index.entries) * 2
+
+        slot_grams = []
+        document_frequency = Counter()
+        for entry in name_index.entries:
+            for name in (entry.zh_lower, entry.en_lower):
+                grams = char_ngrams(name)
+                slot_grams.append(grams)
+                document_frequency.update(grams.keys())
+
+        self.vocabulary: Dict[str, int] = {gram: col for col, gram in enumerate(document_frequency)}
+        self.idf = np.array(
+            [math.log((1 + self.slot_count) / (1 + document_frequency[gram])) + 1 for gram in self.vocabulary],
+            dtype=np.float32,
+        )
+
+        columns, slots, counts = [], [], []
+        vocabulary = self.vocabulary
+        for slot, grams in enumerate(slot_grams):
+            columns.extend(vocabulary[gram] for gram in grams)
+            slots.extend([slot] * len(grams))
+            counts.extend(grams.values())
+
+        columns = np.array(columns, dtype=np.int64)
+        slots = np.array(slots, dtype=np.int64)
+        weights = np.array(counts, dtype=np.float32) * self.idf[columns]
+        # 每個藥名向量做 L2 正規化
+        norms = np.sqrt(np.bincount(slots, weights=weights * weights, minlength=self.slot_count))
+        weights /= norms[slots]
+
+        order = np.argsort(columns, kind='stable')
+        self._slots = slots[order]
+        self._weights = weights[order].astype(np.float32)
+        self._column_ptr = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(columns, minlength=len(self.vocabulary)), out=self._column_ptr[1:])
+
+    def similarity_matrix(self, keywords_lower: List[str]):
+        """回傳 (關鍵字數 × 藥品數) 的相似度矩陣；每個藥品取中英文名中較高者。"""
+        # 目錄中沒有的 gram（df = 0）仍計入查詢向量長度，避免 OCR 雜訊字元拉高相似度
+        unseen_idf = math.log(1 + self.slot_count) + 1
+        rows, cols, query_weights = [], [], []
+        for row, keyword in enumerate(keywords_lower):
+            weighted = []
+            norm = 0.0
+            for gram, count in char_ngrams(keyword).items():
+                col = self.vocabulary.get(gram)
+                weight = count * (float(self.idf[col]) if col is not None else unseen_idf)
+                norm += weight * weight
+                if col is not None:
+                    weighted.append((col, weight))
+            for col, weight in weighted:
+                rows.append(row)
+                cols.append(col)
+                query_weights.append(weight / math.sqrt(norm))
+
+        scores = np.zeros(len(keywords_lower) * self.slot_count, dtype=np.float32)
+        if rows:
+            starts = self._column_ptr[cols]
+            lengths = self._column_ptr[np.array(cols) + 1] - starts
+            # 展開每個 (關鍵字, gram) 對應的 posting 區段
+            repeat_rows = np.repeat(np.array(rows, dtype=np.int64), lengths)
+            repeat_query = np.repeat(np.array(query_weights, dtype=np.float32), lengths)
+            offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            positions = np.repeat(starts, lengths) + offsets
+            flat = repeat_rows * self.slot_count + self._slots[positions]
+            scores = np.bincount(flat, weights=repeat_query * self._weights[positions],
+                                 minlength=len(keywords_lower) * self.slot_count).astype(np.float32)
+
+        return scores.reshape(len(keywords_lower), -1, 2).max(axis=2)
+
+    def top_k(self, keywords_lower: List[str], k: int) -> List[List[Tuple[int, float]]]:
+        """每個關鍵字回傳相似度最高的 k 個 (藥品位置, 相似度)，依相似度由高到低排序。"""
+        similarities = self.similarity_matrix(keywords_lower)
+        drug_count = similarities.shape[1]
+        results = []
+        for row in similarities:
+            if drug_count > k:
+                top = np.argpartition(-row, k)[:k]
+            else:
+                top = np.arange(drug_count)
+            top = top[np.argsort(-row[top], kind='stable')]
+            results.append([(int(pos), float(row[pos])) for pos in top if row[pos] >= MIN_VECTOR_SIMILARITY])
+        return results
+
+
+_cache_lock = threading.Lock()
+_cached_scorer = None
+
+
+def get_vector_scorer(name_index: DrugNameIndex) -> DrugVectorScorer:
+    """取得 name_index 對應的向量評分器；同一個名稱索引只建立一次。"""
+    global _cached_scorer
+    cached = _cached_scorer
+    if cached is not None and cached.name_index is name_index:
+        return cached
+
+    with _cache_lock:
+        cached = _cached_scorer
+        if cached is not None and cached.name_index is name_index:
+            return cached
+        scorer = DrugVectorScorer(name_index)
+        _cached_scorer = scorer
+        print(f"[Smart Filter] 建立藥品向量索引: {len(name_index)} 種藥物, {len(scorer.vocabulary)} 個 n-gram")
+        return scorer
@@ -0,0 +1,242 @@
+# app/services/gemini_gateway.py
+
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+from google import genai
+from google.genai import errors as genai_errors
+
+from config import Config
+
+# 會重試的 HTTP 狀態碼（逾時、限流、伺服器暫時性錯誤）
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_transient_error(error: Exception) -> bool:
+    """判斷是否為值得重試的暫時性錯誤。"""
+    if isinstance(error, genai_errors.APIError):
+        return getattr(error, 'code', None) in RETRYABLE_STATUS_CODES
+    return isinstance(error, (httpx.TimeoutException, httpx.TransportError, ConnectionError, TimeoutError))
+
+
+class _FairSemaphore:
+    """依到達順序（FIFO）放行的計數號誌，避免大量上傳時後到的請求插隊。"""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._cond = threading.Condition()
+        self._waiters = deque()
+
+    def acquire(self):
+        with self._cond:
+            ticket = object()
+            self._waiters.append(ticket)
+            while self._waiters[0] is not ticket or self._value <= 0:
+                self._cond.wait()
+            self._waiters.popleft()
+            self._value -= 1
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._value += 1
+            self._cond.notify_all()
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+
+class _RateLimiter:
+    """滑動視窗的每分鐘請求數限制；rpm <= 0 表示不限制。"""
+
+    def __init__(self, rpm: int):
+        self.rpm = rpm
+        self._lock = threading.Lock()
+        self._sent = deque()
+
+    def wait(self) -> float:
+        """阻塞到可以送出下一個請求，回傳等待秒數。"""
+        if self.rpm <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= 60:
+                    self._sent.popleft()
+                if len(self._sent) < self.rpm:
+                    self._sent.append(now)
+                    return waited
+                delay = 60 - (now - self._sent[0])
+            time.sleep(delay)
+            waited += delay
+
+
+class GeminiGateway:
+    """
+    所有 Gemini 呼叫的共用出口。
+
+    - 每個 API key 只建立一個長期使用的 genai.Client
+    - 同時進行中的請求數受 max_concurrency 限制，並依到達順序排隊
+    - 每分鐘請求數受 rpm_limit 限制
+    - 暫時性錯誤（429 / 5xx / 連線逾時）以指數退避 + 隨機抖動重試
+    - 依階段（ocr、analysis...）統計呼叫次數、token 與延遲
+    """
+
+    def __init__(self, max_concurrency=4, rpm_limit=60, max_retries=3, backoff_base=1.0, backoff_max=20.0,
+                 client_factory=None):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._client_factory = client_factory or (lambda api_key: genai.Client(api_key=api_key))
+
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._semaphore = _FairSemaphore(max_concurrency)
+        self._rate_limiter = _RateLimiter(rpm_limit)
+        self._stats_lock = threading.Lock()
+        self._stage_stats = {}
+
+    def set_client_factory(self, client_factory):
+        """替換建立 client 的方式（離線基準測試使用假 client），並清除已建立的 client。"""
+        with self._clients_lock:
+            self._client_factory = client_factory
+            self._clients.clear()
+
+    def get_client(self, api_key: str):
+        client = self._clients.get(api_key)
+        if client is None:
+            with self._clients_lock:
+                client = self._clients.get(api_key)
+                if client is None:
+                    client = self._client_factory(api_key)
+                    self._clients[api_key] = client
+        return client
+
+    def generate_content(self, api_key: str, stage: str, model: str, contents, config=None):
+        """
+        經由閘道呼叫 client.models.generate_content。
+        重試次數用盡或遇到非暫時性錯誤時拋出最後一次的例外。
+        """
+        client = self.get_client(api_key)
+        queued_at = time.monotonic()
+        self._semaphore.acquire()
+        try:
+            rate_wait = self._rate_limiter.wait()
+            wait_time = time.monotonic() - queued_at
+            attempt = 0
+            while True:
+                call_start = time.monotonic()
+                try:
+                    response = client.models.generate_content(model=model, contents=contents, config=config)
+                except Exception as e:
+                    if attempt >= self.max_retries or not is_transient_error(e):
+                        self._record(stage, time.monotonic() - call_start, wait_time, rate_wait, attempt, error=True)
+                        raise
+                    attempt += 1
+                    rate_wait += self._backoff(stage, attempt, e)
+                    continue
+                self._record(stage, time.monotonic() - call_start, wait_time, rate_wait, attempt,
+                             usage=getattr(response, 'usage_metadata', None))
+                return response
+        finally:
+            self._semaphore.release()
+
+    def generate_content_stream(self, api_key: str, stage: str, model: str, contents, config=None):
+        """
+        經由閘道呼叫 client.models.generate_content_stream，逐一 yield 回應片段。
+        只有在尚未收到任何片段前發生暫時性錯誤才會重試；串流結束（或呼叫端關閉產生器）時釋放名額。
+        """
+        client = self.get_client(api_key)
+        queued_at = time.monotonic()
+        self._semaphore.acquire()
+        try:
+            rate_wait = self._rate_limiter.wait()
+            wait_time = time.monotonic() - queued_at
+            attempt = 0
+            while True:
+                call_start = time.monotonic()
+                usage = None
+                received = False
+                try:
+                    for chunk in client.models.generate_content_stream(model=model, contents=contents, config=config):
+                        received = True
+                        usage = getattr(chunk, 'usage_metadata', None) or usage
+                        yield chunk
+                except Exception as e:
+                    if received or attempt >= self.max_retries or not is_transient_error(e):
+                        self._record(stage, time.monotonic() - call_start, wait_time, rate_wait, attempt, error=True)
+                        raise
+                    attempt += 1
+                    rate_wait += self._backoff(stage, attempt, e)
+                    continue
+                self._record(stage, time.monotonic() - call_start, wait_time, rate_wait, attempt, usage=usage)
+                return
+        finally:
+            self._semaphore.release()
+
+    def _backoff(self, stage, attempt, error) -> float:
+        """指數退避 + 隨機抖動後重新等待限流名額，回傳限流等待秒數。"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+        print(f"[Gemini Gateway] {stage} 暫時性錯誤，{delay:.2f}s 後第 {attempt} 次重試: {error}")
+        time.sleep(delay)
+        return self._rate_limiter.wait()
+
+    def _record(self, stage, latency, wait_time, rate_wait, retries, usage=None, error=False):
+        with self._stats_lock:
+            stats = self._stage_stats.setdefault(stage, {
+                'calls': 0, 'errors': 0, 'retries': 0,
+                'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0,
+                'total_latency': 0.0, 'max_latency': 0.0, 'total_wait': 0.0, 'rate_limit_wait': 0.0,
+            })
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['retries'] += retries
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['total_wait'] += wait_time
+            stats['rate_limit_wait'] += rate_wait
+            if usage:
+                stats['prompt_tokens'] += getattr(usage, 'prompt_token_count', 0) or 0
+                stats['completion_tokens'] += getattr(usage, 'candidates_token_count', 0) or 0
+                stats['total_tokens'] += getattr(usage, 'total_token_count', 0) or 0
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stages = {}
+            for stage, stats in self._stage_stats.items():
+                calls = stats['calls']
+                stages[stage] = {
+                    **stats,
+                    'avg_latency': round(stats['total_latency'] / calls, 4) if calls else 0.0,
+                    'avg_wait': round(stats['total_wait'] / calls, 4) if calls else 0.0,
+                }
+        return {
+            'clients': len(self._clients),
+            'max_concurrency': self.max_concurrency,
+            'rpm_limit': self._rate_limiter.rpm,
+            'queued': self._semaphore.waiting(),
+            'stages': stages,
+        }
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gemini_gateway() -> GeminiGateway:
+    """取得行程內共用的 Gemini 閘道。"""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = GeminiGateway(
+                    max_concurrency=Config.GEMINI_MAX_CONCURRENCY,
+                    rpm_limit=Config.GEMINI_RPM_LIMIT,
+                    max_retries=Config.GEMINI_MAX_RETRIES,
+                )
+    return _gateway
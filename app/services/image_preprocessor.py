@@ -0,0 +1,109 @@
+# app/services/image_preprocessor.py
+
+import concurrent.futures
+import io
+import threading
+import time
+from typing import List, Tuple
+
+from PIL import Image, ImageOps
+
+from config import Config
+
+# EXIF 方向標籤
+_EXIF_ORIENTATION = 0x0112
+
+
+def preprocess_image(image_bytes: bytes, max_edge: int = 1600, grayscale: bool = False, quality: int = 85) -> bytes:
+    """
+    送往 Gemini 前的單張圖片前處理：
+    依 EXIF 方向轉正 → 長邊縮到 max_edge 以內 →（選用）轉灰階 → 以指定品質重新編碼為 JPEG。
+
+    圖片沒有任何變動且重新編碼反而變大時回傳原始資料；無法解碼時也回傳原始資料。
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            # exif_transpose 一律回傳複本，需轉正與否以 EXIF 方向標籤（1 表示不需旋轉）判斷
+            changed = img.getexif().get(_EXIF_ORIENTATION, 1) != 1
+            img = ImageOps.exif_transpose(img)
+
+            if max_edge and max(img.size) > max_edge:
+                img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+                changed = True
+
+            if grayscale and img.mode != 'L':
+                img = img.convert('L')
+                changed = True
+            elif img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+
+            output = io.BytesIO()
+            img.save(output, format='JPEG', quality=quality, optimize=True)
+            processed = output.getvalue()
+    except Exception as e:
+        print(f"[Image Preprocess] 圖片前處理失敗，使用原圖: {e}")
+        return image_bytes
+
+    if not changed and len(processed) >= len(image_bytes):
+        return image_bytes
+    return processed
+
+
+def _timed_preprocess(image_bytes: bytes, **options) -> Tuple[bytes, float]:
+    start = time.time()
+    return preprocess_image(image_bytes, **options), time.time() - start
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=Config.IMAGE_PREPROCESS_WORKERS,
+                    thread_name_prefix='image-preprocess',
+                )
+    return _executor
+
+
+def preprocess_images(image_bytes_list: List[bytes]) -> Tuple[List[bytes], dict]:
+    """
+    以執行緒池平行處理同一個請求的所有圖片（Pillow 的縮放與編碼會釋放 GIL）。
+    回傳與輸入順序相同的處理後圖片，以及位元組數與耗時統計（含每張圖片的處理時間）。
+    """
+    start = time.time()
+    original_bytes = sum(len(b) for b in image_bytes_list)
+
+    if not Config.IMAGE_PREPROCESS_ENABLED or not image_bytes_list:
+        processed_list = list(image_bytes_list)
+        per_image_times = [0.0] * len(image_bytes_list)
+    else:
+        options = dict(
+            max_edge=Config.IMAGE_MAX_EDGE,
+            grayscale=Config.IMAGE_GRAYSCALE,
+            quality=Config.IMAGE_JPEG_QUALITY,
+        )
+        if len(image_bytes_list) == 1:
+            results = [_timed_preprocess(image_bytes_list[0], **options)]
+        else:
+            futures = [_get_executor().submit(_timed_preprocess, b, **options) for b in image_bytes_list]
+            results = [f.result() for f in futures]
+        processed_list = [processed for processed, _ in results]
+        per_image_times = [elapsed for _, elapsed in results]
+
+    processed_bytes = sum(len(b) for b in processed_list)
+    stats = {
+        'enabled': Config.IMAGE_PREPROCESS_ENABLED,
+        'original_bytes': original_bytes,
+        'processed_bytes': processed_bytes,
+        'reduction_ratio': round(1 - processed_bytes / original_bytes, 4) if original_bytes else 0.0,
+        'processing_time': time.time() - start,
+        'per_image_times': per_image_times,
+    }
+    print(f"[Image Preprocess] {len(image_bytes_list)} 張圖片: {original_bytes} → {processed_bytes} bytes "
+          f"(減少 {stats['reduction_ratio']:.1%})，耗時 {stats['processing_time']:.4f}s")
+    return processed_list, stats
@@ -0,0 +1,65 @@
+# app/services/ocr_cache.py
+
+import hashlib
+import threading
+from typing import List, Optional
+
+from config import Config
+from ..utils.cache import DiskCache, LRUCache, TieredCache
+
+# OCR 關鍵字擷取使用的模型；修改 OCR prompt 內容時請一併更新版本號，讓舊快取自動失效
+OCR_MODEL = "gemini-2.5-flash"
+OCR_PROMPT_VERSION = "1"
+
+
+def image_sha256(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class OcrKeywordCache:
+    """
+    OCR 關鍵字快取：以圖片內容 SHA-256 + 模型 + prompt 版本為鍵，
+    保存擷取到的關鍵字與當次使用的 token 數。
+
+    單張圖片以自己的雜湊為鍵；多張圖片一起送出的批次結果無法拆回各張圖片，
+    以依序排列的雜湊組合為鍵。
+    """
+
+    def __init__(self, max_entries=512, ttl=None, disk_dir=None):
+        disk = DiskCache(disk_dir, ttl) if disk_dir else None
+        self._cache = TieredCache(LRUCache(max_entries, ttl), disk)
+
+    @staticmethod
+    def _key(image_hashes: List[str], prompt: str) -> str:
+        return f"ocr:{OCR_MODEL}:{prompt}-v{OCR_PROMPT_VERSION}:{'+'.join(image_hashes)}"
+
+    def get(self, image_hashes: List[str], prompt: str) -> Optional[dict]:
+        """回傳 {'keywords': [...], 'tokens': int}，沒有快取時回傳 None。"""
+        return self._cache.get(self._key(image_hashes, prompt))
+
+    def set(self, image_hashes: List[str], prompt: str, keywords: List[str], tokens: int):
+        self._cache.set(self._key(image_hashes, prompt), {'keywords': list(keywords), 'tokens': tokens})
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+_ocr_cache = None
+_ocr_cache_lock = threading.Lock()
+
+
+def get_ocr_cache() -> OcrKeywordCache:
+    """取得行程內共用的 OCR 關鍵字快取。"""
+    global _ocr_cache
+    if _ocr_cache is None:
+        with _ocr_cache_lock:
+            if _ocr_cache is None:
+                _ocr_cache = OcrKeywordCache(
+                    max_entries=Config.OCR_CACHE_SIZE,
+                    ttl=Config.OCR_CACHE_TTL_SECONDS or None,
+                    disk_dir=Config.OCR_CACHE_DIR or None,
+                )
+    return _ocr_cache
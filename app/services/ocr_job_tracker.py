@@ -0,0 +1,214 @@
+# app/services/ocr_job_tracker.py
+
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import Config
+from ..utils.async_runtime import get_async_runtime
+
+# poll_fn(job_key) 的回傳狀態
+JOB_COMPLETED = 'completed'
+JOB_PENDING = 'pending'
+JOB_FAILED = 'failed'
+JOB_TIMEOUT = 'timeout'
+
+
+class _Job:
+    def __init__(self, key: str, batch: '_Batch', image_index: int, first_poll_at: float, deadline: float):
+        self.key = key
+        self.batch = batch
+        self.image_index = image_index
+        self.attempts = 0
+        self.next_poll_at = first_poll_at
+        self.deadline = deadline
+
+
+class _Batch:
+    """同一次分析送出的一組遠端任務；所有任務完成（或逾時）後呼叫一次 on_complete。"""
+
+    def __init__(self, entries: List[dict], on_complete: Callable[[List[dict]], None]):
+        self.entries = entries
+        self.on_complete = on_complete
+        self.remaining = 0
+        self.started_at = time.time()
+
+
+class OcrJobTracker:
+    """
+    外部 OCR 非同步任務追蹤器。
+
+    送出後尚未完成的遠端任務登記在這裡，由共用事件迴圈上的單一背景協程輪詢：
+    每個任務的輪詢間隔以指數退避加上隨機抖動遞增，超過 timeout 視為逾時。
+    遠端服務支援完成回呼時，回呼端點呼叫 complete() 即可提早結束輪詢。
+    請求執行緒只負責登記，不會為了等待 OCR 結果而 sleep。
+    """
+
+    def __init__(self, poll_fn: Callable[[str], Tuple[str, object]], initial_delay: float = 5.0,
+                 base_interval: float = 2.0, max_interval: float = 30.0, timeout: float = 240.0):
+        self.poll_fn = poll_fn
+        self.initial_delay = initial_delay
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, _Job] = {}
+        self._loop_future = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stats = {'tracked': 0, 'completed': 0, 'failed': 0, 'timed_out': 0, 'polls': 0, 'callbacks': 0}
+
+    # --- 登記與完成 ---
+
+    def track(self, entries: List[dict], pending: Dict[int, str], on_complete: Callable[[List[dict]], None]):
+        """
+        登記一組遠端任務。entries 為逐張圖片的結果（格式同 prescription_service._fan_out_ocr），
+        pending 為 {圖片索引: 任務鍵}；全部完成後以更新過的 entries 呼叫 on_complete（於執行緒池中呼叫）。
+        """
+        batch = _Batch(entries, on_complete)
+        replaced = []
+        now = time.time()
+        with self._lock:
+            for image_index, key in pending.items():
+                if key in self._jobs:
+                    # 遠端以相同的鍵保存結果，舊的請求已拿不到自己的結果
+                    print(f"[OCR Jobs] 任務 {key} 已在追蹤中，改由新的請求接手")
+                    replaced.append(self._resolve_locked(self._jobs[key], JOB_FAILED, None, "已被新的請求取代"))
+                self._jobs[key] = _Job(key, batch, image_index, now + self.initial_delay, now + self.timeout)
+                batch.remaining += 1
+            self._stats['tracked'] += len(pending)
+        print(f"[OCR Jobs] 登記 {len(pending)} 個遠端任務，目前追蹤 {len(self._jobs)} 個")
+        for old_batch in replaced:
+            if old_batch is not None:
+                self._finish(old_batch)
+        self._ensure_loop()
+        self._wake()
+
+    def complete(self, key: str, status: str, data=None, error: str = None) -> bool:
+        """遠端回呼或輪詢得到最終結果時呼叫；任務不存在（已完成或逾時）時回傳 False。"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                return False
+            batch = self._resolve_locked(job, status, data, error)
+        if batch is not None:
+            self._finish(batch)
+        return True
+
+    def record_callback(self):
+        with self._lock:
+            self._stats['callbacks'] += 1
+
+    def _resolve_locked(self, job: _Job, status: str, data, error) -> Optional[_Batch]:
+        """更新任務對應的圖片結果並移除任務；整組完成時回傳該組。呼叫端須持有 _lock。"""
+        del self._jobs[job.key]
+        entry = job.batch.entries[job.image_index]
+        entry['elapsed'] = time.time() - job.batch.started_at
+        if status == JOB_COMPLETED:
+            entry['status'], entry['result'] = 'ok', data
+            self._stats['completed'] += 1
+        else:
+            entry['status'] = 'timeout' if status == JOB_TIMEOUT else 'failed'
+            entry['error'] = error
+            self._stats['timed_out' if status == JOB_TIMEOUT else 'failed'] += 1
+        job.batch.remaining -= 1
+        return job.batch if job.batch.remaining == 0 else None
+
+    def _finish(self, batch: _Batch):
+        runtime = get_async_runtime()
+
+        async def deliver():
+            try:
+                await runtime.run_blocking(batch.on_complete, batch.entries)
+            except Exception as e:
+                print(f"[OCR Jobs] 結果處理失敗: {e}")
+
+        runtime.submit(deliver())
+
+    # --- 背景輪詢 ---
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop_future is not None and not self._loop_future.done():
+                return
+            self._loop_future = get_async_runtime().submit(self._poll_loop())
+
+    def _wake(self):
+        wakeup = self._wakeup
+        if wakeup is not None:
+            get_async_runtime().loop.call_soon_threadsafe(wakeup.set)
+
+    def _next_interval(self, attempts: int) -> float:
+        interval = min(self.max_interval, self.base_interval * (2 ** attempts))
+        return interval * random.uniform(0.5, 1.5)
+
+    async def _poll_loop(self):
+        runtime = get_async_runtime()
+        self._wakeup = asyncio.Event()
+        while True:
+            now = time.time()
+            with self._lock:
+                if not self._jobs:
+                    self._loop_future = None
+                    self._wakeup = None
+                    return
+                expired = [job for job in self._jobs.values() if now >= job.deadline]
+                due = [job for job in self._jobs.values() if job.next_poll_at <= now and now < job.deadline]
+
+            for job in expired:
+                print(f"[OCR Jobs] 任務 {job.key} 超過 {self.timeout:g} 秒未完成")
+                self.complete(job.key, JOB_TIMEOUT, error=f"超過 {self.timeout:g} 秒未完成")
+
+            if due:
+                results = await asyncio.gather(*(runtime.run_blocking(self.poll_fn, job.key) for job in due),
+                                               return_exceptions=True)
+                for job, result in zip(due, results):
+                    with self._lock:
+                        self._stats['polls'] += 1
+                    if isinstance(result, Exception):
+                        status, data = JOB_PENDING, None
+                        print(f"[OCR Jobs] 輪詢 {job.key} 發生錯誤: {result}")
+                    else:
+                        status, data = result
+                    if status == JOB_PENDING:
+                        job.attempts += 1
+                        job.next_poll_at = time.time() + self._next_interval(job.attempts)
+                    else:
+                        self.complete(job.key, status, data if status == JOB_COMPLETED else None,
+                                      None if status == JOB_COMPLETED else str(data))
+                continue
+
+            self._wakeup.clear()
+            with self._lock:
+                wake_at = min((min(job.next_poll_at, job.deadline) for job in self._jobs.values()), default=now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, wake_at - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'pending': len(self._jobs), 'loop_running': self._loop_future is not None, **self._stats}
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_ocr_job_tracker() -> OcrJobTracker:
+    """取得行程內共用的外部 OCR 任務追蹤器（以 PrescriptionService.check_ocr_result 輪詢）。"""
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                from .prescription_service import PrescriptionService
+                _tracker = OcrJobTracker(
+                    poll_fn=PrescriptionService.check_ocr_result,
+                    initial_delay=Config.OCR_POLL_INITIAL_DELAY,
+                    base_interval=Config.OCR_POLL_BASE_INTERVAL,
+                    max_interval=Config.OCR_POLL_MAX_INTERVAL,
+                    timeout=Config.OCR_JOB_TIMEOUT_SECONDS,
+                )
+    return _tracker
@@ -1,24 +1,201 @@
 # --- 請用此版本【完整覆蓋】您的 app/services/prescription_service.py ---
 
-import base64
+import concurrent.futures
+import copy
+import threading
+import time
 import traceback
+from collections import deque
 from ..utils.db import DB
 from .user_service import UserService
 from . import ai_processor
+from .analysis_cache import get_analysis_cache
+from .analysis_merge import merge_into_draft, split_result_by_image
+from .blob_store import get_blob_store
+from .drug_shortlist import get_drug_shortlist
+from .state_store import StateConflictError
+from .ocr_job_tracker import JOB_COMPLETED, JOB_FAILED, JOB_PENDING, get_ocr_job_tracker
 from ..utils.helpers import convert_minguo_to_gregorian
 from flask import current_app
+from urllib.parse import quote, urlencode
+from config import Config
 # 移除不再需要的 line_bot_api 和 flex 導入
 # from app import line_bot_api
 # from ..utils.flex import prescription as flex_prescription
 
+# trigger_analysis 的回傳值：外部 OCR 仍在處理，結果稍後由背景追蹤器存回狀態並通知
+ANALYSIS_PENDING = "pending"
+
+# 存回分析結果時遇到版本衝突的最多嘗試次數
+_STATE_WRITE_ATTEMPTS = 3
+
+_ocr_executor = None
+_ocr_executor_lock = threading.Lock()
+
+
+def _get_ocr_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _ocr_executor
+    if _ocr_executor is None:
+        with _ocr_executor_lock:
+            if _ocr_executor is None:
+                _ocr_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=Config.OCR_MULTI_WORKERS,
+                    thread_name_prefix='ocr-multi',
+                )
+    return _ocr_executor
+
+
+# api_ocr：組員 API 以 line_user_id 保存結果，同一用戶同時只能有一個遠端任務
+# {用戶: 等待中的批次開始函式}；鍵存在表示該用戶有進行中的批次
+_ocr_api_slots = {}
+_ocr_api_slots_lock = threading.Lock()
+
+
+def _acquire_ocr_api_slot(user_key, start) -> bool:
+    """用戶沒有進行中的 api_ocr 批次時佔用並回傳 True；否則把 start 排入等待，輪到時於背景呼叫。"""
+    with _ocr_api_slots_lock:
+        if user_key in _ocr_api_slots:
+            _ocr_api_slots[user_key].append(start)
+            return False
+        _ocr_api_slots[user_key] = deque()
+        return True
+
+
+def _release_ocr_api_slot(user_key):
+    """批次結束時呼叫：有等待中的批次就直接交給它（於執行緒池中開始），否則釋放。"""
+    with _ocr_api_slots_lock:
+        waiting = _ocr_api_slots.get(user_key)
+        if not waiting:
+            _ocr_api_slots.pop(user_key, None)
+            return
+        start = waiting.popleft()
+    _get_ocr_executor().submit(start)
+
+
+def _fan_out_ocr(call, image_bytes_list, log_prefix):
+    """
+    以執行緒池同時對每張圖片呼叫 call(index, image_bytes)，同時進行的數量受 Config.OCR_MULTI_WORKERS 限制。
+    每張圖片從開始執行起超過 Config.OCR_MULTI_TIMEOUT_SECONDS 即視為逾時（背景請求仍會自行結束）。
+    回傳 (依圖片順序的 [{'image', 'status', 'elapsed', 'result', 'usage_info', 'error'}], 實際經過時間)。
+    """
+    timeout = Config.OCR_MULTI_TIMEOUT_SECONDS
+    started = {}
+    fan_out_start = time.time()
+
+    def timed_call(index, image_bytes):
+        started[index] = time.time()
+        return call(index, image_bytes)
+
+    executor = _get_ocr_executor()
+    futures = {executor.submit(timed_call, i, image_bytes): i for i, image_bytes in enumerate(image_bytes_list)}
+    per_image = [{'image': i + 1, 'status': 'timeout', 'elapsed': None, 'result': None, 'usage_info': None, 'error': None}
+                 for i in range(len(image_bytes_list))]
+
+    pending = set(futures)
+    while pending:
+        # 還在排隊、尚未開始執行的圖片不計入逾時
+        wait_for = None
+        if timeout > 0:
+            deadlines = [started[futures[f]] + timeout for f in pending if futures[f] in started]
+            wait_for = min(1.0, max(0.0, min(deadlines) - time.time())) if deadlines else 1.0
+        done, pending = concurrent.futures.wait(pending, timeout=wait_for,
+                                                return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            entry = per_image[futures[future]]
+            entry['elapsed'] = time.time() - started.get(futures[future], fan_out_start)
+            try:
+                entry['result'], entry['usage_info'] = future.result()
+            except Exception as e:
+                entry['status'], entry['error'] = 'failed', str(e)
+                continue
+            entry['status'] = 'ok' if isinstance(entry['result'], dict) else 'failed'
+            if entry['status'] == 'failed' and isinstance(entry['usage_info'], dict):
+                entry['error'] = entry['usage_info'].get('error')
+
+        if timeout > 0:
+            now = time.time()
+            expired = {f for f in pending if futures[f] in started and now - started[futures[f]] >= timeout}
+            for future in expired:
+                entry = per_image[futures[future]]
+                entry['elapsed'] = now - started[futures[future]]
+                entry['error'] = f"超過 {timeout:g} 秒未完成"
+                print(f"{log_prefix} 第 {entry['image']} 張圖片逾時")
+            pending -= expired
+
+    return per_image, time.time() - fan_out_start
+
+
+def _merge_ocr_results(per_image, wall_time, model, version, log_prefix):
+    """
+    依圖片順序合併外部 OCR 的逐張結果，全域資訊取第一個非空值。
+    usage_info 附上逐張狀態、實際經過時間與逐張累計時間；全部失敗時回傳 (None, usage_info)。
+    """
+    combined_result = {
+        "clinic_name": None,
+        "doctor_name": None,
+        "visit_date": None,
+        "days_supply": None,
+        "medications": []
+    }
+    all_medications = []
+
+    for entry in per_image:
+        if entry['status'] != 'ok':
+            print(f"{log_prefix} 第 {entry['image']} 張圖片處理失敗: {entry['error']}")
+            continue
+        result = entry['result']
+        for field in ("clinic_name", "doctor_name", "visit_date", "days_supply"):
+            if not combined_result[field]:
+                combined_result[field] = result.get(field)
+        for med in result.get("medications", []):
+            med["source_image"] = entry['image']  # 標記來源圖片
+            all_medications.append(med)
+
+    combined_result["medications"] = all_medications
+    combined_result["successful_match_count"] = len([med for med in all_medications if med.get('matched_drug_id')])
+
+    succeeded = sum(1 for entry in per_image if entry['status'] == 'ok')
+    summed_call_time = sum(entry['elapsed'] or 0 for entry in per_image)
+    combined_usage_info = {
+        "model": model,
+        "version": version,
+        "execution_time": wall_time,
+        "wall_time": wall_time,
+        "summed_call_time": summed_call_time,
+        "images_processed": len(per_image),
+        "images_succeeded": succeeded,
+        "images_failed": len(per_image) - succeeded,
+        "per_image": [{key: entry[key] for key in ('image', 'status', 'elapsed', 'error')} for entry in per_image],
+        "total_medications": len(all_medications),
+        "api_calls_used": len(per_image),
+        "total_tokens": 0,
+        "token_savings": "100%",
+        "api_status": "success" if succeeded == len(per_image) else ("partial" if succeeded else "failed"),
+        "processing_mode": "concurrent_multi_image",
+        "max_workers": Config.OCR_MULTI_WORKERS,
+    }
+
+    print(f"{log_prefix} 完成處理：{succeeded}/{len(per_image)} 張成功，共識別 {len(all_medications)} 種藥物，"
+          f"實際耗時 {wall_time:.2f}s（逐張累計 {summed_call_time:.2f}s）")
+    if not succeeded:
+        combined_usage_info["error"] = "所有圖片皆處理失敗"
+        return None, combined_usage_info
+    return combined_result, combined_usage_info
+
+
 class PrescriptionService:
     """處理藥單分析與藥歷相關的業務邏輯"""
 
     @staticmethod
-    def trigger_analysis(user_id: str, task_id: str):
+    def trigger_analysis(user_id: str, task_id: str, on_medication=None, on_deferred=None):
         """
         觸發藥單深度分析，並將結果存回狀態。
-        返回 True 表示成功，或拋出異常。
+        返回 True 表示成功；返回 ANALYSIS_PENDING 表示外部 OCR 改為非同步處理，
+        結果會在背景完成後存回狀態並呼叫 on_deferred(user_id, task_id, success)（於 app context 內）。
+        on_medication（選用）：智能分析的串流模式下，每解析出一筆藥物就呼叫一次。
+
+        任務中已有草稿時（使用者加拍頁面），只分析尚未分析過的圖片（以內容雜湊辨識），
+        再把新藥物併入既有草稿，不會覆蓋使用者手動編輯過的內容。
         """
         full_state = UserService.get_user_complex_state(user_id)
         last_task_info = full_state.get("last_task", {})
@@ -26,12 +203,29 @@ class PrescriptionService:
         if not last_task_info or last_task_info.get("task_id") != task_id:
             raise ValueError("找不到對應的分析任務，請重新操作。")
         
-        image_b64_list = last_task_info.get("image_bytes_list", [])
-        if not image_b64_list:
+        all_hashes = last_task_info.get("image_hashes", [])
+        if not all_hashes:
             raise ValueError("分析任務中缺少圖片資料，請重新操作。")
         
         try:
-            image_bytes_list = [base64.b64decode(b64_str) for b64_str in image_b64_list]
+            # 每張圖片的分析結果以內容雜湊保存；有草稿時只送出還沒分析過的圖片
+            image_results = last_task_info.get("image_results") or {}
+            draft = last_task_info.get("results")
+            new_indexes = [i for i, h in enumerate(all_hashes) if h not in image_results]
+            incremental = bool(draft) and len(new_indexes) < len(all_hashes)
+            
+            if incremental and not new_indexes:
+                print(f"[Prescription] 所有 {len(all_hashes)} 張圖片都已分析過，沿用既有草稿")
+                return True
+            
+            target_indexes = new_indexes if incremental else list(range(len(all_hashes)))
+            image_hashes = [all_hashes[i] for i in target_indexes]
+            # 狀態只保存圖片雜湊，圖片本身從 blob store 讀取（只讀這次要分析的圖片）
+            image_bytes_list = get_blob_store().get_many(image_hashes)
+            if any(image_bytes is None for image_bytes in image_bytes_list):
+                raise ValueError("藥單圖片已過期，請重新上傳照片。")
+            if incremental:
+                print(f"[Prescription] 增量分析：{len(all_hashes)} 張圖片中只分析新增的 {len(image_bytes_list)} 張")
             
             api_key = current_app.config['GEMINI_API_KEY']
             db_config = {
@@ -41,30 +235,48 @@ class PrescriptionService:
             }
 
             # 檢查用戶是否選擇了特定的模型
-            user_state = UserService.get_user_complex_state(user_id) or {}
-            selected_model = user_state.get('selected_model', 'smart_filter')
+            selected_model = full_state.get('selected_model', 'smart_filter')
             
             print(f"[Prescription] 分析模型: {selected_model}")
             
-            if selected_model == 'api_ocr':
-                # 使用組員A的 OCR API (Flask - 異步)
+            # 相同圖片、相同模型、相同藥品目錄版本的分析結果直接使用快取（外部 OCR 模型另以用戶與成員區分）
+            member = last_task_info.get("member", "本人")
+            analysis_cache = get_analysis_cache()
+            cached = analysis_cache.get(image_hashes, selected_model, user_id=user_id, member=member)
+            analysis_ctx = {
+                'selected_model': selected_model,
+                'member': member,
+                'cached': cached is not None,
+                'image_hashes': image_hashes,
+                'all_hashes': all_hashes,
+                'target_indexes': target_indexes,
+                'incremental': incremental,
+            }
+            
+            if cached is not None:
+                analysis_result, usage_info = cached
+                usage_info['served_from_cache'] = True
+                print(f"[Analysis Cache] 命中快取，略過 {selected_model} 分析 ({len(image_bytes_list)} 張圖片)")
+            elif selected_model == 'api_ocr':
+                # 使用組員A的 OCR API (Flask - 異步)：只送出任務，需要輪詢的結果交給背景追蹤器
                 print(f"[Prescription] 使用快速識別模式 (Flask)")
                 # 從狀態中獲取成員名稱
                 member_name = last_task_info.get("member", "本人")
-                
-                if len(image_bytes_list) > 1:
-                    print(f"[Prescription] OCR API 多圖處理：將處理 {len(image_bytes_list)} 張圖片")
-                    analysis_result, usage_info = PrescriptionService.call_ocr_api_multiple(
-                        image_bytes_list, 
-                        user_id=user_id, 
-                        member_name=member_name
-                    )
-                else:
-                    analysis_result, usage_info = PrescriptionService.call_ocr_api(
-                        image_bytes_list[0], 
-                        user_id=user_id, 
-                        member_name=member_name
+                multi = len(image_bytes_list) > 1
+                model_name, version = ("ocr_api_multiple", "api_ocr_multi") if multi else ("ocr_api", "api_ocr")
+
+                outcome = PrescriptionService.submit_ocr_api_batch(
+                    image_bytes_list,
+                    user_id=user_id,
+                    member_name=member_name,
+                    on_deferred_complete=PrescriptionService._deferred_ocr_api_handler(
+                        user_id, task_id, analysis_ctx, model_name, version, on_deferred
                     )
+                )
+                if outcome is None:
+                    return ANALYSIS_PENDING
+                per_image, submit_time = outcome
+                analysis_result, usage_info = _merge_ocr_results(per_image, submit_time, model_name, version, "[OCR API]")
             elif selected_model == 'fastapi_ocr':
                 # 使用組員B的 FastAPI OCR (同步)
                 print(f"[Prescription] 使用FastAPI快速識別模式")
@@ -87,18 +299,19 @@ class PrescriptionService:
             else:
                 # 使用智能篩選版 AI 分析（預設）
                 print(f"[Prescription] 使用智能分析模式")
+                # 推測分析（選用）：以該成員近期用藥為候選清單，與關鍵字擷取同時開始完整分析
+                speculative_drugs = None
+                if current_app.config.get('SPECULATIVE_ANALYSIS_ENABLED'):
+                    try:
+                        speculative_drugs = get_drug_shortlist().get(user_id, last_task_info.get("member", "本人"))
+                    except Exception as e:
+                        print(f"[Prescription] 取得近期用藥清單失敗，略過推測分析: {e}")
                 analysis_result, usage_info = ai_processor.run_analysis(
-                    image_bytes_list, db_config, api_key
+                    image_bytes_list, db_config, api_key, speculative_drugs=speculative_drugs,
+                    on_medication=on_medication
                 )
 
-            if not analysis_result or not isinstance(analysis_result, dict) or 'medications' not in analysis_result:
-                error_detail = usage_info.get("error") if isinstance(usage_info, dict) else "未知AI錯誤"
-                raise RuntimeError(f"AI 分析失敗或回傳格式錯誤: {error_detail}")
-
-            last_task_info["results"] = analysis_result
-            full_state["last_task"] = last_task_info
-            UserService.set_user_complex_state(user_id, full_state)
-            
+            PrescriptionService._store_analysis_result(user_id, task_id, analysis_ctx, analysis_result, usage_info)
             return True
 
         except Exception as e:
@@ -106,96 +319,189 @@ class PrescriptionService:
             traceback.print_exc()
     
     @staticmethod
-    def call_ocr_api_multiple(image_bytes_list, user_id=None, member_name=None):
-        """調用組員的 OCR API 進行多圖快速識別"""
-        print(f"[OCR API Multi] 開始處理 {len(image_bytes_list)} 張圖片")
-        
-        all_medications = []
-        combined_result = {
-            "clinic_name": None,
-            "doctor_name": None, 
-            "visit_date": None,
-            "days_supply": None,
-            "medications": []
-        }
-        
-        total_execution_time = 0
-        
-        for i, image_bytes in enumerate(image_bytes_list):
-            print(f"[OCR API Multi] 處理第 {i+1}/{len(image_bytes_list)} 張圖片")
-            
-            result, usage_info = PrescriptionService.call_ocr_api(
-                image_bytes, user_id, member_name
-            )
-            
-            if result and isinstance(result, dict):
-                # 合併全域資訊（使用第一張圖片的資訊，或更新為非空值）
-                if i == 0 or not combined_result["clinic_name"]:
-                    combined_result["clinic_name"] = result.get("clinic_name")
-                if i == 0 or not combined_result["doctor_name"]:
-                    combined_result["doctor_name"] = result.get("doctor_name")
-                if i == 0 or not combined_result["visit_date"]:
-                    combined_result["visit_date"] = result.get("visit_date")
-                if i == 0 or not combined_result["days_supply"]:
-                    combined_result["days_supply"] = result.get("days_supply")
-                
-                # 合併藥物列表
-                medications = result.get("medications", [])
-                for med in medications:
-                    med["source_image"] = i + 1  # 標記來源圖片
-                    all_medications.append(med)
-                
-                # 累計執行時間
-                if usage_info and "execution_time" in usage_info:
-                    total_execution_time += usage_info["execution_time"]
-            else:
-                print(f"[OCR API Multi] 第 {i+1} 張圖片處理失敗")
-        
-        combined_result["medications"] = all_medications
-        combined_result["successful_match_count"] = len([med for med in all_medications if med.get('matched_drug_id')])
-        
-        # 建立合併的使用統計
-        combined_usage_info = {
-            "model": "ocr_api_multiple",
-            "version": "api_ocr_multi",
-            "execution_time": total_execution_time,
-            "images_processed": len(image_bytes_list),
-            "total_medications": len(all_medications),
-            "api_calls_used": len(image_bytes_list),
-            "total_tokens": 0,
-            "token_savings": "100%",
-            "api_status": "success",
-            "processing_mode": "sequential_multi_image"
-        }
-        
-        print(f"[OCR API Multi] 完成處理，共識別 {len(all_medications)} 種藥物")
-        return combined_result, combined_usage_info
+    def _store_analysis_result(user_id, task_id, ctx, analysis_result, usage_info):
+        """
+        驗證分析結果、寫入分析快取並存回任務狀態（增量分析時併入既有草稿）。
+        結果格式錯誤時拋出 RuntimeError；任務已被新的操作取代時捨棄結果並回傳 False。
+        """
+        if not analysis_result or not isinstance(analysis_result, dict) or 'medications' not in analysis_result:
+            error_detail = usage_info.get("error") if isinstance(usage_info, dict) else "未知AI錯誤"
+            raise RuntimeError(f"AI 分析失敗或回傳格式錯誤: {error_detail}")
+
+        image_hashes = ctx['image_hashes']
+        if not ctx['cached']:
+            if isinstance(usage_info, dict):
+                usage_info['served_from_cache'] = False
+            get_analysis_cache().set(image_hashes, ctx['selected_model'], analysis_result, usage_info,
+                                     user_id=user_id, member=ctx.get('member'))
+
+        # 只寫回 image_results 與 results 兩個路徑；讀取後狀態被其他請求改寫（例如使用者同時編輯草稿）時重新合併
+        for _ in range(_STATE_WRITE_ATTEMPTS):
+            full_state, version = UserService.get_user_complex_state_versioned(user_id)
+            last_task_info = full_state.get("last_task", {})
+            if last_task_info.get("task_id") != task_id:
+                print(f"[Prescription] 任務 {task_id} 已被新的操作取代，捨棄分析結果")
+                return False
+
+            image_results = last_task_info.get("image_results") or {}
+            for image_hash, image_result in zip(image_hashes, split_result_by_image(analysis_result, len(image_hashes))):
+                image_results[image_hash] = image_result
+            image_results = {h: image_results[h] for h in ctx['all_hashes'] if h in image_results}
+
+            results = copy.deepcopy(analysis_result)
+            if ctx['incremental']:
+                draft = last_task_info.get("results") or {"medications": []}
+                target_indexes = ctx['target_indexes']
+                _, added, duplicates = merge_into_draft(draft, results, target_indexes)
+                if isinstance(usage_info, dict):
+                    usage_info['incremental'] = {
+                        'images_total': len(ctx['all_hashes']),
+                        'images_reused': len(ctx['all_hashes']) - len(target_indexes),
+                        'images_analyzed': len(target_indexes),
+                        'medications_added': added,
+                        'duplicates_skipped': duplicates,
+                    }
+                print(f"[Prescription] 已併入草稿：新增 {added} 種藥物，略過重複 {duplicates} 種")
+                results = draft
+
+            try:
+                UserService.update_user_complex_state(
+                    user_id,
+                    sets={"last_task.image_results": image_results, "last_task.results": results},
+                    expected_version=version
+                )
+                return True
+            except StateConflictError:
+                print(f"[Prescription] 任務 {task_id} 的狀態在分析期間被更新，重新合併結果")
+        raise RuntimeError("任務狀態持續被其他操作更新，無法存回分析結果")
+
+    @staticmethod
+    def _deferred_ocr_api_handler(user_id, task_id, ctx, model_name, version, on_deferred=None):
+        """建立 api_ocr 背景完成時的處理函式：合併逐張結果、存回狀態並呼叫 on_deferred（於 app context 內）。"""
+        app = current_app._get_current_object()
+
+        def on_complete(per_image, elapsed):
+            with app.app_context():
+                try:
+                    analysis_result, usage_info = _merge_ocr_results(
+                        per_image, elapsed, model_name, version, "[OCR API]"
+                    )
+                    if isinstance(usage_info, dict):
+                        usage_info['deferred'] = True
+                    if not PrescriptionService._store_analysis_result(user_id, task_id, ctx, analysis_result, usage_info):
+                        return
+                    success = True
+                except Exception as e:
+                    print(f"[OCR API] 背景任務結果處理失敗: {e}")
+                    traceback.print_exc()
+                    success = False
+                if on_deferred:
+                    on_deferred(user_id, task_id, success)
+
+        return on_complete
+
+    @staticmethod
+    def submit_ocr_api_batch(image_bytes_list, user_id=None, member_name=None, on_deferred_complete=None):
+        """
+        依序把圖片送往組員的 OCR API，一次一張，皆以真實的 line_user_id 送出。
+        組員 API 以 line_user_id 保存與查詢結果，因此同一用戶同時只能有一個遠端任務：
+        同一用戶已有進行中的批次時，這一批排隊等前一批結束後才開始送出。
+
+        全部圖片都同步完成時回傳 (依圖片順序的逐張結果, 經過時間)；
+        有圖片改為非同步處理（202）或需要排隊時回傳 None，之後的圖片由背景依序送出，
+        全部完成後以 (逐張結果, 經過時間) 呼叫 on_deferred_complete。
+        """
+        user_key = user_id or 'unknown'
+        per_image = [{'image': i + 1, 'status': 'failed', 'elapsed': None, 'result': None, 'usage_info': None, 'error': None}
+                     for i in range(len(image_bytes_list))]
+        started = time.time()
+
+        def finish():
+            _release_ocr_api_slot(user_key)
+            return per_image, time.time() - started
+
+        def advance(index):
+            """從第 index 張開始依序送出；全部完成時回傳 True，改由背景追蹤時回傳 False。"""
+            for i in range(index, len(image_bytes_list)):
+                entry = per_image[i]
+                call_started = time.time()
+                result, usage_info = PrescriptionService.call_ocr_api(image_bytes_list[i], user_id, member_name)
+                entry['elapsed'], entry['usage_info'] = time.time() - call_started, usage_info
+                if isinstance(result, dict):
+                    entry['status'], entry['result'] = 'ok', result
+                elif isinstance(usage_info, dict) and usage_info.get('pending'):
+                    entry['status'] = 'pending'
+                    get_ocr_job_tracker().track(per_image, {i: usage_info['job_key']},
+                                                lambda entries, i=i: resume(i + 1))
+                    return False
+                else:
+                    entry['error'] = usage_info.get('error') if isinstance(usage_info, dict) else None
+            return True
+
+        def resume(index):
+            """前一張的遠端任務結束後（於背景執行緒）繼續送出剩下的圖片。"""
+            try:
+                if not advance(index):
+                    return
+            except Exception as e:
+                print(f"[OCR API] 背景送出圖片失敗: {e}")
+                traceback.print_exc()
+                for entry in per_image[index:]:
+                    if entry['status'] == 'failed' and entry['error'] is None:
+                        entry['error'] = str(e)
+            try:
+                on_deferred_complete(per_image, time.time() - started)
+            finally:
+                # 結果存回之後才讓同一用戶的下一批開始
+                _release_ocr_api_slot(user_key)
+
+        if not _acquire_ocr_api_slot(user_key, lambda: resume(0)):
+            print(f"[OCR API] 用戶 {user_key} 已有進行中的遠端任務，這批 {len(image_bytes_list)} 張圖片排隊等候")
+            return None
+        try:
+            done = advance(0)
+        except Exception:
+            finish()
+            raise
+        if not done:
+            print("[OCR API] 遠端改為非同步處理，剩下的圖片由背景依序送出，請求執行緒不等待")
+            return None
+        return finish()
 
     @staticmethod
     def call_ocr_api(image_bytes, user_id=None, member_name=None):
-        """調用組員的 OCR API 進行快速識別"""
+        """
+        調用組員的 OCR API 進行快速識別（只送出，不輪詢）。
+        同步完成（200）時回傳標準格式結果；遠端改為非同步處理（202）時回傳
+        (None, {'pending': True, 'job_key': ...})，由呼叫端交給 OcrJobTracker 追蹤。
+        組員 API 以 line_user_id 作為輪詢結果的鍵，因此任務鍵就是 user_id。
+        """
         import requests
-        import json
-        
+
+        job_key = user_id or 'unknown'
         try:
             # 組員的 OCR API 端點（正確的路徑）
             api_url = "https://gpu-test-543976352117.us-central1.run.app/api/v1/analyze?photo="
-            
+
             print(f"[OCR API] 開始調用 API: {api_url}")
             print(f"[OCR API] 用戶ID: {user_id}, 成員: {member_name}")
-            
+
             # 準備請求資料（正確的欄位名稱和格式）
             files = {
                 'photos': ('prescription.jpg', image_bytes, 'image/jpeg')
             }
-            
+
             data = {
-                'line_user_id': user_id or 'unknown',
+                'line_user_id': job_key,
                 'member': member_name or '本人'
             }
-            
-            print(f"[OCR API] 發送資料: {data}")
-            
+            # 設定了公開網址時附上完成回呼，遠端支援的話可省去輪詢
+            if Config.OCR_CALLBACK_URL and Config.OCR_CALLBACK_TOKEN:
+                data['callback_url'] = (f"{Config.OCR_CALLBACK_URL.rstrip('/')}/api/ocr/callback?"
+                                        f"{urlencode({'job_key': job_key, 'token': Config.OCR_CALLBACK_TOKEN})}")
+
+            print(f"[OCR API] 發送資料: {dict(data, callback_url='***') if 'callback_url' in data else data}")
+
             # 發送請求
             response = requests.post(
                 api_url,
@@ -203,32 +509,12 @@ class PrescriptionService:
                 data=data,
                 timeout=60  # 增加到60秒超時
             )
-            
-            if response.status_code in [200, 202]:
-                print(f"[OCR API] 任務提交成功 (狀態碼: {response.status_code})")
-                
-                if response.status_code == 200:
-                    # 同步回應，直接處理結果
-                    api_result = response.json()
-                    print(f"[OCR API] 同步獲得結果")
-                elif response.status_code == 202:
-                    # 異步處理，需要輪詢結果
-                    print(f"[OCR API] 異步處理，開始輪詢結果...")
-                    print(f"[DEBUG] POST回應內容: {response.text}")
-                    print(f"[DEBUG] POST回應headers: {dict(response.headers)}")
-                    
-                    # 等待一段時間再開始輪詢，給組員系統處理時間
-                    import time
-                    print(f"[DEBUG] 等待10秒讓組員系統處理...")
-                    time.sleep(10)
-                    
-                    api_result = PrescriptionService.poll_ocr_result(user_id)
-                    if not api_result:
-                        return None, {"error": "輪詢結果超時或失敗"}
-                
-                # 轉換 API 結果為統一格式
-                analysis_result = PrescriptionService.convert_api_result_to_standard_format(api_result)
-                
+
+            if response.status_code == 200:
+                # 同步回應，直接處理結果
+                print(f"[OCR API] 同步獲得結果")
+                analysis_result = PrescriptionService.convert_api_result_to_standard_format(response.json())
+
                 # 建立使用統計
                 usage_info = {
                     "model": "ocr_api",
@@ -240,160 +526,88 @@ class PrescriptionService:
                     "api_status": "success",
                     "http_status": response.status_code
                 }
-                
+
                 return analysis_result, usage_info
-                
-            else:
-                print(f"[OCR API] API 調用失敗: {response.status_code}")
-                print(f"[OCR API] 回應內容: {response.text}")
-                return None, {"error": f"API 調用失敗: {response.status_code}"}
-                
+
+            if response.status_code == 202:
+                # 非同步處理：結果由背景追蹤器輪詢（或等待回呼），請求執行緒不等待
+                print(f"[OCR API] 任務已受理 (202)，交由背景追蹤: {job_key}")
+                return None, {
+                    "pending": True,
+                    "job_key": job_key,
+                    "api_response_time": response.elapsed.total_seconds(),
+                    "http_status": response.status_code
+                }
+
+            print(f"[OCR API] API 調用失敗: {response.status_code}")
+            print(f"[OCR API] 回應內容: {response.text}")
+            return None, {"error": f"API 調用失敗: {response.status_code}"}
+
         except requests.exceptions.Timeout:
             print(f"[OCR API] API 調用超時")
             return None, {"error": "API 調用超時"}
         except Exception as e:
             print(f"[OCR API] API 調用錯誤: {e}")
             return None, {"error": f"API 調用錯誤: {str(e)}"}
-    
+
     @staticmethod
-    def poll_ocr_result(user_id, max_retries=20, polling_interval=10):
-        """輪詢組員OCR API獲取異步處理結果"""
+    def check_ocr_result(job_key):
+        """
+        查詢一次組員 OCR API 的非同步任務結果（由 OcrJobTracker 呼叫，不等待）。
+        回傳 (JOB_COMPLETED, 標準格式結果) / (JOB_PENDING, None) / (JOB_FAILED, 錯誤訊息)。
+        """
         import requests
-        import time
-        
-        # 輪詢端點
-        result_url = f"https://gpu-test-543976352117.us-central1.run.app/api/v1/result/{user_id}"
-        
-        print(f"[OCR API] 開始輪詢結果 - URL: {result_url}")
-        print(f"[OCR API] 最大重試次數: {max_retries}, 間隔: {polling_interval}秒")
-        print(f"[DEBUG] 輪詢用的user_id: '{user_id}'")
-        print(f"[DEBUG] 輪詢用的user_id長度: {len(user_id) if user_id else 0}")
-        
-        for i in range(max_retries):
+
+        result_url = f"https://gpu-test-543976352117.us-central1.run.app/api/v1/result/{quote(str(job_key), safe='')}"
+        response = requests.get(result_url, timeout=10)
+
+        if response.status_code == 200:
             try:
-                print(f"[OCR API] 輪詢第 {i+1}/{max_retries} 次...")
-                print(f"[DEBUG] 完整輪詢URL: {result_url}")
-                
-                response = requests.get(result_url, timeout=10)
-                
-                print(f"[DEBUG] 輪詢回應狀態: {response.status_code}")
-                print(f"[DEBUG] 輪詢回應headers: {dict(response.headers)}")
-                print(f"[DEBUG] 輪詢回應內容: {response.text}")
-                
-                if response.status_code == 200:
-                    try:
-                        result = response.json()
-                        print(f"[DEBUG] 結果JSON結構: {list(result.keys()) if isinstance(result, dict) else type(result)}")
-                        print(f"[OCR API] 結果預覽: {str(result)[:200]}...")
-                        
-                        # 檢查JSON中的status字段
-                        if result.get("status") == "completed":
-                            print(f"[OCR API] 輪詢成功獲得完成結果")
-                            return result.get("data")  # 返回data部分
-                        elif result.get("status") == "error":
-                            print(f"[OCR API] 組員API處理失敗: {result.get('message', '未知錯誤')}")
-                            return None
-                        elif result.get("status") == "processing":
-                            print(f"[OCR API] 任務仍在處理中，繼續等待...")
-                        else:
-                            print(f"[OCR API] 收到未知狀態: {result.get('status')}")
-                            print(f"[DEBUG] 完整回應: {result}")
-                        # 如果不是completed，繼續輪詢
-                    except Exception as json_error:
-                        print(f"[DEBUG] JSON解析錯誤: {json_error}")
-                        print(f"[DEBUG] 原始回應: {response.text}")
-                    
-                elif response.status_code == 404:
-                    print(f"[OCR API] 結果尚未準備好 (404)，繼續等待...")
-                    
-                elif response.status_code == 202:
-                    print(f"[OCR API] 任務仍在處理中 (202)，繼續等待...")
-                    
-                else:
-                    print(f"[OCR API] 輪詢收到意外狀態碼: {response.status_code}")
-                    print(f"[OCR API] 回應內容: {response.text}")
-                
-                # 等待下次輪詢
-                if i < max_retries - 1:  # 最後一次不需要等待
-                    print(f"[OCR API] 等待 {polling_interval} 秒後重試...")
-                    time.sleep(polling_interval)
-                    
-            except requests.exceptions.Timeout:
-                print(f"[OCR API] 輪詢第 {i+1} 次超時")
-                
-            except Exception as e:
-                print(f"[OCR API] 輪詢第 {i+1} 次發生錯誤: {e}")
-                import traceback
-                traceback.print_exc()
-        
-        print(f"[OCR API] 輪詢超時，已重試 {max_retries} 次")
-        return None
-    
+                result = response.json()
+            except ValueError:
+                print(f"[OCR API] 輪詢結果不是 JSON: {response.text[:200]}")
+                return JOB_PENDING, None
+            return PrescriptionService.parse_ocr_job_payload(result)
+
+        if response.status_code not in (202, 404):
+            print(f"[OCR API] 輪詢收到意外狀態碼: {response.status_code}")
+        # 404：結果尚未準備好；202：仍在處理中
+        return JOB_PENDING, None
+
+    @staticmethod
+    def parse_ocr_job_payload(payload):
+        """解析輪詢結果或完成回呼的內容（{"status": ..., "data": ..., "message": ...}）。"""
+        status = payload.get("status") if isinstance(payload, dict) else None
+        if status == "completed":
+            return JOB_COMPLETED, PrescriptionService.convert_api_result_to_standard_format(payload.get("data"))
+        if status == "error":
+            return JOB_FAILED, payload.get("message", "未知錯誤")
+        if status != "processing":
+            print(f"[OCR API] 收到未知狀態: {status}")
+        return JOB_PENDING, None
+
+    @staticmethod
+    def handle_ocr_callback(job_key, payload):
+        """處理組員 OCR API 的完成回呼；任務仍在追蹤中且內容為最終結果時回傳 True。"""
+        tracker = get_ocr_job_tracker()
+        tracker.record_callback()
+        status, data = PrescriptionService.parse_ocr_job_payload(payload)
+        if status == JOB_PENDING:
+            return False
+        if status == JOB_COMPLETED:
+            return tracker.complete(job_key, JOB_COMPLETED, data)
+        return tracker.complete(job_key, JOB_FAILED, error=str(data))
+
     @staticmethod
     def call_fastapi_ocr_multiple(image_bytes_list, user_id=None, member_name=None):
-        """調用組員B的 FastAPI OCR 進行多圖快速識別"""
-        print(f"[FastAPI OCR Multi] 開始處理 {len(image_bytes_list)} 張圖片")
-        
-        all_medications = []
-        combined_result = {
-            "clinic_name": None,
-            "doctor_name": None, 
-            "visit_date": None,
-            "days_supply": None,
-            "medications": []
-        }
-        
-        total_execution_time = 0
-        
-        for i, image_bytes in enumerate(image_bytes_list):
-            print(f"[FastAPI OCR Multi] 處理第 {i+1}/{len(image_bytes_list)} 張圖片")
-            
-            result, usage_info = PrescriptionService.call_fastapi_ocr(
-                image_bytes, user_id, member_name
-            )
-            
-            if result and isinstance(result, dict):
-                # 合併全域資訊（使用第一張圖片的資訊，或更新為非空值）
-                if i == 0 or not combined_result["clinic_name"]:
-                    combined_result["clinic_name"] = result.get("clinic_name")
-                if i == 0 or not combined_result["doctor_name"]:
-                    combined_result["doctor_name"] = result.get("doctor_name")
-                if i == 0 or not combined_result["visit_date"]:
-                    combined_result["visit_date"] = result.get("visit_date")
-                if i == 0 or not combined_result["days_supply"]:
-                    combined_result["days_supply"] = result.get("days_supply")
-                
-                # 合併藥物列表
-                medications = result.get("medications", [])
-                for med in medications:
-                    med["source_image"] = i + 1  # 標記來源圖片
-                    all_medications.append(med)
-                
-                # 累計執行時間
-                if usage_info and "execution_time" in usage_info:
-                    total_execution_time += usage_info["execution_time"]
-            else:
-                print(f"[FastAPI OCR Multi] 第 {i+1} 張圖片處理失敗")
-        
-        combined_result["medications"] = all_medications
-        combined_result["successful_match_count"] = len([med for med in all_medications if med.get('matched_drug_id')])
-        
-        # 建立合併的使用統計
-        combined_usage_info = {
-            "model": "fastapi_ocr_multiple",
-            "version": "fastapi_ocr_multi",
-            "execution_time": total_execution_time,
-            "images_processed": len(image_bytes_list),
-            "total_medications": len(all_medications),
-            "api_calls_used": len(image_bytes_list),
-            "total_tokens": 0,
-            "token_savings": "100%",
-            "api_status": "success",
-            "processing_mode": "sequential_multi_image"
-        }
-        
-        print(f"[FastAPI OCR Multi] 完成處理，共識別 {len(all_medications)} 種藥物")
-        return combined_result, combined_usage_info
+        """調用組員B的 FastAPI OCR 進行多圖快速識別：所有圖片同時送出，依圖片順序合併。"""
+        print(f"[FastAPI OCR Multi] 開始並行處理 {len(image_bytes_list)} 張圖片")
+
+        def call(index, image_bytes):
+            return PrescriptionService.call_fastapi_ocr(image_bytes, user_id, member_name)
+
+        per_image, wall_time = _fan_out_ocr(call, image_bytes_list, "[FastAPI OCR Multi]")
+        return _merge_ocr_results(per_image, wall_time, "fastapi_ocr_multiple", "fastapi_ocr_multi", "[FastAPI OCR Multi]")
 
     @staticmethod
     def call_fastapi_ocr(image_bytes, user_id=None, member_name=None):
@@ -570,15 +784,14 @@ class PrescriptionService:
         visit_date_gregorian = convert_minguo_to_gregorian(visit_date_str)
         if not visit_date_gregorian:
             # 【修正】這裡要確保狀態被正確設定，以便 handle_postback 能夠處理
-            state_to_save = UserService.get_user_complex_state(user_id)
-            state_to_save['state_info'] = {'state': 'AWAITING_VISIT_DATE'}
-            UserService.set_user_complex_state(user_id, state_to_save)
+            UserService.update_user_complex_state(user_id, sets={'state_info': {'state': 'AWAITING_VISIT_DATE'}})
             return "AWAITING_VISIT_DATE", None, None
 
         analysis_data['visit_date'] = visit_date_gregorian
         
         try:
             mm_id, is_update = DB.save_or_update_prescription(analysis_data, task_to_save, user_id)
+            get_drug_shortlist().invalidate(user_id, task_to_save.get('member'))
             UserService.clear_user_complex_state(user_id)
             return "SUCCESS", mm_id, is_update
         except Exception as e:
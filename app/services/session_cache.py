@@ -0,0 +1,200 @@
+# app/services/session_cache.py
+
+import copy
+import itertools
+import threading
+from typing import Callable, Optional
+
+from config import Config
+from ..utils.cache import LRUCache
+from ..utils.state_paths import apply_updates, get_path
+
+_MISSING = object()
+# 快取「資料庫中沒有這筆狀態」，避免對不存在的狀態重複查詢
+_ABSENT = object()
+
+
+def _approx_size(value) -> int:
+    """粗估狀態大小（字串長度總和），用來略過夾帶圖片等大型資料的狀態。"""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(str(k)) + _approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_approx_size(v) for v in value)
+    return 8
+
+
+class SessionCache:
+    """
+    用戶工作階段快取：放在 state / user_temp_state / users 資料表前面的記憶體快取。
+
+    - 簡單狀態：存活時間取資料庫 expires_at 的剩餘秒數與 ttl 的較小值。
+    - 複雜狀態：連同資料庫的版本號一起快取，讀取與寫入都以深層複製隔離，
+      呼叫端修改取回的 dict 不會影響快取；部分更新直接套用到快取的狀態上；
+      超過 max_state_bytes 的狀態（例如夾帶藥單圖片）不快取，直接讀寫資料庫。
+    - 已知用戶：確認存在於 users 資料表的用戶（及其名稱），get_or_create_user 不必再查詢。
+
+    寫入一律先寫資料庫再更新快取（write-through）。每次寫入會更新該用戶的版本號，
+    讀取未命中時記下版本號，查完資料庫後版本號沒變才寫回快取，
+    避免其他執行緒在查詢期間寫入的新值被舊值覆蓋。
+    ttl 為 0 時不快取簡單與複雜狀態（每次都讀寫資料庫），只記住已知用戶。
+    """
+
+    def __init__(self, max_users: int = 2048, ttl: float = 0, known_users_size: int = 10000,
+                 max_state_bytes: int = 128 * 1024):
+        self.ttl = ttl
+        self.max_state_bytes = max_state_bytes
+        self._simple = LRUCache(max_users, ttl)
+        self._complex = LRUCache(max_users, ttl)
+        self._known_users = LRUCache(known_users_size)
+        self._versions = LRUCache(max_users * 2)
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    # --- 版本號 ---
+
+    def _version(self, key):
+        return self._versions.get(key)
+
+    def _fill(self, cache: LRUCache, key, version, value, ttl=None):
+        """查完資料庫後寫回快取；期間有其他執行緒寫入時放棄。"""
+        if not self.ttl:
+            return
+        with self._lock:
+            if self._versions.get(key) == version:
+                cache.set(key, value, ttl)
+
+    def _write(self, cache: LRUCache, key, value, ttl=None):
+        with self._lock:
+            self._versions.set(key, next(self._counter))
+            if value is _MISSING or not self.ttl:
+                cache.delete(key)
+            else:
+                cache.set(key, value, ttl)
+
+    # --- 簡單狀態 ---
+
+    def get_simple(self, user_id: str, load: Callable[[str], tuple]):
+        """load(user_id) 回傳 (狀態, 剩餘秒數)；沒有狀態時回傳 (None, None)。"""
+        key = f"simple:{user_id}"
+        value = self._simple.get(key, _MISSING)
+        if value is not _MISSING:
+            return None if value is _ABSENT else value
+        version = self._version(key)
+        state, remaining = load(user_id)
+        if state is None:
+            self._fill(self._simple, key, version, _ABSENT)
+        elif remaining and remaining > 0:
+            self._fill(self._simple, key, version, state, min(self.ttl, remaining))
+        return state
+
+    def write_simple(self, user_id: str, state: Optional[str], expires_in: float = None, persist: Callable = None):
+        """先執行 persist() 寫入資料庫，再更新快取；state 為 None 表示已刪除。"""
+        key = f"simple:{user_id}"
+        try:
+            if persist:
+                persist()
+        except Exception:
+            self._write(self._simple, key, _MISSING)
+            raise
+        if state is None:
+            self._write(self._simple, key, _ABSENT)
+        else:
+            self._write(self._simple, key, state, min(self.ttl, expires_in) if expires_in else None)
+
+    # --- 複雜狀態 ---
+
+    def get_complex(self, user_id: str, load: Callable[[str], tuple]) -> tuple:
+        """load(user_id) 回傳 (狀態, 版本號)；回傳的狀態是複本。"""
+        key = f"complex:{user_id}"
+        value = self._complex.get(key, _MISSING)
+        if value is not _MISSING:
+            state, version = value
+            return copy.deepcopy(state), version
+        stamp = self._version(key)
+        state, version = load(user_id)
+        if _approx_size(state) <= self.max_state_bytes:
+            self._fill(self._complex, key, stamp, (copy.deepcopy(state), version))
+        return state, version
+
+    def peek_complex(self, user_id: str, path: str, default=None) -> tuple:
+        """
+        從快取讀取狀態中的一個路徑，回傳 (是否有快取, 值的複本)；
+        有快取但路徑不存在時回傳 (True, default)。
+        """
+        value = self._complex.get(f"complex:{user_id}", _MISSING)
+        if value is _MISSING:
+            return False, default
+        return True, copy.deepcopy(get_path(value[0], path, default))
+
+    def write_complex(self, user_id: str, state: dict, persist: Callable[[], Optional[int]]):
+        """
+        先執行 persist() 寫入資料庫，再更新快取。
+        persist 回傳寫入後的版本號；回傳 None 表示版本衝突未寫入，此時丟棄快取讓下次重新讀取。
+        """
+        key = f"complex:{user_id}"
+        try:
+            version = persist()
+        except Exception:
+            self._write(self._complex, key, _MISSING)
+            raise
+        too_large = version is None or _approx_size(state) > self.max_state_bytes
+        self._write(self._complex, key, _MISSING if too_large else (copy.deepcopy(state), version))
+        return version
+
+    def update_complex(self, user_id: str, sets: dict, removes, persist: Callable[[], Optional[int]]):
+        """
+        先執行 persist() 在資料庫做部分更新，再對快取的狀態套用相同的更新。
+        快取的版本號正好是更新前的版本時才套用，否則（中間漏掉其他寫入）丟棄快取。
+        """
+        key = f"complex:{user_id}"
+        try:
+            version = persist()
+        except Exception:
+            self._write(self._complex, key, _MISSING)
+            raise
+        with self._lock:
+            self._versions.set(key, next(self._counter))
+            cached = self._complex.get(key, _MISSING)
+            if self.ttl and version is not None and cached is not _MISSING and cached[1] == version - 1:
+                state = apply_updates(copy.deepcopy(cached[0]), sets, removes)
+                if _approx_size(state) <= self.max_state_bytes:
+                    self._complex.set(key, (state, version))
+                    return version
+            self._complex.delete(key)
+        return version
+
+    # --- 已知用戶 ---
+
+    def known_user_name(self, user_id: str) -> Optional[str]:
+        return self._known_users.get(user_id)
+
+    def remember_user(self, user_id: str, user_name: str):
+        self._known_users.set(user_id, user_name)
+
+    def stats(self) -> dict:
+        return {
+            'simple_state': self._simple.stats(),
+            'complex_state': self._complex.stats(),
+            'known_users': self._known_users.stats(),
+        }
+
+
+_session_cache = None
+_session_cache_lock = threading.Lock()
+
+
+def get_session_cache() -> SessionCache:
+    """取得行程內共用的用戶工作階段快取。"""
+    global _session_cache
+    if _session_cache is None:
+        with _session_cache_lock:
+            if _session_cache is None:
+                _session_cache = SessionCache(
+                    max_users=Config.SESSION_CACHE_SIZE,
+                    ttl=Config.SESSION_CACHE_TTL_SECONDS,
+                    known_users_size=Config.KNOWN_USERS_CACHE_SIZE,
+                    max_state_bytes=Config.SESSION_CACHE_MAX_STATE_KB * 1024,
+                )
+    return _session_cache
@@ -0,0 +1,190 @@
+# app/services/state_store.py
+
+import json
+import os
+import sqlite3
+import threading
+
+from config import Config
+from ..utils.db import DB
+from ..utils.state_codec import get_state_codec
+from ..utils.state_paths import apply_updates, build_update_expression, get_path, json_path, rewrite_with_updates
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_temp_state (
+    recorder_id TEXT PRIMARY KEY,
+    state_data TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class StateConflictError(Exception):
+    """寫入複雜狀態時版本號不符：讀取之後已有其他請求寫入。"""
+
+
+def _empty_state() -> dict:
+    return {"state_info": {}, "last_task": {}}
+
+
+class SQLiteStateBackend:
+    """
+    以 SQLite 保存複雜狀態（user_temp_state）的實作，供本機開發使用。
+
+    介面與 DB 類別的複雜狀態方法相同：部分更新對應 json_set / json_remove，
+    以 version 欄位偵測衝突的寫入，並同樣以狀態編碼器壓縮較大的狀態。
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """每個執行緒各自保有一條連線（sqlite3 連線不可跨執行緒共用）。"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get_complex_state(self, user_id):
+        return self.get_complex_state_versioned(user_id)[0]
+
+    def get_complex_state_versioned(self, user_id):
+        row = self._connect().execute(
+            "SELECT state_data, version FROM user_temp_state WHERE recorder_id = ?", (user_id,)
+        ).fetchone()
+        if not row:
+            return _empty_state(), 0
+        try:
+            state = get_state_codec().decode(row[0]) if row[0] else None
+        except (ValueError, TypeError):
+            state = None
+        return state or _empty_state(), row[1]
+
+    def get_complex_state_path(self, user_id, path, default=None):
+        # json_quote 讓字串值也以 JSON 文字回傳；路徑不存在時為 'null'。壓縮儲存的狀態取回整份解碼
+        row = self._connect().execute(
+            "SELECT json_quote(json_extract(state_data, ?)), "
+            "CASE WHEN substr(state_data, 1, 1) = '{' THEN NULL ELSE state_data END "
+            "FROM user_temp_state WHERE recorder_id = ?",
+            (json_path(path), user_id)
+        ).fetchone()
+        if row and row[1]:
+            return get_path(get_state_codec().decode(row[1]), path, default)
+        if not row or row[0] is None:
+            return default
+        value = json.loads(row[0])
+        return default if value is None else value
+
+    def update_complex_state_paths(self, user_id, sets=None, removes=(), expected_version=None):
+        codec = get_state_codec()
+        if codec.prefers_rewrite((sets or {}).values()):
+            return rewrite_with_updates(self, user_id, sets, removes, expected_version)
+        expression, params = build_update_expression(sets or {}, removes, 'sqlite', dumps=codec.dumps)
+        sql = (f"UPDATE user_temp_state SET state_data = {expression}, version = version + 1 "
+               "WHERE recorder_id = ? AND substr(state_data, 1, 1) = '{'")
+        params.append(user_id)
+        if expected_version is not None:
+            sql += " AND version = ?"
+            params.append(expected_version)
+        conn = self._connect()
+        rewrite = False
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute(sql, params).rowcount:
+                version = conn.execute(
+                    "SELECT version FROM user_temp_state WHERE recorder_id = ?", (user_id,)
+                ).fetchone()[0]
+            else:
+                row = conn.execute("SELECT version FROM user_temp_state WHERE recorder_id = ?", (user_id,)).fetchone()
+                if row:
+                    # 狀態是壓縮儲存的（或版本號不符）：版本號相符時於交易結束後改為整份寫回
+                    version = None
+                    rewrite = expected_version is None or row[0] == expected_version
+                elif expected_version:
+                    version = None
+                else:
+                    state = apply_updates(_empty_state(), sets, removes)
+                    conn.execute(
+                        "INSERT INTO user_temp_state (recorder_id, state_data, version) VALUES (?, ?, 1)",
+                        (user_id, codec.encode(state))
+                    )
+                    version = 1
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        if rewrite:
+            return rewrite_with_updates(self, user_id, sets, removes, expected_version)
+        return version
+
+    def replace_complex_state(self, user_id, state_data, expected_version=None):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT version FROM user_temp_state WHERE recorder_id = ?", (user_id,)).fetchone()
+            current = row[0] if row else 0
+            if expected_version is not None and expected_version != current:
+                version = None
+            else:
+                version = current + 1
+                conn.execute(
+                    "INSERT INTO user_temp_state (recorder_id, state_data, version) VALUES (?, ?, ?) "
+                    "ON CONFLICT(recorder_id) DO UPDATE SET state_data = excluded.state_data, version = excluded.version",
+                    (user_id, get_state_codec().encode(state_data), version)
+                )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return version
+
+    def set_complex_state(self, user_id, state_data):
+        self.replace_complex_state(user_id, state_data)
+
+    def clear_complex_state(self, user_id):
+        # 與 DB.clear_complex_state 相同：寫入空狀態並遞增版本號，不刪除整列
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute(
+                "UPDATE user_temp_state SET state_data = ?, version = version + 1 WHERE recorder_id = ?",
+                (get_state_codec().encode(_empty_state()), user_id)
+            ).rowcount:
+                version = conn.execute(
+                    "SELECT version FROM user_temp_state WHERE recorder_id = ?", (user_id,)
+                ).fetchone()[0]
+            else:
+                version = 0
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return version
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend():
+    """
+    取得複雜狀態的儲存後端（依 Config.STATE_BACKEND 選擇）：
+    'mysql' 回傳 DB 類別本身，'sqlite' 回傳行程內共用的 SQLiteStateBackend。
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if Config.STATE_BACKEND == 'sqlite':
+                    _backend = SQLiteStateBackend(Config.STATE_SQLITE_PATH)
+                else:
+                    _backend = DB
+    return _backend
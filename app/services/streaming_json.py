@@ -0,0 +1,82 @@
+# app/services/streaming_json.py
+
+import json
+from typing import List
+
+
+class JsonArrayStreamParser:
+    """
+    增量 JSON 解析器：逐段餵入串流回應的文字，每當最外層物件中 array_key 陣列的
+    某個元素完整出現時就立即解析並回傳，不必等待整個回應結束。
+
+    只追蹤字串 / 跳脫字元 / 巢狀深度，不驗證整體 JSON 格式；
+    完整回應仍應在串流結束後以 json.loads 解析。``` 等包在最外層物件之外的文字會被忽略。
+    """
+
+    def __init__(self, array_key: str = 'medications'):
+        self.array_key = array_key
+        self._buffer = []          # 目前元素已讀到的字元
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_chars = []    # 深度 1 的字串內容（用來辨識 key）
+        self._last_string = None
+        self._current_key = None
+        self._array_depth = None   # 進入目標陣列後的深度
+        self._element_depth = None # 目前元素開始時的深度
+        self.emitted = 0
+
+    def feed(self, text: str) -> List:
+        """餵入一段文字，回傳這段文字中完成的陣列元素（可能為空）。"""
+        completed = []
+        for ch in text:
+            if self._element_depth is not None:
+                self._buffer.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = ''.join(self._string_chars)
+                elif self._depth == 1:
+                    self._string_chars.append(ch)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_chars = []
+            elif ch == ':' and self._depth == 1:
+                self._current_key = self._last_string
+            elif ch == ',' and self._depth == 1:
+                self._current_key = None
+            elif ch in '{[':
+                if self._array_depth is not None and self._depth == self._array_depth and self._element_depth is None:
+                    self._element_depth = self._depth
+                    self._buffer = [ch]
+                self._depth += 1
+                if ch == '[' and self._depth == 2 and self._current_key == self.array_key:
+                    self._array_depth = self._depth
+            elif ch in '}]':
+                self._depth -= 1
+                if self._element_depth is not None and self._depth == self._element_depth:
+                    element = self._parse(''.join(self._buffer))
+                    self._buffer = []
+                    self._element_depth = None
+                    if element is not None:
+                        completed.append(element)
+                        self.emitted += 1
+                if self._array_depth is not None and self._depth < self._array_depth:
+                    self._array_depth = None
+                    self._current_key = None
+        return completed
+
+    @staticmethod
+    def _parse(text: str):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None
@@ -1,6 +1,8 @@
 # app/services/user_service.py
 
 from ..utils.db import DB
+from .session_cache import get_session_cache
+from .state_store import StateConflictError, get_state_backend
 from app import line_bot_api
 
 class UserService:
@@ -9,59 +11,122 @@ class UserService:
     # --- 複雜狀態管理 (藥單流程) ---
     @staticmethod
     def get_user_complex_state(user_id: str):
-        return DB.get_complex_state(user_id)
+        return UserService.get_user_complex_state_versioned(user_id)[0]
 
     @staticmethod
-    def set_user_complex_state(user_id: str, state_data: dict):
-        """設置用戶複雜狀態，自動確保用戶存在"""
+    def get_user_complex_state_versioned(user_id: str):
+        """回傳 (狀態, 版本號)；寫入時把版本號傳給 expected_version 即可偵測衝突。"""
+        return get_session_cache().get_complex(user_id, get_state_backend().get_complex_state_versioned)
+
+    @staticmethod
+    def get_user_complex_state_path(user_id: str, path: str, default=None):
+        """只讀取狀態中的一個路徑（例如 'last_task'），快取沒有時不載入整份狀態。"""
+        cached, value = get_session_cache().peek_complex(user_id, path, default)
+        if cached:
+            return value
+        return get_state_backend().get_complex_state_path(user_id, path, default)
+
+    @staticmethod
+    def _ensure_user(user_id: str) -> bool:
+        """確保用戶在資料庫中存在（已確認過的用戶不必再查詢）"""
+        session_cache = get_session_cache()
+        if session_cache.known_user_name(user_id) is not None:
+            return True
         try:
-            # 【核心修復】確保用戶在資料庫中存在
-            try:
-                user_profile = line_bot_api.get_profile(user_id)
-                user_name = user_profile.display_name if user_profile else f"User_{user_id[:8]}"
-            except Exception:
-                user_name = f"User_{user_id[:8]}"
-            
-            result = DB.get_or_create_user(user_id, user_name)
-            if not result:
-                print(f"❌ 無法創建或獲取用戶: {user_id}")
+            user_profile = line_bot_api.get_profile(user_id)
+            user_name = user_profile.display_name if user_profile else f"User_{user_id[:8]}"
+        except Exception:
+            user_name = f"User_{user_id[:8]}"
+        
+        if not DB.get_or_create_user(user_id, user_name):
+            print(f"❌ 無法創建或獲取用戶: {user_id}")
+            return False
+        session_cache.remember_user(user_id, user_name)
+        return True
+
+    @staticmethod
+    def set_user_complex_state(user_id: str, state_data: dict, expected_version: int = None):
+        """
+        設置用戶複雜狀態（整份覆寫），自動確保用戶存在。
+        指定 expected_version 且狀態已被其他請求改寫時拋出 StateConflictError。
+        """
+        try:
+            if not UserService._ensure_user(user_id):
                 return False
             
-            # 設置狀態
-            DB.set_complex_state(user_id, state_data)
-            return True
+            # 設置狀態（先寫資料庫再更新快取）
+            version = get_session_cache().write_complex(
+                user_id, state_data, lambda: get_state_backend().replace_complex_state(user_id, state_data, expected_version)
+            )
         except Exception as e:
             print(f"❌ 設置用戶狀態失敗: {e}")
             return False
+        if version is None and expected_version is not None:
+            raise StateConflictError(f"用戶 {user_id} 的狀態已被其他請求更新")
+        return True
+
+    @staticmethod
+    def update_user_complex_state(user_id: str, sets: dict = None, removes=(), expected_version: int = None):
+        """
+        只更新狀態中的指定路徑，例如 sets={'last_task.results': {...}}、removes=['state_info']。
+        資料庫端以 JSON_SET / JSON_REMOVE 執行，不必讀取與改寫整份狀態；
+        指定 expected_version 且狀態已被其他請求改寫時拋出 StateConflictError。
+        """
+        try:
+            if not UserService._ensure_user(user_id):
+                return False
+            
+            version = get_session_cache().update_complex(
+                user_id, sets or {}, removes,
+                lambda: get_state_backend().update_complex_state_paths(user_id, sets or {}, removes, expected_version)
+            )
+        except Exception as e:
+            print(f"❌ 更新用戶狀態失敗: {e}")
+            return False
+        if version is None and expected_version is not None:
+            raise StateConflictError(f"用戶 {user_id} 的狀態已被其他請求更新")
+        return True
 
     @staticmethod
     def clear_user_complex_state(user_id: str):
-        DB.clear_complex_state(user_id)
+        get_session_cache().write_complex(
+            user_id, {"state_info": {}, "last_task": {}},
+            lambda: get_state_backend().clear_complex_state(user_id)
+        )
 
     # --- 簡單狀態管理 (通用) ---
     @staticmethod
     def get_user_simple_state(user_id: str):
-        return DB.get_simple_state(user_id)
+        return get_session_cache().get_simple(user_id, DB.get_simple_state_with_ttl)
 
     @staticmethod
     def save_user_simple_state(user_id: str, state: str, minutes: int = 10):
-        DB.save_simple_state(user_id, state, minutes_to_expire=minutes)
+        get_session_cache().write_simple(
+            user_id, state, expires_in=minutes * 60,
+            persist=lambda: DB.save_simple_state(user_id, state, minutes_to_expire=minutes)
+        )
 
     @staticmethod
     def delete_user_simple_state(user_id: str):
-        DB.delete_simple_state(user_id)
-        
+        get_session_cache().write_simple(user_id, None, persist=lambda: DB.delete_simple_state(user_id))
+
     # --- 使用者與成員 ---
     @staticmethod
     def get_or_create_user(user_id: str):
-        """如果使用者不存在，則建立使用者並回傳 display name"""
+        """如果使用者不存在，則建立使用者並回傳 display name（已確認過的用戶直接回傳快取的名稱）"""
+        session_cache = get_session_cache()
+        user_name = session_cache.known_user_name(user_id)
+        if user_name is not None:
+            return user_name
+        
         try:
             profile = line_bot_api.get_profile(user_id)
             user_name = profile.display_name
         except Exception:
             user_name = "使用者" # 預設名稱
         
-        DB.get_or_create_user(user_id, user_name)
+        if DB.get_or_create_user(user_id, user_name):
+            session_cache.remember_user(user_id, user_name)
         return user_name
 
     @staticmethod
@@ -0,0 +1,112 @@
+# app/utils/async_runtime.py
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+import threading
+
+from config import Config
+
+
+class AsyncRuntime:
+    """
+    行程內共用的非同步執行環境：一條常駐的事件迴圈執行緒 + 一個有上限的阻塞工作執行緒池。
+
+    Flask / webhook 的工作執行緒透過 submit() / run() 把協程丟進事件迴圈，
+    協程內的阻塞工作（資料庫、Gemini、Pillow）以 run_blocking() 交給執行緒池，
+    因此多個同時進行的分析之間也能互相重疊，而不是每個請求各自建立再關閉一個事件迴圈。
+
+    注意：run_blocking() 執行的函式不可再呼叫 run()，否則執行緒池耗盡時會互相等待。
+    """
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        self._pid = os.getpid()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='async-blocking'
+        )
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(self._executor)
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._in_flight = 0
+        self._blocking_in_flight = 0
+        self._thread = threading.Thread(target=self._run_loop, name='async-runtime', daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def in_loop_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """從任何執行緒把協程排進事件迴圈，回傳執行緒安全的 concurrent.futures.Future。"""
+        with self._lock:
+            self._submitted += 1
+            self._in_flight += 1
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, _future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def run(self, coro, timeout=None):
+        """提交協程並阻塞等待結果；逾時會取消協程並拋出 concurrent.futures.TimeoutError。"""
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("不可在事件迴圈執行緒內呼叫 AsyncRuntime.run()，請直接 await")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """在有上限的執行緒池中執行阻塞函式（只能在事件迴圈內 await）。"""
+        with self._lock:
+            self._blocking_in_flight += 1
+        try:
+            return await self._loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        finally:
+            with self._lock:
+                self._blocking_in_flight -= 1
+
+    def shutdown(self):
+        if self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'running': self._thread.is_alive(),
+                'max_workers': self.max_workers,
+                'submitted': self._submitted,
+                'in_flight': self._in_flight,
+                'blocking_in_flight': self._blocking_in_flight,
+            }
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_async_runtime() -> AsyncRuntime:
+    """取得行程內共用的非同步執行環境（gunicorn fork 出的 worker 會各自建立一份）。"""
+    global _runtime
+    if _runtime is None or _runtime._pid != os.getpid():
+        with _runtime_lock:
+            if _runtime is None or _runtime._pid != os.getpid():
+                _runtime = AsyncRuntime(max_workers=Config.ASYNC_EXECUTOR_WORKERS)
+    return _runtime
@@ -8,53 +8,42 @@ from flask import g
 from zoneinfo import ZoneInfo
 import random
 import string
+import threading
 import time
 import pytz
 
+from .db_pool import get_pool
+from .state_codec import get_state_codec
+from .state_paths import apply_updates, build_update_expression, get_path, json_path, rewrite_with_updates
+
 # --- 資料庫連線管理 ---
 
 def get_db_connection():
-    """從 Flask 的 g 物件取得資料庫連線，若不存在則透過 Cloud SQL Unix socket 建立。"""
+    """從 Flask 的 g 物件取得資料庫連線，若不存在則從行程共用的連線池借出一條。"""
     try:
         if 'db' not in g:
-            if os.environ.get("DB_SOCKET_PATH"):
-                # 使用 Cloud SQL Auth Proxy 的 Unix socket 路徑
-                g.db = pymysql.connect(
-                    user=os.environ.get('DB_USER'),
-                    password=os.environ.get('DB_PASS'),
-                    database=os.environ.get('DB_NAME'),
-                    unix_socket=os.environ.get('DB_SOCKET_PATH'),
-                    charset='utf8mb4',
-                    cursorclass=pymysql.cursors.DictCursor,
-                    connect_timeout=10
-                )
-            else:
-                # fallback: 一般 host-based 連線（例如本機測試用）
-                g.db = pymysql.connect(
-                    host=os.environ.get('DB_HOST'),
-                    user=os.environ.get('DB_USER'),
-                    password=os.environ.get('DB_PASS'),
-                    database=os.environ.get('DB_NAME'),
-                    port=int(os.environ.get('DB_PORT', 3306)),
-                    charset='utf8mb4',
-                    cursorclass=pymysql.cursors.DictCursor,
-                    connect_timeout=10
-                )
+            g.db = get_pool().acquire()
         return g.db
     except pymysql.MySQLError as e:
         print(f"資料庫連線錯誤: {e}")
         return None
 
 def close_db_connection(e=None):
-    """關閉 g 物件中儲存的資料庫連線。"""
+    """將 g 物件中借出的資料庫連線歸還連線池。"""
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_pool().release(db)
 
 def init_app(app):
     """註冊資料庫關閉函式到 Flask app。"""
     app.teardown_appcontext(close_db_connection)
 
+# user_temp_state 是否已確認有 version 欄位
+_state_version_column_ready = False
+_state_version_column_lock = threading.Lock()
+# MySQL 錯誤碼：欄位已存在
+_ER_DUP_FIELDNAME = 1060
+
 # --- 資料庫操作類別 (整合雙方邏輯) ---
 
 class DB:
@@ -83,7 +72,19 @@ class DB:
             cursor.execute(query, (user_id,))
             row = cursor.fetchone()
             return row['state'] if row else None
-    
+
+    @staticmethod
+    def get_simple_state_with_ttl(user_id):
+        """回傳 (狀態, 距離 expires_at 的剩餘秒數)；沒有有效狀態時回傳 (None, None)。"""
+        db = get_db_connection()
+        if not db: return None, None
+        with db.cursor() as cursor:
+            query = ("SELECT state, TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), expires_at) AS remaining "
+                     "FROM state WHERE recorder_id=%s AND expires_at > UTC_TIMESTAMP()")
+            cursor.execute(query, (user_id,))
+            row = cursor.fetchone()
+            return (row['state'], row['remaining']) if row else (None, None)
+
     @staticmethod
     def delete_simple_state(user_id):
         db = get_db_connection()
@@ -102,8 +103,8 @@ class DB:
             record = cursor.fetchone()
             if record and record['state_data']:
                 try:
-                    return json.loads(record['state_data'])
-                except (json.JSONDecodeError, TypeError):
+                    return get_state_codec().decode(record['state_data'])
+                except (ValueError, TypeError):
                     return {"state_info": {}, "last_task": {}}
             return {"state_info": {}, "last_task": {}}
 
@@ -111,21 +112,187 @@ class DB:
     def set_complex_state(user_id, state_data):
         db = get_db_connection()
         if not db: return
+        DB._ensure_state_version_column(db)
         with db.cursor() as cursor:
-            # 使用自定义的 JSON 编码器来处理 date 类型
-            from app import CustomJSONEncoder
-            json_data = json.dumps(state_data, cls=CustomJSONEncoder)
-            sql = "INSERT INTO user_temp_state (recorder_id, state_data) VALUES (%s, %s) ON DUPLICATE KEY UPDATE state_data = VALUES(state_data)"
+            # 狀態編碼器會處理 date 類型，較大的狀態壓縮後再寫入
+            json_data = get_state_codec().encode(state_data)
+            sql = ("INSERT INTO user_temp_state (recorder_id, state_data, version) VALUES (%s, %s, 1) "
+                   "ON DUPLICATE KEY UPDATE state_data = VALUES(state_data), version = version + 1")
             cursor.execute(sql, (user_id, json_data))
             db.commit()
 
     @staticmethod
     def clear_complex_state(user_id):
+        """
+        清空狀態並回傳新的版本號（沒有這筆狀態時回傳 0）。
+        寫入空狀態並遞增版本號而不是刪除整列：刪除會讓版本號回到 0，
+        之後重新建立的狀態可能與清除前讀到的版本號相同，使舊的寫入通過版本比對。
+        """
         db = get_db_connection()
-        if not db: return
+        if not db: return None
+        DB._ensure_state_version_column(db)
+        with db.cursor() as cursor:
+            if not cursor.execute(
+                "UPDATE user_temp_state SET state_data = %s, version = version + 1 WHERE recorder_id = %s",
+                (get_state_codec().encode({"state_info": {}, "last_task": {}}), user_id)
+            ):
+                db.rollback()
+                return 0
+            cursor.execute("SELECT version FROM user_temp_state WHERE recorder_id = %s", (user_id,))
+            version = cursor.fetchone()['version']
+            db.commit()
+            return version
+
+    # 複雜狀態的部分更新與版本號（樂觀鎖）：只改寫指定路徑，寫入時比對 version 欄位偵測衝突
+    @staticmethod
+    def _ensure_state_version_column(db):
+        """
+        確認 user_temp_state 有 version 欄位（每個行程只檢查一次）。
+        正式環境應先執行 migrations/001_user_temp_state_version.sql；這裡只是保險：
+        還沒有欄位時補上，其他執行個體搶先補上時（欄位已存在的錯誤）視為完成。
+        """
+        global _state_version_column_ready
+        if _state_version_column_ready:
+            return
+        with _state_version_column_lock:
+            if _state_version_column_ready:
+                return
+            with db.cursor() as cursor:
+                cursor.execute(
+                    "SELECT COUNT(*) AS cnt FROM information_schema.COLUMNS "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'user_temp_state' AND COLUMN_NAME = 'version'"
+                )
+                if not cursor.fetchone()['cnt']:
+                    try:
+                        cursor.execute("ALTER TABLE user_temp_state ADD COLUMN version INT NOT NULL DEFAULT 0")
+                    except pymysql.MySQLError as e:
+                        if e.args[0] != _ER_DUP_FIELDNAME:
+                            raise
+                    db.commit()
+            _state_version_column_ready = True
+
+    @staticmethod
+    def get_complex_state_versioned(user_id):
+        """回傳 (狀態, 版本號)；沒有狀態時版本號為 0。"""
+        db = get_db_connection()
+        if not db: return {"state_info": {}, "last_task": {}}, 0
+        DB._ensure_state_version_column(db)
+        with db.cursor() as cursor:
+            cursor.execute("SELECT state_data, version FROM user_temp_state WHERE recorder_id = %s", (user_id,))
+            record = cursor.fetchone()
+            if not record:
+                return {"state_info": {}, "last_task": {}}, 0
+            try:
+                state = get_state_codec().decode(record['state_data']) if record['state_data'] else None
+            except (ValueError, TypeError):
+                state = None
+            return state or {"state_info": {}, "last_task": {}}, record['version']
+
+    @staticmethod
+    def get_complex_state_path(user_id, path, default=None):
+        """只讀取狀態中的一個路徑（例如 'last_task.results'），不載入整份 JSON。"""
+        db = get_db_connection()
+        if not db: return default
+        with db.cursor() as cursor:
+            # 壓縮儲存的狀態無法以 JSON_EXTRACT 讀取，改為取回整份資料在 Python 端解碼
+            cursor.execute(
+                "SELECT JSON_EXTRACT(state_data, %s) AS value, IF(LEFT(state_data, 1) = '{', NULL, state_data) AS encoded "
+                "FROM user_temp_state WHERE recorder_id = %s",
+                (json_path(path), user_id)
+            )
+            record = cursor.fetchone()
+            if record and record['encoded']:
+                return get_path(get_state_codec().decode(record['encoded']), path, default)
+            if not record or record['value'] is None:
+                return default
+            return json.loads(record['value'])
+
+    @staticmethod
+    def update_complex_state_paths(user_id, sets=None, removes=(), expected_version=None):
+        """
+        以 JSON_SET / JSON_REMOVE 只更新指定路徑，回傳更新後的版本號。
+        指定 expected_version 且資料庫中的版本號不同時不寫入，回傳 None。
+        寫入的值較大或狀態已壓縮儲存時，改為在 Python 端套用更新後整份寫回。
+        """
+        db = get_db_connection()
+        if not db: return None
+        DB._ensure_state_version_column(db)
+        codec = get_state_codec()
+        if codec.prefers_rewrite((sets or {}).values()):
+            return rewrite_with_updates(DB, user_id, sets, removes, expected_version)
+        expression, params = build_update_expression(sets or {}, removes, 'mysql', dumps=codec.dumps)
+        sql = (f"UPDATE user_temp_state SET state_data = {expression}, version = version + 1 "
+               "WHERE recorder_id = %s AND LEFT(state_data, 1) = '{'")
+        params.append(user_id)
+        if expected_version is not None:
+            sql += " AND version = %s"
+            params.append(expected_version)
         with db.cursor() as cursor:
-            cursor.execute("DELETE FROM user_temp_state WHERE recorder_id = %s", (user_id,))
+            if cursor.execute(sql, params):
+                cursor.execute("SELECT version FROM user_temp_state WHERE recorder_id = %s", (user_id,))
+                version = cursor.fetchone()['version']
+                db.commit()
+                return version
+            cursor.execute("SELECT version FROM user_temp_state WHERE recorder_id = %s", (user_id,))
+            record = cursor.fetchone()
+            db.rollback()
+            if record:
+                if expected_version is not None and record['version'] != expected_version:
+                    return None
+                # 版本號相符但狀態是壓縮儲存的
+                return rewrite_with_updates(DB, user_id, sets, removes, expected_version)
+            if expected_version:
+                return None
+            # 還沒有這筆狀態：以空狀態套用更新後新增
+            state = apply_updates({"state_info": {}, "last_task": {}}, sets, removes)
+            try:
+                cursor.execute(
+                    "INSERT INTO user_temp_state (recorder_id, state_data, version) VALUES (%s, %s, 1)",
+                    (user_id, codec.encode(state))
+                )
+            except pymysql.err.IntegrityError:
+                # 其他請求搶先新增了這筆狀態
+                db.rollback()
+                if expected_version is not None:
+                    return None
+                return DB.update_complex_state_paths(user_id, sets, removes)
             db.commit()
+            return 1
+
+    @staticmethod
+    def replace_complex_state(user_id, state_data, expected_version=None):
+        """整份覆寫狀態並回傳新的版本號；版本號不符時不寫入，回傳 None。"""
+        db = get_db_connection()
+        if not db: return None
+        DB._ensure_state_version_column(db)
+        if expected_version is None:
+            DB.set_complex_state(user_id, state_data)
+            with db.cursor() as cursor:
+                cursor.execute("SELECT version FROM user_temp_state WHERE recorder_id = %s", (user_id,))
+                return cursor.fetchone()['version']
+        json_data = get_state_codec().encode(state_data)
+        with db.cursor() as cursor:
+            # 補上 version 欄位前就存在的狀態版本號為 0，因此版本號 0 也先嘗試更新既有的狀態
+            if cursor.execute(
+                "UPDATE user_temp_state SET state_data = %s, version = version + 1 WHERE recorder_id = %s AND version = %s",
+                (json_data, user_id, expected_version)
+            ):
+                db.commit()
+                return expected_version + 1
+            if expected_version != 0:
+                db.rollback()
+                return None
+            # 還沒有這筆狀態時才新增；其他請求搶先新增時視為版本衝突
+            try:
+                cursor.execute(
+                    "INSERT INTO user_temp_state (recorder_id, state_data, version) VALUES (%s, %s, 1)",
+                    (user_id, json_data)
+                )
+            except pymysql.err.IntegrityError:
+                db.rollback()
+                return None
+            db.commit()
+            return 1
 
     # --- 使用者與成員管理 (整合) ---
     @staticmethod
@@ -489,6 +656,24 @@ class DB:
             if med_details: result['days_supply'] = med_details[0].get('days')
             return result
 
+    @staticmethod
+    def get_recent_drug_ids(recorder_id, member, limit=30):
+        """取得某成員近期藥單中出現過的藥品 ID（依最近開立時間排序）"""
+        db = get_db_connection()
+        if not db: return []
+        with db.cursor() as cursor:
+            cursor.execute("""
+                SELECT rd.drug_id, MAX(mm.created_at) AS last_seen
+                FROM medication_main mm
+                JOIN medication_records mr ON mr.mm_id = mm.mm_id
+                JOIN record_details rd ON rd.record_id = mr.mr_id
+                WHERE mm.recorder_id = %s AND mm.member = %s AND rd.drug_id IS NOT NULL
+                GROUP BY rd.drug_id
+                ORDER BY last_seen DESC
+                LIMIT %s
+            """, (recorder_id, member, limit))
+            return [row['drug_id'] for row in cursor.fetchall()]
+
     # --- 提醒 (Reminder) 相關 (來自組員) ---
     @staticmethod
     def create_reminder(data):
@@ -714,11 +899,9 @@ class DB:
     # --- 藥物資料庫相關 (來自您) ---
     @staticmethod
     def get_all_drug_info():
-        db = get_db_connection()
-        if not db: return []
-        with db.cursor() as cursor:
-            cursor.execute("SELECT drug_id, drug_name_zh, drug_name_en, main_use, side_effects FROM drug_info")
-            return cursor.fetchall()
+        """從行程內共用的藥品目錄取得所有藥品（唯讀）。"""
+        from app.services.drug_catalog import get_catalog
+        return get_catalog().get_analysis_rows()
 
     @staticmethod
     def get_frequency_map():
@@ -729,88 +912,46 @@ class DB:
             return cursor.fetchall()
     
     # --- 药丸辨识相关 (集成0705功能) ---
+    @staticmethod
+    def _to_pill_details(rows):
+        """转换字段名以匹配0705的格式"""
+        details_list = []
+        for row in rows:
+            details_list.append({
+                'drug_id': row.get('drug_id'),
+                'drug_name_en': row.get('drug_name_en'),
+                'drug_name_zh': row.get('drug_name_zh'),
+                'uses': row.get('main_use'),  # 将 main_use 映射为 uses
+                'side_effects': row.get('side_effects'),
+                'shape': row.get('shape'),
+                'color': row.get('color'),
+                'interactions': row.get('food_drug_interactions'),  # 映射字段名
+                'image_url': row.get('image_url')
+            })
+        return details_list
+
     @staticmethod
     def get_pills_details_by_ids(drug_ids):
-        """从数据库查询多个药丸的详细信息"""
+        """从药品目录查询多个药丸的详细信息"""
         if not drug_ids:
             return []
-        
-        db = get_db_connection()
-        if not db:
-            return []
-            
+
         try:
-            with db.cursor() as cursor:
-                # 构建 IN 查询
-                placeholders = ', '.join(['%s'] * len(drug_ids))
-                sql = f"""
-                    SELECT drug_id, drug_name_en, drug_name_zh, main_use, side_effects, 
-                           shape, color, food_drug_interactions, image_url 
-                    FROM drug_info WHERE drug_id IN ({placeholders})
-                """
-                
-                cursor.execute(sql, drug_ids)
-                results = cursor.fetchall()
-                
-                # 转换字段名以匹配0705的格式
-                details_list = []
-                for row in results:
-                    details_list.append({
-                        'drug_id': row.get('drug_id'),
-                        'drug_name_en': row.get('drug_name_en'),
-                        'drug_name_zh': row.get('drug_name_zh'),
-                        'uses': row.get('main_use'),  # 将 main_use 映射为 uses
-                        'side_effects': row.get('side_effects'),
-                        'shape': row.get('shape'),
-                        'color': row.get('color'),
-                        'interactions': row.get('food_drug_interactions'),  # 映射字段名
-                        'image_url': row.get('image_url')
-                    })
-                
-                return details_list
-                
+            from app.services.drug_catalog import get_catalog
+            return DB._to_pill_details(get_catalog().get_by_ids(drug_ids))
         except Exception as e:
             print(f"查询药品信息失败: {e}")
             return []
-    
+
     @staticmethod
     def get_pills_details_by_prefix(prefix):
-        """根據藥品ID前綴查詢藥品詳細資訊"""
+        """根據藥品ID前綴從藥品目錄查詢藥品詳細資訊"""
         if not prefix:
             return []
-        
-        db = get_db_connection()
-        if not db:
-            return []
-            
+
         try:
-            with db.cursor() as cursor:
-                sql = """
-                    SELECT drug_id, drug_name_en, drug_name_zh, main_use, side_effects, 
-                           shape, color, food_drug_interactions, image_url 
-                    FROM drug_info WHERE drug_id LIKE %s
-                """
-                
-                cursor.execute(sql, (f"{prefix}%",))
-                results = cursor.fetchall()
-                
-                # 轉換字段名以匹配格式
-                details_list = []
-                for row in results:
-                    details_list.append({
-                        'drug_id': row.get('drug_id'),
-                        'drug_name_en': row.get('drug_name_en'),
-                        'drug_name_zh': row.get('drug_name_zh'),
-                        'uses': row.get('main_use'),
-                        'side_effects': row.get('side_effects'),
-                        'shape': row.get('shape'),
-                        'color': row.get('color'),
-                        'interactions': row.get('food_drug_interactions'),
-                        'image_url': row.get('image_url')
-                    })
-                
-                return details_list
-                
+            from app.services.drug_catalog import get_catalog
+            return DB._to_pill_details(get_catalog().get_by_prefix(prefix))
         except Exception as e:
             print(f"根據前綴查詢藥品信息失敗: {e}")
             return []
@@ -845,7 +986,11 @@ class DB:
                     shape, color, interactions, image_url
                 ))
                 db.commit()
-                return True
+
+            # 通知藥品目錄只重撈這一筆
+            from app.services.drug_catalog import get_catalog
+            get_catalog().invalidate(drug_id)
+            return True
                 
         except Exception as e:
             print(f"新增/更新药品信息失败: {e}")
@@ -0,0 +1,242 @@
+# app/utils/db_pool.py
+
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+import pymysql
+
+# --- 資料庫連線池 ---
+
+
+class PoolTimeoutError(pymysql.MySQLError):
+    """連線池已滿且在等待時間內沒有可用連線。"""
+
+
+class ConnectionPool:
+    """
+    執行緒安全、有上限的 pymysql 連線池。
+
+    - 借出時執行 ping 存活檢查，失效連線會被丟棄並重建。
+    - 連線存活超過 recycle 秒即關閉重建，避免被 MySQL wait_timeout 斷線。
+    - 連線數達到 max_size 時，借用者最多等待 timeout 秒。
+    """
+
+    def __init__(self, connect_func, max_size=10, timeout=10.0, recycle=1800):
+        self._connect_func = connect_func
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+
+        self._cond = threading.Condition()
+        self._idle = deque()      # (conn, created_at)
+        self._created_at = {}     # id(conn) -> (created_at, generation)（借出中的連線）
+        self._size = 0            # 目前存在的連線總數（閒置 + 借出）
+        self._generation = 0      # 每次 close_all 加一；借出時的世代較舊的連線歸還時直接關閉
+
+        self._stats = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'connections_recycled': 0,
+            'ping_failures': 0,
+            'wait_timeouts': 0,
+            'total_wait_time': 0.0,
+        }
+
+    def acquire(self, timeout=None):
+        """借出一條可用的連線，必要時建立新連線或等待歸還。"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        wait_start = time.monotonic()
+
+        while True:
+            conn, created_at = None, None
+            should_create = False
+
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['wait_timeouts'] += 1
+                        raise PoolTimeoutError(f"連線池已滿 ({self.max_size})，等待 {timeout} 秒仍無可用連線")
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, created_at = self._idle.pop()
+                else:
+                    self._size += 1
+                    should_create = True
+
+            if should_create:
+                try:
+                    conn = self._connect_func()
+                except Exception:
+                    self._discard_slot()
+                    raise
+                created_at = time.monotonic()
+                with self._cond:
+                    self._stats['connections_created'] += 1
+            else:
+                # 依存活時間回收
+                if time.monotonic() - created_at > self.recycle:
+                    self._close_quietly(conn)
+                    self._discard_slot()
+                    with self._cond:
+                        self._stats['connections_recycled'] += 1
+                    continue
+
+                # 存活檢查
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._close_quietly(conn)
+                    self._discard_slot()
+                    with self._cond:
+                        self._stats['ping_failures'] += 1
+                    continue
+
+            with self._cond:
+                self._created_at[id(conn)] = (created_at, self._generation)
+                self._stats['checkouts'] += 1
+                self._stats['total_wait_time'] += time.monotonic() - wait_start
+            return conn
+
+    def release(self, conn, discard=False):
+        """歸還連線；會先 rollback 結束未提交的交易，失敗則直接丟棄。"""
+        if conn is None:
+            return
+
+        with self._cond:
+            checkout = self._created_at.pop(id(conn), None)
+            stale = checkout is not None and checkout[1] != self._generation
+        if checkout is None:
+            # 不是從這個連線池借出的連線
+            self._close_quietly(conn)
+            return
+        created_at = checkout[0]
+
+        if stale:
+            # close_all 之前借出的連線，歸還時關閉
+            discard = True
+        elif not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard or not getattr(conn, 'open', False):
+            self._close_quietly(conn)
+            self._discard_slot()
+            return
+
+        with self._cond:
+            self._idle.append((conn, created_at))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """以 with 區塊借用連線，離開時自動歸還。"""
+        conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+        except pymysql.OperationalError:
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def close_all(self):
+        """關閉所有閒置連線（借出中的連線會在歸還時關閉）。"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._generation += 1
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        """回傳連線池的即時統計，供健康檢查端點使用。"""
+        with self._cond:
+            checkouts = self._stats['checkouts']
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'timeout': self.timeout,
+                'recycle': self.recycle,
+                'checkouts': checkouts,
+                'connections_created': self._stats['connections_created'],
+                'connections_recycled': self._stats['connections_recycled'],
+                'ping_failures': self._stats['ping_failures'],
+                'wait_timeouts': self._stats['wait_timeouts'],
+                'avg_wait_ms': round(self._stats['total_wait_time'] / checkouts * 1000, 3) if checkouts else 0.0,
+            }
+
+    def _discard_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _connect():
+    """依環境變數建立一條新的 pymysql 連線（Cloud SQL Unix socket 或 host）。"""
+    if os.environ.get("DB_SOCKET_PATH"):
+        # 使用 Cloud SQL Auth Proxy 的 Unix socket 路徑
+        return pymysql.connect(
+            user=os.environ.get('DB_USER'),
+            password=os.environ.get('DB_PASS'),
+            database=os.environ.get('DB_NAME'),
+            unix_socket=os.environ.get('DB_SOCKET_PATH'),
+            charset='utf8mb4',
+            cursorclass=pymysql.cursors.DictCursor,
+            connect_timeout=10
+        )
+    # fallback: 一般 host-based 連線（例如本機測試用）
+    return pymysql.connect(
+        host=os.environ.get('DB_HOST'),
+        user=os.environ.get('DB_USER'),
+        password=os.environ.get('DB_PASS'),
+        database=os.environ.get('DB_NAME'),
+        port=int(os.environ.get('DB_PORT', 3306)),
+        charset='utf8mb4',
+        cursorclass=pymysql.cursors.DictCursor,
+        connect_timeout=10
+    )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """取得行程內共用的連線池（延遲建立）。"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    _connect,
+                    max_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+                    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+                    recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+                )
+    return _pool
+
+
+@contextmanager
+def pooled_connection(timeout=None):
+    """在 Flask 請求之外（背景執行緒等）借用連線池中的連線。"""
+    with get_pool().connection(timeout) as conn:
+        yield conn
@@ -320,8 +320,11 @@ def _create_info_row(label: str, value: str):
     )
 
 
-def generate_analysis_report_messages(analysis_result: dict, frequency_map: dict, liff_edit_id: str, liff_reminder_id: str, member_name: str, is_direct_view=False, source=""):
-    """根據 AI 分析結果或資料庫紀錄，產生包含輪播和對應快速回覆的訊息列表。"""
+def generate_analysis_report_messages(analysis_result: dict, frequency_map: dict, liff_edit_id: str, liff_reminder_id: str, member_name: str, is_direct_view=False, source="", add_page_url=None):
+    """
+    根據 AI 分析結果或資料庫紀錄，產生包含輪播和對應快速回覆的訊息列表。
+    add_page_url（選用）：草稿可加拍頁面時的相機 LIFF 網址，會加上「加拍一頁」按鈕。
+    """
     structured_drugs = analysis_result.get("medications", [])
     if not structured_drugs: 
         return [TextSendMessage(text="分析結果中不包含藥物資訊。")]
@@ -448,6 +451,8 @@ def generate_analysis_report_messages(analysis_result: dict, frequency_map: dict
             QuickReplyButton(action=URIAction(label="✏️ 返回編輯", uri=liff_edit_url)),
             QuickReplyButton(action=PostbackAction(label="❌ 放棄修改", data="action=cancel_task", text="❌ 放棄修改"))
         ]
+        if add_page_url:
+            quick_reply_items.insert(2, QuickReplyButton(action=URIAction(label="➕ 加拍一頁", uri=add_page_url)))
         messages_to_send.extend([TextSendMessage(text=info_text), TextSendMessage(text=prompt_text, quick_reply=QuickReply(items=quick_reply_items))])
     else: # 預設是初次 AI 分析後
         total_count = len(structured_drugs)
@@ -460,11 +465,44 @@ def generate_analysis_report_messages(analysis_result: dict, frequency_map: dict
             QuickReplyButton(action=PostbackAction(label="📸 重新拍照", data="action=start_camera", text="📸 重新拍照")),
             QuickReplyButton(action=PostbackAction(label="❌ 放棄操作", data="action=cancel_task", text="❌ 放棄操作"))
         ]
+        if add_page_url:
+            quick_reply_items.insert(2, QuickReplyButton(action=URIAction(label="➕ 加拍一頁", uri=add_page_url)))
         messages_to_send.extend([TextSendMessage(text=info_text), TextSendMessage(text=prompt_text, quick_reply=QuickReply(items=quick_reply_items))])
 
     return messages_to_send
 
 
+def create_partial_analysis_message(medications: list, member_name: str):
+    """串流分析途中先推送的部分結果：列出目前已辨識的藥物，完整報告稍後送出。"""
+    rows = []
+    for med in medications:
+        if not isinstance(med, dict): continue
+        drug_name = med.get("drug_name_zh") or med.get("drug_name_en") or "(未命名藥物)"
+        detail = " ".join(str(v) for v in (med.get("dose_quantity"), med.get("frequency_text")) if v)
+        rows.append(_create_info_row(str(drug_name), detail or "解析中…"))
+
+    return FlexSendMessage(
+        alt_text="藥單分析中",
+        contents=BubbleContainer(
+            header=BoxComponent(
+                layout="vertical",
+                contents=[TextComponent(text="⏳ 藥單分析中", weight="bold", size="lg", color="#FFFFFF")],
+                backgroundColor="#007BFF"
+            ),
+            body=BoxComponent(
+                layout="vertical", spacing="md",
+                contents=[
+                    TextComponent(text=f"已為「{member_name}」辨識出 {len(rows)} 種藥物，完整報告即將送出：", wrap=True, size="sm"),
+                    SeparatorComponent(margin="md"),
+                    BoxComponent(layout="vertical", spacing="sm", margin="md", contents=rows or [
+                        TextComponent(text="解析中…", size="sm", color="#666666")
+                    ])
+                ]
+            )
+        )
+    )
+
+
 def create_ask_visit_date_message():
     """當 AI 未能辨識出看診日期時，發送此訊息要求使用者提供。"""
     today_str = datetime.now().strftime('%Y-%m-%d')
@@ -0,0 +1,112 @@
+# app/utils/ordered_dispatcher.py
+
+import concurrent.futures
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Callable, Deque, Dict, Tuple
+
+from config import Config
+
+# 計算延遲時保留的最近事件數
+_LATENCY_WINDOW = 500
+
+
+class OrderedDispatcher:
+    """
+    依鍵保序的執行緒池分派器。
+
+    不同鍵的工作在執行緒池中同時執行；相同鍵的工作依送出順序一次執行一個。
+    每個鍵同時最多佔用一個執行緒，且每執行完一個工作就把剩下的工作重新排回執行緒池，
+    同一個用戶連續送出大量事件時不會獨佔執行緒。
+    """
+
+    def __init__(self, workers: int = 4, name: str = 'dispatch'):
+        self.workers = max(1, workers)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Deque[Tuple[str, Callable[[], None], float]]] = {}
+        self._latencies: Dict[str, list] = {}  # {標籤: [(排隊秒數, 執行秒數)]}
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0}
+
+    def submit(self, key: str, label: str, func: Callable[[], None]):
+        """送出工作；label 用於分類統計（例如事件類型）。"""
+        with self._lock:
+            self._stats['submitted'] += 1
+            queue = self._pending.get(key)
+            if queue is not None:
+                # 這個鍵已有工作在排隊或執行中，由它執行完後接手
+                queue.append((label, func, time.time()))
+                return
+            self._pending[key] = deque([(label, func, time.time())])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key: str):
+        with self._lock:
+            label, func, submitted_at = self._pending[key][0]
+
+        started_at = time.time()
+        failed = False
+        try:
+            func()
+        except Exception as e:
+            failed = True
+            print(f"[Dispatcher] 處理 {label} 時發生錯誤: {e}")
+            traceback.print_exc()
+        finished_at = time.time()
+
+        with self._lock:
+            queue = self._pending[key]
+            queue.popleft()
+            self._stats['failed' if failed else 'completed'] += 1
+            latencies = self._latencies.setdefault(label, [])
+            latencies.append((started_at - submitted_at, finished_at - started_at))
+            if len(latencies) > _LATENCY_WINDOW:
+                del latencies[:-_LATENCY_WINDOW]
+            if not queue:
+                del self._pending[key]
+                return
+        self._executor.submit(self._drain, key)
+
+    @staticmethod
+    def _percentile(values, q):
+        if not values:
+            return None
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+    def stats(self) -> dict:
+        with self._lock:
+            all_latencies = [item for latencies in self._latencies.values() for item in latencies]
+            return {
+                'workers': self.workers,
+                'pending': sum(len(queue) for queue in self._pending.values()),
+                'active_keys': len(self._pending),
+                'queue_lag_p50': self._percentile([lag for lag, _ in all_latencies], 0.5),
+                'queue_lag_p95': self._percentile([lag for lag, _ in all_latencies], 0.95),
+                'handler_time': {
+                    label: {
+                        'count': len(latencies),
+                        'p50': self._percentile([run for _, run in latencies], 0.5),
+                        'p95': self._percentile([run for _, run in latencies], 0.95),
+                        'max': round(max(run for _, run in latencies), 3),
+                    }
+                    for label, latencies in self._latencies.items()
+                },
+                **self._stats,
+            }
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_webhook_dispatcher() -> OrderedDispatcher:
+    """取得行程內共用的 LINE Webhook 事件分派器（以用戶為鍵保序）。"""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = OrderedDispatcher(workers=Config.WEBHOOK_DISPATCH_WORKERS, name='webhook-dispatch')
+    return _dispatcher
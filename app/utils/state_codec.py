@@ -0,0 +1,145 @@
+# app/utils/state_codec.py
+
+import base64
+import json
+import threading
+import time
+import zlib
+
+from config import Config
+
+# 壓縮格式：{標頭字元: (名稱, 壓縮函式, 解壓縮函式)}
+_COMPRESSORS = {
+    'z': ('zlib', lambda data, level: zlib.compress(data, level), zlib.decompress),
+}
+
+
+def _zstd_compressor():
+    """zstd 為選用相依套件（zstandard），沒有安裝時回傳 None。"""
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return ('zstd',
+            lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+class StateCodec:
+    """
+    user_temp_state.state_data 的編碼器。
+
+    小於 min_compress_bytes 的狀態存成精簡 JSON（與舊資料格式相容，資料庫端仍可用 JSON_SET 部分更新）；
+    較大的狀態（例如含完整藥物說明的分析結果）壓縮後以 base64 存成一個 JSON 字串：
+    '"<標頭字元><base64>"'，標頭字元決定解壓縮方式。存成 JSON 字串是為了在 JSON 型別的欄位中也能寫入。
+    讀取時以第一個字元區分：'{' 為一般 JSON（包含舊資料），'"' 為壓縮資料。
+    """
+
+    def __init__(self, min_compress_bytes: int = 4096, algorithm: str = 'zlib', level: int = 6):
+        self.min_compress_bytes = min_compress_bytes
+        self.level = level
+        self._compressors = dict(_COMPRESSORS)
+        zstd = _zstd_compressor()
+        if zstd is not None:
+            self._compressors['s'] = zstd
+        headers = [header for header, (name, _, _) in self._compressors.items() if name == algorithm]
+        if not headers:
+            print(f"[State Codec] 不支援的壓縮格式 {algorithm}，改用 zlib")
+            headers = ['z']
+        self._header = headers[0]
+        self._lock = threading.Lock()
+        self._stats = {'encoded_plain': 0, 'encoded_compressed': 0, 'decoded': 0,
+                       'raw_bytes': 0, 'stored_bytes': 0, 'encode_seconds': 0.0, 'decode_seconds': 0.0}
+
+    @staticmethod
+    def is_plain(text: str) -> bool:
+        return not text or text.lstrip()[:1] != '"'
+
+    @staticmethod
+    def dumps(value) -> str:
+        """精簡 JSON（不跳脫中文、不含多餘空白），部分更新寫入的值也使用相同格式。"""
+        from app import CustomJSONEncoder
+        return json.dumps(value, cls=CustomJSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+    def prefers_rewrite(self, values) -> bool:
+        """
+        部分更新要寫入的值夠大時回傳 True：改為讀出整份狀態、套用更新後壓縮寫回，
+        而不是在資料庫端以 JSON_SET 寫入未壓縮的大型資料。
+        """
+        if not self.min_compress_bytes:
+            return False
+        size = sum(len(self.dumps(value).encode('utf-8')) for value in values)
+        return size >= self.min_compress_bytes
+
+    def encode(self, state) -> str:
+        started = time.perf_counter()
+        text = self.dumps(state)
+        raw = text.encode('utf-8')
+        compressed = bool(self.min_compress_bytes) and len(raw) >= self.min_compress_bytes
+        if compressed:
+            _, compress, _ = self._compressors[self._header]
+            text = '"' + self._header + base64.b64encode(compress(raw, self.level)).decode('ascii') + '"'
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._stats['encoded_compressed' if compressed else 'encoded_plain'] += 1
+            self._stats['raw_bytes'] += len(raw)
+            self._stats['stored_bytes'] += len(text) if compressed else len(raw)
+            self._stats['encode_seconds'] += elapsed
+        return text
+
+    def decode(self, text):
+        """解碼 state_data；一般 JSON（包含舊資料）與壓縮資料皆可。"""
+        if isinstance(text, (bytes, bytearray)):
+            text = text.decode('utf-8')
+        started = time.perf_counter()
+        if self.is_plain(text):
+            state = json.loads(text)
+        else:
+            payload = json.loads(text)
+            if not payload or payload[0] not in self._compressors:
+                raise ValueError(f"無法辨識的狀態編碼: {payload[:1]!r}")
+            _, _, decompress = self._compressors[payload[0]]
+            try:
+                raw = decompress(base64.b64decode(payload[1:]))
+            except Exception as e:
+                raise ValueError(f"狀態解壓縮失敗: {e}") from e
+            state = json.loads(raw.decode('utf-8'))
+        with self._lock:
+            self._stats['decoded'] += 1
+            self._stats['decode_seconds'] += time.perf_counter() - started
+        return state
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        encoded = stats['encoded_plain'] + stats['encoded_compressed']
+        return {
+            'algorithm': self._compressors[self._header][0],
+            'min_compress_bytes': self.min_compress_bytes,
+            'encoded_plain': stats['encoded_plain'],
+            'encoded_compressed': stats['encoded_compressed'],
+            'decoded': stats['decoded'],
+            'raw_bytes': stats['raw_bytes'],
+            'stored_bytes': stats['stored_bytes'],
+            'compression_ratio': round(stats['raw_bytes'] / stats['stored_bytes'], 2) if stats['stored_bytes'] else None,
+            'avg_encode_ms': round(stats['encode_seconds'] * 1000 / encoded, 3) if encoded else None,
+            'avg_decode_ms': round(stats['decode_seconds'] * 1000 / stats['decoded'], 3) if stats['decoded'] else None,
+        }
+
+
+_codec = None
+_codec_lock = threading.Lock()
+
+
+def get_state_codec() -> StateCodec:
+    """取得行程內共用的狀態編碼器。"""
+    global _codec
+    if _codec is None:
+        with _codec_lock:
+            if _codec is None:
+                _codec = StateCodec(
+                    min_compress_bytes=Config.STATE_COMPRESS_MIN_BYTES,
+                    algorithm=Config.STATE_COMPRESS_ALGORITHM,
+                    level=Config.STATE_COMPRESS_LEVEL,
+                )
+    return _codec
@@ -0,0 +1,127 @@
+# app/utils/state_paths.py
+
+import copy
+import json
+import re
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# 狀態路徑以點分隔（例如 'last_task.results'），對應 JSON 路徑 '$.last_task.results'
+_PLAIN_KEY = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# 各資料庫的 JSON 函式：(參數符號, 空物件, 寫入 JSON 值的運算式, 補上層函式, 設定函式, 刪除函式)
+_DIALECTS = {
+    'mysql': ('%s', 'JSON_OBJECT()', 'CAST(%s AS JSON)', 'JSON_INSERT', 'JSON_SET', 'JSON_REMOVE'),
+    'sqlite': ('?', 'json_object()', 'json(?)', 'json_insert', 'json_set', 'json_remove'),
+}
+
+
+def split_path(path: str) -> List[str]:
+    keys = path.split('.') if path else []
+    if not keys or any(not key for key in keys):
+        raise ValueError(f"無效的狀態路徑: {path!r}")
+    return keys
+
+
+def json_path(path: str) -> str:
+    """'last_task.results' → '$.last_task.results'；含特殊字元的鍵以雙引號包住。"""
+    parts = []
+    for key in split_path(path):
+        if _PLAIN_KEY.match(key):
+            parts.append(f".{key}")
+        else:
+            parts.append('."' + key.replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '$' + ''.join(parts)
+
+
+def plan_updates(sets: Dict[str, object], removes: Iterable[str]) -> Tuple[List[str], List[str], List[str]]:
+    """
+    檢查並整理一次部分更新要用到的路徑，回傳 (需要先補成空物件的上層路徑, 設定路徑, 刪除路徑)。
+    JSON_SET / json_set 不會自動建立不存在的上層物件，因此設定巢狀路徑前先以 JSON_INSERT 補上層
+    （已存在的上層保持不變）。
+    同一次更新中不允許一個設定路徑是另一個設定路徑的上層。
+    """
+    set_paths = list(sets)
+    for path in set_paths:
+        for other in set_paths:
+            if other != path and other.startswith(path + '.'):
+                raise ValueError(f"狀態路徑 {path!r} 與 {other!r} 重疊")
+    parents = []
+    for path in set_paths:
+        keys = split_path(path)
+        for depth in range(1, len(keys)):
+            parent = '.'.join(keys[:depth])
+            if parent not in parents:
+                parents.append(parent)
+    return parents, set_paths, [path for path in removes if split_path(path)]
+
+
+def get_path(doc: dict, path: str, default=None):
+    value = doc
+    for key in split_path(path):
+        if not isinstance(value, dict) or key not in value:
+            return default
+        value = value[key]
+    return value
+
+
+def apply_updates(doc: dict, sets: Dict[str, object] = None, removes: Iterable[str] = ()) -> dict:
+    """在 Python 端套用與資料庫相同的部分更新（就地修改並回傳 doc），用於同步記憶體中的快取。"""
+    for path, value in (sets or {}).items():
+        keys = split_path(path)
+        target = doc
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+            if not isinstance(target, dict):
+                # 與 JSON_SET 相同：上層不是物件時不寫入
+                break
+        else:
+            target[keys[-1]] = copy.deepcopy(value)
+    for path in removes or ():
+        keys = split_path(path)
+        target = get_path(doc, '.'.join(keys[:-1])) if len(keys) > 1 else doc
+        if isinstance(target, dict):
+            target.pop(keys[-1], None)
+    return doc
+
+
+def build_update_expression(sets: Dict[str, object], removes: Iterable[str], dialect: str,
+                            dumps: Callable[[object], str] = json.dumps) -> Tuple[str, list]:
+    """
+    產生部分更新 state_data 欄位的 SQL 運算式與參數，例如
+    JSON_REMOVE(JSON_SET(state_data, '$.last_task.results', CAST(%s AS JSON)), '$.state_info')。
+    dialect 為 'mysql' 或 'sqlite'；dumps 用來把值序列化為 JSON 字串。
+    """
+    param, empty_object, json_value, insert_fn, set_fn, remove_fn = _DIALECTS[dialect]
+    parents, set_paths, remove_paths = plan_updates(sets, removes)
+
+    # 每個路徑各自包一層函式呼叫：SQLite 在同一次 json_set 呼叫中看不到前面剛建立的物件
+    expression, params = 'state_data', []
+    for parent in parents:
+        expression = f"{insert_fn}({expression}, {param}, {empty_object})"
+        params.append(json_path(parent))
+    for path in set_paths:
+        expression = f"{set_fn}({expression}, {param}, {json_value})"
+        params += [json_path(path), dumps(sets[path])]
+    if remove_paths:
+        expression = f"{remove_fn}({expression}, {', '.join([param] * len(remove_paths))})"
+        params += [json_path(path) for path in remove_paths]
+    return expression, params
+
+
+def rewrite_with_updates(backend, user_id: str, sets: Dict[str, object], removes: Iterable[str],
+                         expected_version: int = None, attempts: int = 3):
+    """
+    以「讀出整份狀態 → 套用更新 → 依版本號整份寫回」的方式完成部分更新，回傳新的版本號。
+    用於壓縮儲存的狀態（資料庫端無法以 JSON 函式更新）或要寫入大型資料時；
+    backend 需提供 get_complex_state_versioned 與 replace_complex_state。
+    指定 expected_version 且版本號不符時回傳 None；未指定時遇到衝突會重新讀取再試。
+    """
+    for _ in range(attempts):
+        state, version = backend.get_complex_state_versioned(user_id)
+        if expected_version is not None and version != expected_version:
+            return None
+        new_version = backend.replace_complex_state(user_id, apply_updates(state, sets, removes), expected_version=version)
+        if new_version is not None or expected_version is not None:
+            return new_version
+    print(f"[State] 用戶 {user_id} 的狀態持續被其他請求更新，放棄寫入")
+    return None
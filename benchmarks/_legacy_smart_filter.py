@@ -0,0 +1,305 @@
+# benchmarks/_legacy_smart_filter.py
+"""
+改版前的 smart_filter_drugs（每次請求都對每個藥名重新做標準化 / 拆解），
+僅供 bench_smart_filter.py 比較效能與結果一致性使用。
+"""
+
+from typing import Dict, List
+
+
+def normalize_drug_name(name):
+    """標準化藥物名稱，移除特殊字符和空格"""
+    if not name:
+        return ""
+    
+    # 轉為小寫並移除各種特殊字符
+    normalized = (name.lower()
+                 .replace("_", "")
+                 .replace("-", "")
+                 .replace(" ", "")
+                 .replace("\"", "")
+                 .replace("'", "")
+                 .replace(".", "")
+                 .replace("(", "")
+                 .replace(")", "")
+                 .replace("[", "")
+                 .replace("]", "")
+                 .replace(",", ""))
+    
+    return normalized
+
+def extract_drug_components(name):
+    """提取藥物名稱的主要組成部分"""
+    if not name:
+        return []
+    
+    import re
+    
+    # 移除劑量信息 (如 0.125MG, 10mg 等)
+    name_clean = re.sub(r'\d+\.?\d*\s*mg|tablets?|capsules?', '', name, flags=re.IGNORECASE)
+    
+    # 分割成組件
+    components = []
+    
+    # 按常見分隔符分割
+    parts = re.split(r'[_\-\s"\'\.]+', name_clean)
+    
+    for part in parts:
+        part = part.strip()
+        if part and len(part) > 1:  # 忽略單字符
+            components.append(part.lower())
+    
+    return components
+
+def smart_filter_drugs(all_drugs: List[Dict], keywords: List[str]) -> List[Dict]:
+    """改進的藥物篩選函數，支持更靈活的匹配"""
+    import difflib
+    
+    # 過濾掉 None 值的關鍵字
+    keywords = [kw for kw in (keywords or []) if kw is not None and str(kw).strip()]
+    
+    if not keywords:
+        print("[Smart Filter] 沒有關鍵字，使用前20種藥物")
+        return all_drugs[:20]
+    
+    filtered_drugs = []
+    match_scores = []  # 記錄匹配分數
+    
+    for drug in all_drugs:
+        drug_zh = drug.get('drug_name_zh', '') or ''
+        drug_en = drug.get('drug_name_en', '') or ''
+        
+        max_score = 0
+        best_match_info = ""
+        
+        # 檢查每個關鍵字
+        for keyword in keywords:
+            if keyword is None:
+                continue
+            keyword_lower = keyword.lower()
+            
+            # 方法1: 直接包含匹配
+            if (keyword_lower in drug_zh.lower() or 
+                keyword_lower in drug_en.lower()):
+                score = 1.0
+                match_info = f"direct_match({keyword})"
+                if score > max_score:
+                    max_score = score
+                    best_match_info = match_info
+            
+            # 方法2: 標準化後匹配
+            normalized_keyword = normalize_drug_name(keyword)
+            normalized_zh = normalize_drug_name(drug_zh)
+            normalized_en = normalize_drug_name(drug_en)
+            
+            if (normalized_keyword in normalized_zh or 
+                normalized_keyword in normalized_en):
+                score = 0.9
+                match_info = f"normalized_match({keyword})"
+                if score > max_score:
+                    max_score = score
+                    best_match_info = match_info
+            
+            # 方法3: 組件匹配 (如 spalytic_hs -> spalytic + hs)
+            keyword_components = extract_drug_components(keyword)
+            drug_zh_components = extract_drug_components(drug_zh)
+            drug_en_components = extract_drug_components(drug_en)
+            
+            if keyword_components:
+                # 檢查所有關鍵字組件是否都能在藥物名稱中找到
+                zh_matches = sum(1 for kc in keyword_components 
+                               if any(kc in dc for dc in drug_zh_components))
+                en_matches = sum(1 for kc in keyword_components 
+                               if any(kc in dc for dc in drug_en_components))
+                
+                component_score_zh = zh_matches / len(keyword_components)
+                component_score_en = en_matches / len(keyword_components)
+                component_score = max(component_score_zh, component_score_en)
+                
+                if component_score >= 0.5:  # 降低到50%的組件匹配
+                    score = 0.8 * component_score
+                    match_info = f"component_match({keyword}:{component_score:.2f})"
+                    if score > max_score:
+                        max_score = score
+                        best_match_info = match_info
+            
+            # 方法3.5: 強化的spalytic_hs特殊處理
+            if 'spalytic' in keyword_lower and 'hs' in keyword_lower:
+                if ('spalytic' in drug_en.lower() and 'hs' in drug_en.lower()) or \
+                   ('spalytic' in drug_zh.lower() and 'hs' in drug_zh.lower()):
+                    score = 0.95  # 給予很高的分數
+                    match_info = f"spalytic_hs_special_match({keyword})"
+                    if score > max_score:
+                        max_score = score
+                        best_match_info = match_info
+            
+            # 方法3.6: 摩舒益多特殊處理 - 多種變體匹配
+            mosapride_variants = ['摩舒益多', 'mosapride', '摩舒', '益多', 'mosa', 'pride']
+            drug_combined = (drug_zh + ' ' + drug_en).lower()
+            
+            if any(variant in keyword_lower for variant in mosapride_variants):
+                # 檢查藥物名稱是否包含摩舒益多的任何形式
+                if any(variant in drug_combined for variant in ['摩舒益多', 'mosapride', '摩舒', 'mosa']):
+                    score = 0.95
+                    match_info = f"mosapride_special_match({keyword})"
+                    if score > max_score:
+                        max_score = score
+                        best_match_info = match_info
+            
+            # 方法3.7: 瓦斯康錠/Gascon特殊處理 - OCR誤識修正
+            gascon_variants = ['卡斯康', '瓦斯康', '加斯康', 'cascon', 'gascon', 'kascon']
+            
+            # 檢查關鍵字是否包含瓦斯康的變體
+            if any(variant in keyword_lower for variant in gascon_variants):
+                # 檢查藥物名稱是否包含瓦斯康或gascon
+                if ('瓦斯康' in drug_zh.lower() or 'gascon' in drug_en.lower() or 
+                    'cascon' in drug_en.lower() or 'kascon' in drug_en.lower()):
+                    score = 0.95
+                    match_info = f"gascon_special_match({keyword})"
+                    if score > max_score:
+                        max_score = score
+                        best_match_info = match_info
+            
+            # 特殊處理：如果關鍵字包含「斯康」相關且有劑量資訊
+            elif (('斯康' in keyword_lower or 'scon' in keyword_lower) and 
+                  any(dose in keyword_lower for dose in ['40', '毫克', 'mg'])):
+                if ('瓦斯康' in drug_zh.lower() or 'gascon' in drug_en.lower() or 
+                    'cascon' in drug_en.lower()):
+                    score = 0.9
+                    match_info = f"gascon_partial_match({keyword})"
+                    if score > max_score:
+                        max_score = score
+                        best_match_info = match_info
+            
+            # 進一步特殊處理：40mg相關的gascon變體
+            elif ('40' in keyword_lower and any(variant in keyword_lower for variant in ['cas', 'gas', 'kas'])):
+                if ('gascon' in drug_en.lower() or 'cascon' in drug_en.lower() or '瓦斯康' in drug_zh.lower()):
+                    score = 0.85
+                    match_info = f"gascon_40mg_match({keyword})"
+                    if score > max_score:
+                        max_score = score
+                        best_match_info = match_info
+            
+            # 方法4: 相似度匹配 (使用較低的閾值)
+            similarity_zh = difflib.SequenceMatcher(None, keyword_lower, drug_zh.lower()).ratio()
+            similarity_en = difflib.SequenceMatcher(None, keyword_lower, drug_en.lower()).ratio()
+            similarity = max(similarity_zh, similarity_en)
+            
+            if similarity >= 0.6:  # 降低相似度閾值
+                score = 0.6 * similarity
+                match_info = f"similarity_match({keyword}:{similarity:.2f})"
+                if score > max_score:
+                    max_score = score
+                    best_match_info = match_info
+            
+            # 方法5: 部分詞匹配
+            keyword_words = keyword_lower.replace('_', ' ').split()
+            matched_words = 0
+            for word in keyword_words:
+                if len(word) > 1:  # 降低最小長度要求
+                    if (word in drug_zh.lower() or word in drug_en.lower()):
+                        matched_words += 1
+            
+            if matched_words > 0:
+                word_match_ratio = matched_words / len(keyword_words)
+                if word_match_ratio >= 0.5:  # 至少50%的詞匹配
+                    score = 0.4 + (0.3 * word_match_ratio)  # 0.4-0.7分數範圍
+                    match_info = f"partial_word_match({matched_words}/{len(keyword_words)})"
+                    if score > max_score:
+                        max_score = score
+                        best_match_info = match_info
+            
+            # 方法6: 超級寬鬆匹配 - 確保不遺漏任何可能的匹配
+            # 移除所有非字母數字字符後進行匹配
+            keyword_clean = ''.join(c for c in keyword_lower if c.isalnum())
+            drug_en_clean = ''.join(c for c in drug_en.lower() if c.isalnum())
+            drug_zh_clean = ''.join(c for c in drug_zh.lower() if c.isalnum())
+            
+            if len(keyword_clean) > 3:  # 避免太短的匹配
+                if (keyword_clean in drug_en_clean or keyword_clean in drug_zh_clean):
+                    score = 0.3
+                    match_info = f"ultra_loose_match({keyword})"
+                    if score > max_score:
+                        max_score = score
+                        best_match_info = match_info
+        
+        # 終極保障：硬編碼關鍵匹配規則，確保100%匹配成功
+        for keyword in keywords:
+            if keyword is None:
+                continue
+            keyword_lower = keyword.lower()
+            drug_en_lower = drug_en.lower()
+            drug_zh_lower = drug_zh.lower()
+            
+            # 特殊規則：spalytic_hs 系列
+            if 'spalytic' in keyword_lower and 'hs' in keyword_lower:
+                if 'spalytic' in drug_en_lower and 'hs' in drug_en_lower:
+                    max_score = 1.0
+                    best_match_info = f"guaranteed_spalytic_hs_match({keyword})"
+                    break
+            
+            # 特殊規則：摩舒益多系列 - 終極保障
+            mosapride_check = ['摩舒益多', 'mosapride', '摩舒', 'mosa']
+            if any(variant in keyword_lower for variant in mosapride_check):
+                if any(variant in drug_en_lower or variant in drug_zh_lower for variant in mosapride_check):
+                    max_score = 1.0
+                    best_match_info = f"guaranteed_mosapride_match({keyword})"
+                    break
+            
+            # 特殊規則：移除所有符號後的完全匹配
+            keyword_alpha = ''.join(c for c in keyword_lower if c.isalpha())
+            drug_en_alpha = ''.join(c for c in drug_en_lower if c.isalpha())
+            drug_zh_alpha = ''.join(c for c in drug_zh_lower if c.isalpha())
+            
+            if len(keyword_alpha) > 4 and (keyword_alpha in drug_en_alpha or keyword_alpha in drug_zh_alpha):
+                if max_score < 0.8:
+                    max_score = 0.8
+                    best_match_info = f"guaranteed_alpha_match({keyword})"
+        
+        # 如果有匹配，加入結果
+        if max_score > 0:
+            match_scores.append((drug, max_score, best_match_info))
+    
+    # 按匹配分數排序
+    match_scores.sort(key=lambda x: x[1], reverse=True)
+    
+    # 取前面的匹配結果
+    for drug, score, match_info in match_scores:
+        filtered_drugs.append(drug)
+        print(f"[Smart Filter] 匹配: {drug.get('drug_name_en', '')} | {drug.get('drug_name_zh', '')} | {match_info} | 分數: {score:.3f}")
+    
+    # 終極檢查：確保關鍵藥物不被遺漏
+    critical_keywords = ['spalytic', 'spalytic_hs', 'spalyticus', '摩舒益多', 'mosapride', '摩舒', '益多', 
+                        '卡斯康', '瓦斯康', '加斯康', 'cascon', 'gascon', 'kascon']
+    for critical_keyword in critical_keywords:
+        if any(critical_keyword.lower() in (kw or '').lower() for kw in keywords if kw is not None):
+            # 強制搜索包含關鍵詞的所有藥物
+            search_terms = []
+            if critical_keyword.lower() in ['spalytic', 'spalytic_hs', 'spalyticus']:
+                search_terms = ['spalytic']
+            elif critical_keyword.lower() in ['摩舒益多', 'mosapride', '摩舒', '益多']:
+                search_terms = ['摩舒益多', 'mosapride', '摩舒']
+            elif critical_keyword.lower() in ['卡斯康', '瓦斯康', '加斯康', 'cascon', 'gascon', 'kascon']:
+                search_terms = ['瓦斯康', 'gascon', 'cascon']
+            
+            for search_term in search_terms:
+                for drug in all_drugs:
+                    drug_en = (drug.get('drug_name_en') or '').lower()
+                    drug_zh = (drug.get('drug_name_zh') or '').lower()
+                    if search_term.lower() in drug_en or search_term in drug_zh:
+                        if drug not in filtered_drugs:
+                            filtered_drugs.append(drug)
+                            print(f"[Smart Filter] 強制加入關鍵藥物: {drug.get('drug_name_en', '')} | {drug.get('drug_name_zh', '')}")
+    
+    # 如果篩選結果太少，補充一些常用藥物
+    if len(filtered_drugs) < 5:
+        print(f"[Smart Filter] 篩選結果太少({len(filtered_drugs)})，補充常用藥物")
+        common_drugs = all_drugs[:15]
+        for drug in common_drugs:
+            if drug not in filtered_drugs:
+                filtered_drugs.append(drug)
+                if len(filtered_drugs) >= 15:
+                    break
+    
+    print(f"[Smart Filter] 篩選結果: {len(filtered_drugs)} 種藥物")
+    return filtered_drugs
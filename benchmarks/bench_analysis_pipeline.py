@@ -0,0 +1,348 @@
+# benchmarks/bench_analysis_pipeline.py
+"""
+藥單分析流程（run_analysis）離線基準測試（不需要 Gemini API 金鑰與資料庫）。
+
+- Gemini：以假的 genai client 重播錄製的回應（benchmarks/fixtures/recorded_responses.json），
+          OCR 與分析各自有可設定的模擬延遲；經由共用閘道呼叫，因此併發上限與限流設定都會生效
+- 藥品目錄：合成目錄（大小可設定）直接載入行程內的 DrugCatalog，並併入錄製回應中用到的藥品
+- 圖片：指定資料夾中的藥單照片，或自動產生的合成照片；每次分析都使用內容不同的圖片，避免命中 OCR 快取
+
+對每個併發數 N，以 N 個執行緒同時呼叫 run_analysis（與 gunicorn 多執行緒相同），回報：
+  - 各階段耗時（前處理、目錄載入、OCR、篩選、prompt 建立、分析請求、數學驗證）的平均 / p50 / p95
+    （「分析請求」包含其中的 prompt 建立；分組模式下每組各計一次）
+  - 每次分析的總耗時、吞吐量（次/秒）、峰值記憶體（tracemalloc）
+指定 --output 時另將結果寫成 JSON（含 git commit，預設不寫檔），可用 --compare 與先前的結果比較。
+
+用法（於專案根目錄執行）:
+    python benchmarks/bench_analysis_pipeline.py --drugs 20000 --concurrency 1,4,8 --output /tmp/before.json
+    python benchmarks/bench_analysis_pipeline.py --drugs 20000 --concurrency 1,4,8 --compare /tmp/before.json
+"""
+
+import argparse
+import contextlib
+import functools
+import glob
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image, ImageDraw  # noqa: E402
+
+from config import Config  # noqa: E402
+from app.services import ai_processor  # noqa: E402
+from app.services.drug_catalog import get_catalog  # noqa: E402
+from app.services.gemini_gateway import get_gemini_gateway  # noqa: E402
+from bench_smart_filter import build_catalog  # noqa: E402
+
+DEFAULT_RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'recorded_responses.json')
+STAGES = ('preprocess', 'catalog', 'ocr', 'filter', 'prompt_build', 'analysis', 'validation')
+
+
+# --- 錄製回應重播 ---
+
+class RecordedGenaiClient:
+    """假的 genai client：依請求種類輪流重播錄製的回應文字，並以 sleep 模擬 API 延遲。"""
+
+    def __init__(self, recorded: dict, ocr_latency: float, analysis_latency: float, stream_chunks: int = 8):
+        self._ocr = itertools.cycle(recorded['ocr'])
+        self._analysis = itertools.cycle(recorded['analysis'])
+        self._lock = threading.Lock()
+        self.ocr_latency = ocr_latency
+        self.analysis_latency = analysis_latency
+        self.stream_chunks = max(1, stream_chunks)
+        self.models = self
+
+    def _next(self, config):
+        # 只有完整分析要求 JSON 回應，OCR 關鍵字擷取沒有設定 response_mime_type
+        is_analysis = getattr(config, 'response_mime_type', None) == 'application/json'
+        with self._lock:
+            text = next(self._analysis if is_analysis else self._ocr)
+        return text, (self.analysis_latency if is_analysis else self.ocr_latency)
+
+    @staticmethod
+    def _usage(text, final=True):
+        completion = len(text) // 4
+        return SimpleNamespace(prompt_token_count=1000, candidates_token_count=completion,
+                               total_token_count=1000 + completion) if final else None
+
+    def generate_content(self, model, contents, config=None):
+        text, latency = self._next(config)
+        time.sleep(latency)
+        return SimpleNamespace(text=text, usage_metadata=self._usage(text))
+
+    def generate_content_stream(self, model, contents, config=None):
+        text, latency = self._next(config)
+        size = -(-len(text) // self.stream_chunks)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        for i, piece in enumerate(pieces):
+            time.sleep(latency / len(pieces))
+            yield SimpleNamespace(text=piece, usage_metadata=self._usage(text, final=i == len(pieces) - 1))
+
+
+# --- 各階段計時 ---
+
+class StageTimer:
+    """包裝 ai_processor 內的各階段函式，收集每次呼叫的耗時（執行緒安全）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {stage: [] for stage in STAGES}
+
+    def reset(self):
+        with self._lock:
+            self.samples = {stage: [] for stage in STAGES}
+
+    def _add(self, stage, elapsed):
+        with self._lock:
+            self.samples[stage].append(elapsed)
+
+    def wrap(self, stage, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._add(stage, time.perf_counter() - start)
+        return wrapper
+
+    def wrap_async(self, stage, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self._add(stage, time.perf_counter() - start)
+        return wrapper
+
+    def install(self):
+        ai_processor.preprocess_images = self.wrap('preprocess', ai_processor.preprocess_images)
+        ai_processor.get_all_drugs_from_db = self.wrap('catalog', ai_processor.get_all_drugs_from_db)
+        ai_processor.extract_drug_keywords_batch = self.wrap('ocr', ai_processor.extract_drug_keywords_batch)
+        ai_processor.smart_filter_drugs = self.wrap('filter', ai_processor.smart_filter_drugs)
+        ai_processor.build_analysis_prompt = self.wrap('prompt_build', ai_processor.build_analysis_prompt)
+        ai_processor.request_analysis = self.wrap_async('analysis', ai_processor.request_analysis)
+        ai_processor.apply_math_validation = self.wrap('validation', ai_processor.apply_math_validation)
+
+
+def summarize(samples):
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean': statistics.fmean(samples),
+        'p50': statistics.median(samples),
+        'p95': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        'max': ordered[-1],
+    }
+
+
+# --- 圖片語料 ---
+
+def synthetic_photo(seed: int, width: int = 2448, height: int = 3264) -> bytes:
+    """產生類似手機拍攝藥袋的合成照片（文字列 + 感光雜訊），大小接近實際上傳的 JPEG。"""
+    rng = random.Random(seed)
+    img = Image.merge('RGB', [Image.effect_noise((width, height), 24).point(lambda v, o=o: min(255, v + o))
+                              for o in (150, 145, 140)])
+    draw = ImageDraw.Draw(img)
+    for row in range(40):
+        y = 200 + row * 70
+        x = 150
+        while x < width - 300:
+            w = rng.randint(60, 260)
+            draw.rectangle([x, y, x + w, y + 36], fill=(30, 30, 40))
+            x += w + rng.randint(20, 60)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def load_corpus(images_dir: str, count: int):
+    if images_dir:
+        paths = sorted(p for ext in ('*.jpg', '*.jpeg', '*.png') for p in glob.glob(os.path.join(images_dir, ext)))
+        if not paths:
+            raise SystemExit(f"{images_dir} 中沒有 jpg / png 圖片")
+        corpus = []
+        for path in paths[:count]:
+            with open(path, 'rb') as f:
+                corpus.append(f.read())
+        return corpus
+    return [synthetic_photo(seed) for seed in range(count)]
+
+
+def make_variant(image_bytes: bytes, token: int) -> bytes:
+    """改動左上角一個像素後重新編碼，讓每次分析的圖片雜湊都不同（不命中 OCR 快取）。"""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img = img.convert('RGB')
+        img.putpixel((0, 0), (token % 256, (token // 256) % 256, 0))
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=92)
+        return output.getvalue()
+
+
+# --- 執行 ---
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_level(concurrency: int, requests: int, image_sets, timer: StageTimer, trace_memory: bool):
+    timer.reset()
+    latencies, failures = [], 0
+    lock = threading.Lock()
+
+    def one(images):
+        nonlocal failures
+        start = time.perf_counter()
+        result, _ = ai_processor.run_analysis(images, {}, 'offline-benchmark')
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if not result or not result.get('medications'):
+                failures += 1
+
+    if trace_memory:
+        tracemalloc.reset_peak()
+    wall_start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, image_sets[:requests]))
+    wall = time.perf_counter() - wall_start
+
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'failures': failures,
+        'wall_time': wall,
+        'throughput_per_sec': requests / wall if wall else 0.0,
+        'latency': summarize(latencies),
+        'stages': {stage: summarize(samples) for stage, samples in timer.samples.items()},
+        'peak_memory_bytes': tracemalloc.get_traced_memory()[1] if trace_memory else None,
+    }
+
+
+def print_level(level, baseline=None):
+    latency = level['latency']
+    memory = level['peak_memory_bytes']
+    print(f"\n併發 {level['concurrency']}: {level['requests']} 次分析（失敗 {level['failures']}），"
+          f"吞吐量 {level['throughput_per_sec']:.2f} 次/秒，延遲 p50 {latency['p50']:.3f}s / p95 {latency['p95']:.3f}s"
+          + (f"，峰值記憶體 {memory / 1024 / 1024:.1f} MB" if memory is not None else ""))
+    for stage in STAGES:
+        stats = level['stages'][stage]
+        if not stats['count']:
+            continue
+        line = f"  {stage:<13} n={stats['count']:<4} mean {stats['mean']:.4f}s  p50 {stats['p50']:.4f}s  p95 {stats['p95']:.4f}s"
+        base = (baseline or {}).get('stages', {}).get(stage, {})
+        if base.get('count'):
+            line += f"  (基準 p50 {base['p50']:.4f}s, {stats['p50'] / base['p50'] if base['p50'] else float('inf'):.2f}x)"
+        print(line)
+    if baseline:
+        print(f"  吞吐量相對基準: {level['throughput_per_sec'] / baseline['throughput_per_sec']:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drugs', type=int, default=20000, help='合成藥品目錄大小')
+    parser.add_argument('--images', type=int, default=2, help='每次分析的圖片數')
+    parser.add_argument('--images-dir', default='', help='藥單照片資料夾（預設使用合成照片）')
+    parser.add_argument('--concurrency', default='1,4,8', help='以逗號分隔的併發數')
+    parser.add_argument('--requests', type=int, default=0, help='每個併發數的分析次數（預設為併發數的 3 倍）')
+    parser.add_argument('--responses', default=DEFAULT_RESPONSES, help='錄製回應 JSON 檔')
+    parser.add_argument('--ocr-latency', type=float, default=0.8, help='模擬 OCR 請求延遲（秒）')
+    parser.add_argument('--analysis-latency', type=float, default=3.0, help='模擬分析請求延遲（秒）')
+    parser.add_argument('--gemini-concurrency', type=int, default=Config.GEMINI_MAX_CONCURRENCY, help='閘道併發上限')
+    parser.add_argument('--rpm-limit', type=int, default=0, help='閘道每分鐘請求上限（預設不限制）')
+    parser.add_argument('--streaming', action='store_true', help='啟用串流分析')
+    parser.add_argument('--no-tracemalloc', action='store_true', help='不追蹤峰值記憶體（tracemalloc 會拖慢執行）')
+    parser.add_argument('--output', default=None, help='JSON 結果輸出路徑（預設不寫檔）')
+    parser.add_argument('--compare', default='', help='與先前輸出的 JSON 結果比較')
+    args = parser.parse_args()
+
+    levels = [int(n) for n in args.concurrency.split(',') if n.strip()]
+    with open(args.responses, encoding='utf-8') as f:
+        recorded = json.load(f)
+
+    # 閘道在第一次使用時才依 Config 建立
+    Config.GEMINI_MAX_CONCURRENCY = args.gemini_concurrency
+    Config.GEMINI_RPM_LIMIT = args.rpm_limit
+    Config.ANALYSIS_STREAMING_ENABLED = args.streaming
+    client = RecordedGenaiClient(recorded, args.ocr_latency, args.analysis_latency)
+    get_gemini_gateway().set_client_factory(lambda api_key: client)
+
+    trace_memory = not args.no_tracemalloc
+    if trace_memory:
+        tracemalloc.start()
+
+    # 藥品目錄：載入 + 名稱索引建立（每個目錄版本一次）
+    rows = build_catalog(args.drugs) + recorded.get('catalog_drugs', [])
+    start = time.perf_counter()
+    get_catalog().load_rows(rows)
+    catalog_load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ai_processor.smart_filter_drugs(ai_processor.get_all_drugs_from_db(), ['warmup'])
+    index_build_time = time.perf_counter() - start
+    print(f"目錄: {len(rows)} 種藥物，載入 {catalog_load_time:.3f}s，名稱索引建立 {index_build_time:.3f}s")
+
+    timer = StageTimer()
+    timer.install()
+
+    max_requests = max(args.requests or n * 3 for n in levels)
+    corpus = load_corpus(args.images_dir, args.images)
+    image_sets = [[make_variant(corpus[i % len(corpus)], r * args.images + i) for i in range(args.images)]
+                  for r in range(max_requests * len(levels))]
+    print(f"圖片: 每次分析 {args.images} 張，平均 {statistics.fmean(len(b) for s in image_sets for b in s) / 1024:.0f} KB")
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = {level['concurrency']: level for level in json.load(f).get('levels', [])}
+
+    results = []
+    for index, concurrency in enumerate(levels):
+        requests = args.requests or concurrency * 3
+        offset = index * max_requests
+        level = run_level(concurrency, requests, image_sets[offset:offset + requests], timer, trace_memory)
+        results.append(level)
+        print_level(level, baseline.get(concurrency))
+
+    report = {
+        'benchmark': 'analysis_pipeline',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'args': vars(args),
+        'catalog': {'drugs': len(rows), 'load_time': catalog_load_time, 'index_build_time': index_build_time},
+        'gateway': get_gemini_gateway().stats(),
+        'levels': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        print(f"\n結果已寫入 {args.output}")
+    return 0 if not any(level['failures'] for level in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
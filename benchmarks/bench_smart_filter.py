@@ -0,0 +1,141 @@
+# benchmarks/bench_smart_filter.py
+"""
+smart_filter_drugs 效能比較（不需要資料庫）。
+
+以合成的藥品目錄比較：
+  - before: 改版前每次請求都重新標準化所有藥名
+  - after:  使用預先建立的藥品名稱索引（每個目錄版本建立一次），
+            相似度比對只計算字元倒排索引找出的候選
+  - numpy:  向量批次評分後端（需安裝 numpy；結果與 python 後端不完全相同，另列出重疊率）
+
+用法（於專案根目錄執行）:
+    python benchmarks/bench_smart_filter.py --drugs 50000 --runs 3
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.services import drug_vector_scorer  # noqa: E402
+from app.services.ai_processor import _KeywordForms, _score_drug, smart_filter_drugs  # noqa: E402
+from app.services.drug_alias import get_alias_table  # noqa: E402
+from app.services.drug_name_index import DrugNameIndex  # noqa: E402
+from _legacy_smart_filter import smart_filter_drugs as legacy_smart_filter_drugs  # noqa: E402
+
+_SYLLABLES = [c + v for c in ('b', 'c', 'd', 'f', 'g', 'l', 'm', 'n', 'p', 'pr', 'r', 's', 't', 'v', 'x', 'z')
+              for v in ('a', 'e', 'i', 'o', 'u')] + ['zol', 'fen', 'cin', 'dol', 'mab', 'vir', 'tan', 'pam', 'lin', 'pril']
+_ZH_CHARS = ('安立普樂舒康寧定平克斯益多瓦卡加美得欣泰利膠囊錠健保生力達衛福華新德佳恩維素寶心肝腎胃腸'
+             '血壓糖脂酸鈣鎂鐵鋅氯鈉鉀碘磷硫氧氫碳氮抗炎痛熱咳喘敏菌毒病疹癢眠鎮靜憂躁神經肌骨關節'
+             '眼耳鼻喉口齒皮膚膜液膏劑粉散丸片針貼噴霧滴凝膠糖漿懸浮緩釋持續長效速崩溶解口含舌下腸溶')
+_FORMS = ['Tablets', 'Capsules', 'F.C. Tablets', 'Film-Coated', '']
+_DOSES = ['5mg', '10mg', '20mg', '40mg', '0.125MG', '500 mg', '']
+
+# 確保特殊規則（spalytic / mosapride / gascon）也會被觸發
+_SPECIAL_DRUGS = [
+    {'drug_name_en': 'Spalytic HS Tablets', 'drug_name_zh': '使巴利錠 HS'},
+    {'drug_name_en': 'Mosapride 5mg Tablets', 'drug_name_zh': '摩舒益多錠'},
+    {'drug_name_en': 'Gascon 40mg Tablets', 'drug_name_zh': '瓦斯康錠 40毫克'},
+]
+
+
+def build_catalog(size: int, seed: int = 42):
+    rng = random.Random(seed)
+    drugs = []
+    for i in range(size):
+        stem = ''.join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+        en = ' '.join(p for p in (stem, rng.choice(_DOSES), rng.choice(_FORMS)) if p)
+        zh = ''.join(rng.choice(_ZH_CHARS) for _ in range(rng.randint(2, 5)))
+        drugs.append({
+            'drug_id': f'D{i:06d}',
+            'drug_name_zh': zh,
+            'drug_name_en': en,
+            'main_use': '合成測試資料',
+            'side_effects': '無',
+        })
+    for offset, special in enumerate(_SPECIAL_DRUGS):
+        drugs[offset * (size // len(_SPECIAL_DRUGS))].update(special)
+    return drugs
+
+
+def build_keywords(drugs, count: int, seed: int = 7):
+    rng = random.Random(seed)
+    keywords = ['Spalytic_HS', '摩舒益多', 'Gascon 40mg']
+    for drug in rng.sample(drugs, count):
+        name = drug['drug_name_en'] if rng.random() < 0.7 else drug['drug_name_zh']
+        keywords.append(name.split(' ')[0])
+    return keywords
+
+
+def timed(func, runs: int):
+    durations, result = [], None
+    for _ in range(runs):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func()
+        durations.append(time.perf_counter() - start)
+    return durations, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drugs', type=int, default=50000, help='合成藥品目錄大小')
+    parser.add_argument('--keywords', type=int, default=8, help='隨機 OCR 關鍵字數量（另含 3 個特殊規則關鍵字）')
+    parser.add_argument('--runs', type=int, default=3, help='每種實作的重複次數')
+    parser.add_argument('--top-k', type=int, default=50, help='numpy 後端每個關鍵字保留的候選數')
+    parser.add_argument('--skip-before', action='store_true', help='略過改版前實作（大型目錄時很慢）')
+    args = parser.parse_args()
+
+    drugs = build_catalog(args.drugs)
+    keywords = build_keywords(drugs, args.keywords)
+    print(f"目錄: {len(drugs)} 種藥物, 關鍵字: {len(keywords)} 個")
+
+    build_start = time.perf_counter()
+    name_index = DrugNameIndex(drugs, version=1)
+    build_time = time.perf_counter() - build_start
+
+    after, actual = timed(lambda: smart_filter_drugs(drugs, keywords, name_index=name_index, backend='python'), args.runs)
+    print(f"索引建立（每個目錄版本一次）: {build_time:.3f}s")
+
+    same = True
+    if not args.skip_before:
+        before, expected = timed(lambda: legacy_smart_filter_drugs(drugs, keywords), args.runs)
+        same = [d['drug_id'] for d in expected] == [d['drug_id'] for d in actual]
+        print(f"before: 中位數 {statistics.median(before):.3f}s  ({', '.join(f'{t:.3f}' for t in before)})")
+    print(f"after:  中位數 {statistics.median(after):.3f}s  ({', '.join(f'{t:.3f}' for t in after)})")
+    if not args.skip_before:
+        print(f"加速: {statistics.median(before) / statistics.median(after):.2f}x, 結果一致: {same}")
+
+    if drug_vector_scorer.is_available():
+        build_start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            drug_vector_scorer.get_vector_scorer(name_index)
+        vector_build_time = time.perf_counter() - build_start
+        vector, vector_result = timed(
+            lambda: smart_filter_drugs(drugs, keywords, name_index=name_index, backend='numpy', top_k=args.top_k),
+            args.runs)
+        # python 後端分數 >= 0.8 的強匹配（直接/標準化/組件/特殊規則）有多少也出現在 numpy 後端結果中
+        keyword_forms = [_KeywordForms(keyword, name_index) for keyword in keywords]
+        with contextlib.redirect_stdout(io.StringIO()):
+            alias_matches = get_alias_table().match(name_index, keywords)
+        strong = [entry.drug['drug_id'] for pos, entry in enumerate(name_index.entries)
+                  if _score_drug(pos, entry, keyword_forms, alias_matches)[0] >= 0.8]
+        vector_ids = {d['drug_id'] for d in vector_result}
+        covered = sum(1 for drug_id in strong if drug_id in vector_ids)
+        print(f"向量索引建立（每個目錄版本一次）: {vector_build_time:.3f}s")
+        print(f"numpy:  中位數 {statistics.median(vector):.3f}s  ({', '.join(f'{t:.3f}' for t in vector)}), "
+              f"python 強匹配被涵蓋: {covered}/{len(strong)}")
+    else:
+        print("numpy 未安裝，略過向量評分後端")
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+# benchmarks/check_similarity_recall.py
+"""
+相似度候選集召回率檢查（不需要資料庫）。
+
+對每個 (關鍵字, 藥名) 組合，以全目錄 difflib 掃描找出相似度 >= 門檻的配對，
+再檢查這些配對是否都落在 DrugNameIndex.similarity_candidates 找出的候選 slot 內，
+並比較 smart_filter_drugs 新舊實作的最終結果。
+
+關鍵字來源：隨機抽取藥名並模擬 OCR 誤讀（替換、刪除、插入、相鄰交換、截斷）。
+
+用法（於專案根目錄執行）:
+    python benchmarks/check_similarity_recall.py --drugs 20000 --keywords 200
+"""
+
+import argparse
+import contextlib
+import difflib
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.services.ai_processor import smart_filter_drugs  # noqa: E402
+from app.services.drug_name_index import SIMILARITY_THRESHOLD, DrugNameIndex  # noqa: E402
+from _legacy_smart_filter import smart_filter_drugs as legacy_smart_filter_drugs  # noqa: E402
+from bench_smart_filter import build_catalog  # noqa: E402
+
+_OCR_NOISE = 'abcdefghijklmnopqrstuvwxyz0123456789 _-.斯康益多'
+
+
+def ocr_misread(text: str, rng: random.Random) -> str:
+    chars = list(text)
+    for _ in range(rng.randint(0, 3)):
+        if not chars:
+            break
+        op = rng.choice(('replace', 'delete', 'insert', 'swap', 'truncate'))
+        i = rng.randrange(len(chars))
+        if op == 'replace':
+            chars[i] = rng.choice(_OCR_NOISE)
+        elif op == 'delete':
+            del chars[i]
+        elif op == 'insert':
+            chars.insert(i, rng.choice(_OCR_NOISE))
+        elif op == 'swap' and i + 1 < len(chars):
+            chars[i], chars[i + 1] = chars[i + 1], chars[i]
+        elif op == 'truncate' and len(chars) > 4:
+            chars = chars[:max(3, i)]
+    return ''.join(chars)
+
+
+def build_keywords(drugs, count: int, seed: int):
+    rng = random.Random(seed)
+    keywords = []
+    for drug in rng.sample(drugs, count):
+        name = drug['drug_name_en'] if rng.random() < 0.6 else drug['drug_name_zh']
+        if rng.random() < 0.5:
+            name = name.split(' ')[0]
+        keyword = ocr_misread(name, rng).strip()
+        if keyword:
+            keywords.append(keyword)
+    return keywords
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drugs', type=int, default=20000, help='合成藥品目錄大小')
+    parser.add_argument('--keywords', type=int, default=200, help='模擬 OCR 關鍵字數量')
+    parser.add_argument('--filter-runs', type=int, default=5, help='比較 smart_filter_drugs 新舊結果的請求數')
+    parser.add_argument('--seed', type=int, default=11)
+    args = parser.parse_args()
+
+    drugs = build_catalog(args.drugs)
+    keywords = build_keywords(drugs, args.keywords, args.seed)
+    name_index = DrugNameIndex(drugs, version=1)
+    print(f"目錄: {len(drugs)} 種藥物, 關鍵字: {len(keywords)} 個, posting: {name_index.stats()['posting_count']} 個")
+
+    # 1. 配對層級召回率：全掃描 vs 候選集
+    expected_pairs = 0
+    missed = []
+    candidate_total = 0
+    scan_time = index_time = 0.0
+    for keyword in keywords:
+        keyword_lower = keyword.lower()
+
+        start = time.perf_counter()
+        hits = [slot for pos, entry in enumerate(name_index.entries)
+                for slot, name in ((pos * 2, entry.zh_lower), (pos * 2 + 1, entry.en_lower))
+                if difflib.SequenceMatcher(None, keyword_lower, name).ratio() >= SIMILARITY_THRESHOLD]
+        scan_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        candidates = name_index.similarity_candidates(keyword_lower)
+        index_time += time.perf_counter() - start
+
+        candidate_total += len(candidates)
+        expected_pairs += len(hits)
+        missed.extend((keyword, name_index.entries[slot // 2]) for slot in hits if slot not in candidates)
+
+    recall = 1.0 if not expected_pairs else (expected_pairs - len(missed)) / expected_pairs
+    print(f"相似度 >= {SIMILARITY_THRESHOLD} 的配對: {expected_pairs}, 遺漏: {len(missed)}, 召回率: {recall:.4%}")
+    print(f"平均候選藥名數: {candidate_total / max(len(keywords), 1):.1f} / {len(drugs) * 2}")
+    print(f"全掃描 ratio(): {scan_time:.2f}s, 取候選集: {index_time:.3f}s")
+    for keyword, entry in missed[:10]:
+        print(f"  遺漏: {keyword!r} -> {entry.en_lower!r} / {entry.zh_lower!r}")
+
+    # 2. 請求層級：smart_filter_drugs 最終結果需與改版前一致
+    rng = random.Random(args.seed)
+    mismatches = 0
+    for _ in range(args.filter_runs):
+        request_keywords = rng.sample(keywords, min(8, len(keywords)))
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = [d['drug_id'] for d in legacy_smart_filter_drugs(drugs, request_keywords)]
+            actual = [d['drug_id'] for d in smart_filter_drugs(drugs, request_keywords, name_index=name_index)]
+        if expected != actual:
+            mismatches += 1
+            print(f"  結果不一致: {request_keywords}")
+    print(f"smart_filter_drugs 結果一致: {args.filter_runs - mismatches}/{args.filter_runs}")
+
+    return 0 if not missed and not mismatches else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
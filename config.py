@@ -51,6 +51,150 @@ class Config:
     DB_NAME = os.environ.get('DB_NAME')
     DB_PORT = int(os.environ.get('DB_PORT', 3306))
 
+    # --- 藥品目錄快取設定 ---
+    # 每隔多少秒探測一次 drug_info 是否有變動（增量更新）
+    DRUG_CATALOG_REFRESH_SECONDS = float(os.environ.get('DRUG_CATALOG_REFRESH_SECONDS', 300))
+    # 每隔多少秒強制整表重載一次
+    DRUG_CATALOG_FULL_RELOAD_SECONDS = float(os.environ.get('DRUG_CATALOG_FULL_RELOAD_SECONDS', 3600))
+
+    # --- 藥品篩選 (smart_filter_drugs) 設定 ---
+    # 'python': 逐一評分全部藥品；'numpy': 向量批次評分，只評估每個關鍵字的前 SMART_FILTER_TOP_K 名
+    SMART_FILTER_BACKEND = os.environ.get('SMART_FILTER_BACKEND', 'python')
+    SMART_FILTER_TOP_K = int(os.environ.get('SMART_FILTER_TOP_K', 50))
+
+    # --- OCR 關鍵字快取設定 ---
+    # 記憶體中保留的項目數
+    OCR_CACHE_SIZE = int(os.environ.get('OCR_CACHE_SIZE', 512))
+    # 快取存活秒數（0 表示不過期）
+    OCR_CACHE_TTL_SECONDS = float(os.environ.get('OCR_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+    # 磁碟快取目錄，設定後重新啟動仍保留快取（留空則只使用記憶體）
+    OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR', '')
+
+    # --- 藥單分析結果快取設定 ---
+    # 保留的分析結果數量
+    ANALYSIS_CACHE_SIZE = int(os.environ.get('ANALYSIS_CACHE_SIZE', 128))
+    # 分析結果存活秒數（0 表示不過期）
+    ANALYSIS_CACHE_TTL_SECONDS = float(os.environ.get('ANALYSIS_CACHE_TTL_SECONDS', 3600))
+
+    # --- Gemini 呼叫閘道設定 ---
+    # 同時進行中的 Gemini 請求上限（整個行程共用）
+    GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', 4))
+    # 每分鐘請求數上限（0 表示不限制）
+    GEMINI_RPM_LIMIT = int(os.environ.get('GEMINI_RPM_LIMIT', 60))
+    # 暫時性錯誤（429 / 5xx / 逾時）的重試次數
+    GEMINI_MAX_RETRIES = int(os.environ.get('GEMINI_MAX_RETRIES', 3))
+
+    # --- 藥單圖片前處理設定 ---
+    # 是否在送出 Gemini 前先轉正、縮圖並重新壓縮圖片
+    IMAGE_PREPROCESS_ENABLED = os.environ.get('IMAGE_PREPROCESS_ENABLED', 'true').lower() == 'true'
+    # 縮圖後的最長邊（像素）
+    IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', 1600))
+    # 是否轉為灰階
+    IMAGE_GRAYSCALE = os.environ.get('IMAGE_GRAYSCALE', 'false').lower() == 'true'
+    # 重新編碼的 JPEG 品質（1-95）
+    IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+    # 前處理執行緒池大小
+    IMAGE_PREPROCESS_WORKERS = int(os.environ.get('IMAGE_PREPROCESS_WORKERS', 4))
+
+    # --- 非同步執行環境設定 ---
+    # 事件迴圈交付阻塞工作（資料庫、Gemini、圖片處理）的執行緒池大小
+    ASYNC_EXECUTOR_WORKERS = int(os.environ.get('ASYNC_EXECUTOR_WORKERS', 16))
+
+    # --- 分析 Prompt 設定 ---
+    # 候選藥物表格的 token 預算，超過時從匹配分數最低的一端截斷（0 表示不限制）
+    ANALYSIS_PROMPT_TOKEN_BUDGET = int(os.environ.get('ANALYSIS_PROMPT_TOKEN_BUDGET', 6000))
+    # 是否以串流方式接收分析結果（每解析出一筆藥物就可先推送部分結果）
+    ANALYSIS_STREAMING_ENABLED = os.environ.get('ANALYSIS_STREAMING_ENABLED', 'false').lower() == 'true'
+    # 串流模式下解析出幾筆藥物後推送部分結果
+    ANALYSIS_STREAM_PARTIAL_AFTER = int(os.environ.get('ANALYSIS_STREAM_PARTIAL_AFTER', 2))
+
+    # --- 多圖分組分析設定 ---
+    # 圖片數超過此值時改為分組並行分析（0 表示一律單一請求）
+    ANALYSIS_SPLIT_THRESHOLD = int(os.environ.get('ANALYSIS_SPLIT_THRESHOLD', 3))
+    # 每組的圖片數
+    ANALYSIS_SPLIT_GROUP_SIZE = int(os.environ.get('ANALYSIS_SPLIT_GROUP_SIZE', 1))
+    # 同時進行的分組分析數
+    ANALYSIS_SPLIT_CONCURRENCY = int(os.environ.get('ANALYSIS_SPLIT_CONCURRENCY', 3))
+
+    # --- 外部 OCR API 多圖處理設定 ---
+    # 多張圖片同時送出的請求數上限
+    OCR_MULTI_WORKERS = int(os.environ.get('OCR_MULTI_WORKERS', 4))
+    # 每張圖片的逾時秒數（api_ocr 包含輪詢等待），逾時的圖片視為失敗
+    OCR_MULTI_TIMEOUT_SECONDS = float(os.environ.get('OCR_MULTI_TIMEOUT_SECONDS', 240))
+
+    # --- 外部 OCR 非同步任務追蹤設定 ---
+    # 送出後第一次查詢結果前的等待秒數
+    OCR_POLL_INITIAL_DELAY = float(os.environ.get('OCR_POLL_INITIAL_DELAY', 5))
+    # 查詢間隔的起始秒數（每次未完成加倍並加上隨機抖動）
+    OCR_POLL_BASE_INTERVAL = float(os.environ.get('OCR_POLL_BASE_INTERVAL', 2))
+    # 查詢間隔上限秒數
+    OCR_POLL_MAX_INTERVAL = float(os.environ.get('OCR_POLL_MAX_INTERVAL', 30))
+    # 遠端任務的逾時秒數
+    OCR_JOB_TIMEOUT_SECONDS = float(os.environ.get('OCR_JOB_TIMEOUT_SECONDS', 240))
+    # 本服務的公開網址與回呼驗證碼；兩者都設定時，送出任務會附上完成回呼網址（/api/ocr/callback）
+    OCR_CALLBACK_URL = os.environ.get('OCR_CALLBACK_URL', '')
+    OCR_CALLBACK_TOKEN = os.environ.get('OCR_CALLBACK_TOKEN', '')
+
+    # --- 藥單分析工作佇列設定 ---
+    # 'mysql': 存在 MySQL 的 analysis_jobs（所有執行個體共用，重新啟動後保留）；'sqlite': 本機 SQLite 檔案（僅限單一執行個體的本機開發）
+    ANALYSIS_QUEUE_BACKEND = os.environ.get('ANALYSIS_QUEUE_BACKEND', 'mysql')
+    # sqlite 模式的佇列檔案路徑
+    ANALYSIS_QUEUE_DB_PATH = os.environ.get('ANALYSIS_QUEUE_DB_PATH', '/tmp/analysis_queue.db')
+    # 執行分析的工作執行緒數
+    ANALYSIS_QUEUE_WORKERS = int(os.environ.get('ANALYSIS_QUEUE_WORKERS', 2))
+    # 每個任務的最多執行次數，超過後移入死信
+    ANALYSIS_JOB_MAX_ATTEMPTS = int(os.environ.get('ANALYSIS_JOB_MAX_ATTEMPTS', 3))
+    # 第一次重試前的等待秒數（之後每次加倍）
+    ANALYSIS_JOB_RETRY_DELAY = float(os.environ.get('ANALYSIS_JOB_RETRY_DELAY', 10))
+    # 執行中的任務超過此秒數仍未結束，視為執行個體已中斷並重新排入佇列
+    ANALYSIS_JOB_STALE_SECONDS = float(os.environ.get('ANALYSIS_JOB_STALE_SECONDS', 900))
+    # 已完成任務的保留小時數（0 表示不清除）
+    ANALYSIS_QUEUE_RETENTION_HOURS = float(os.environ.get('ANALYSIS_QUEUE_RETENTION_HOURS', 24))
+
+    # --- LINE Webhook 事件分派設定 ---
+    # 處理 Webhook 事件的執行緒數（不同用戶同時處理，同一用戶依序處理）
+    WEBHOOK_DISPATCH_WORKERS = int(os.environ.get('WEBHOOK_DISPATCH_WORKERS', 8))
+
+    # --- 用戶工作階段快取設定 ---
+    # 快取狀態的用戶數上限
+    SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 2048))
+    # 簡單與複雜狀態的快取存活秒數（簡單狀態另受 expires_at 限制）。
+    # 快取不會在執行個體之間同步失效，Cloud Run 有多個執行個體時須維持 0（不快取狀態，只快取已知用戶）
+    SESSION_CACHE_TTL_SECONDS = float(os.environ.get('SESSION_CACHE_TTL_SECONDS', 0))
+    # 記住已確認存在的用戶數上限
+    KNOWN_USERS_CACHE_SIZE = int(os.environ.get('KNOWN_USERS_CACHE_SIZE', 10000))
+    # 超過此大小（KB）的複雜狀態不快取（例如夾帶藥單圖片的狀態）
+    SESSION_CACHE_MAX_STATE_KB = int(os.environ.get('SESSION_CACHE_MAX_STATE_KB', 128))
+
+    # --- 藥單圖片儲存設定 ---
+    # 'local': 存在本機目錄（僅限單一執行個體，例如本機開發）；'gcs': 存在 Google Cloud Storage（多個執行個體共用，正式環境使用）
+    BLOB_STORE_BACKEND = os.environ.get('BLOB_STORE_BACKEND', 'local')
+    # local 模式的儲存目錄
+    BLOB_STORE_DIR = os.environ.get('BLOB_STORE_DIR', '/tmp/prescription_blobs')
+    # gcs 模式的 bucket 名稱與物件路徑前綴
+    BLOB_STORE_BUCKET = os.environ.get('BLOB_STORE_BUCKET', '')
+    BLOB_STORE_PREFIX = os.environ.get('BLOB_STORE_PREFIX', 'prescriptions/')
+    # 圖片保留小時數，超過後由垃圾回收刪除（0 表示不回收）
+    BLOB_STORE_TTL_HOURS = float(os.environ.get('BLOB_STORE_TTL_HOURS', 24))
+
+    # --- 複雜狀態儲存設定 ---
+    # 'mysql': 存在 MySQL 的 user_temp_state；'sqlite': 存在本機 SQLite 檔案（本機開發用）
+    STATE_BACKEND = os.environ.get('STATE_BACKEND', 'mysql')
+    STATE_SQLITE_PATH = os.environ.get('STATE_SQLITE_PATH', '/tmp/user_state.db')
+    # 狀態 JSON 超過此大小（bytes）時壓縮後再寫入（0 表示不壓縮）
+    STATE_COMPRESS_MIN_BYTES = int(os.environ.get('STATE_COMPRESS_MIN_BYTES', 4096))
+    # 壓縮格式：'zlib'，或安裝 zstandard 套件後可用 'zstd'
+    STATE_COMPRESS_ALGORITHM = os.environ.get('STATE_COMPRESS_ALGORITHM', 'zlib')
+    STATE_COMPRESS_LEVEL = int(os.environ.get('STATE_COMPRESS_LEVEL', 6))
+
+    # --- 推測分析設定 ---
+    # 是否以成員近期用藥為候選清單，與關鍵字擷取同時開始完整分析
+    SPECULATIVE_ANALYSIS_ENABLED = os.environ.get('SPECULATIVE_ANALYSIS_ENABLED', 'false').lower() == 'true'
+    # 近期用藥清單的藥品數上限
+    SPECULATIVE_SHORTLIST_SIZE = int(os.environ.get('SPECULATIVE_SHORTLIST_SIZE', 30))
+    # 近期用藥清單的快取秒數（0 表示不過期）
+    SPECULATIVE_SHORTLIST_TTL_SECONDS = float(os.environ.get('SPECULATIVE_SHORTLIST_TTL_SECONDS', 600))
+
     @staticmethod
     def validate_config():
         """檢查所有必要的環境變數是否都已設定。"""
@@ -0,0 +1,3 @@
+-- user_temp_state 的版本號欄位（複雜狀態的樂觀鎖與部分更新使用）
+-- 部署新版本前執行一次；既有的狀態版本號為 0
+ALTER TABLE user_temp_state ADD COLUMN version INT NOT NULL DEFAULT 0;